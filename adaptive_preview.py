@@ -0,0 +1,265 @@
+#! /usr/bin/env python3
+"""
+adaptive_preview.py
+پیش‌نمایش MJPEG تطبیقی: برای هر کلاینت سرعت ارسال اندازه‌گیری می‌شود و از بین چند سطح
+(اندازه، کیفیت، fps) که هر کدام یک بار برای همه کلاینت‌های آن سطح encode می‌شوند انتخاب می‌شود
+فریم‌ها صف نمی‌شوند: هر کلاینت همیشه تازه‌ترین فریم سطح خودش را می‌گیرد، پس تأخیر محدود می‌ماند
+"""
+
+import time
+import itertools
+import cv2
+from threading import Condition, Thread, Lock
+from frame_hub import MJPEG_HEADER, MJPEG_TRAILER
+from buffer_pool import BufferPool
+
+# سطح‌ها از بهترین به کم‌حجم‌ترین
+TIERS = (
+    {"name": "high", "scale": 1.0, "quality": 80, "fps": 30},
+    {"name": "medium", "scale": 0.75, "quality": 60, "fps": 15},
+    {"name": "low", "scale": 0.5, "quality": 45, "fps": 8},
+    {"name": "minimal", "scale": 0.25, "quality": 30, "fps": 4},
+)
+
+# فقط از این کسر ظرفیت اندازه‌گیری شده استفاده می‌کنیم
+HEADROOM = 0.8
+# تعداد ارسال پشت سر هم با ظرفیت کافی قبل از رفتن به سطح بالاتر
+UPGRADE_AFTER = 10
+# ضریب میانگین متحرک نمایی برای سرعت ارسال
+EWMA_ALPHA = 0.3
+
+
+class TierEncoder:
+    """سطح‌های فعال (با حداقل یک کلاینت) را از فریم‌های خام FrameHub می‌سازد"""
+
+    def __init__(self, hub, tiers=TIERS):
+        self.hub = hub
+        self.tiers = tiers
+        self._cond = Condition()
+        self._pool = BufferPool()
+        self._clients_lock = Lock()
+        self._ids = itertools.count(1)
+        self.clients = {}
+
+        n = len(tiers)
+        self.subscribers = [0] * n
+        self.versions = [0] * n
+        self.parts = [None] * n
+        self.sizes = [0] * n
+        self.encoded = [0] * n
+        self._last_encode = [0.0] * n
+        self._thread = None
+
+    def _ensure_started(self):
+        with self._cond:
+            if self._thread is None:
+                self._thread = Thread(target=self._run, name="tier-encoder", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        last_version = 0
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: any(self.subscribers))
+            item = self.hub.acquire(last_version)
+            if item is None:
+                continue
+            last_version, frame = item[0], item[1]
+            try:
+                self._encode_tiers(frame)
+            finally:
+                self.hub.release(frame)
+
+    def _encode_tiers(self, frame):
+        now = time.monotonic()
+        for i, tier in enumerate(self.tiers):
+            if not self.subscribers[i] or now - self._last_encode[i] < 1.0 / tier["fps"]:
+                continue
+            self._last_encode[i] = now
+            part = self._encode(i, tier, frame)
+            if part is None:
+                continue
+            with self._cond:
+                self.versions[i] += 1
+                self.parts[i] = part
+                self.sizes[i] = len(part)
+                self.encoded[i] += 1
+                self._cond.notify_all()
+
+    def _encode(self, i, tier, frame):
+        if tier["scale"] != 1.0:
+            h, w = frame.shape[:2]
+            size = (max(1, int(w * tier["scale"])), max(1, int(h * tier["scale"])))
+            dst = self._pool.get(("tier", i), (size[1], size[0]) + frame.shape[2:], frame.dtype)
+            frame = cv2.resize(frame, size, dst=dst, interpolation=cv2.INTER_AREA)
+        ret, buffer = cv2.imencode('.jpg', frame, [int(cv2.IMWRITE_JPEG_QUALITY), tier["quality"]])
+        if not ret:
+            return None
+        return b''.join((MJPEG_HEADER, memoryview(buffer), MJPEG_TRAILER))
+
+    # -----------------------
+    # اشتراک در سطح‌ها
+    # -----------------------
+    def _subscribe(self, i):
+        with self._cond:
+            self.subscribers[i] += 1
+            self._cond.notify_all()
+
+    def _unsubscribe(self, i):
+        with self._cond:
+            self.subscribers[i] -= 1
+
+    def wait_tier(self, i, last_version, timeout=1.0):
+        """تازه‌ترین فریم سطح i که از last_version جدیدتر است (فریم‌های میانی رد می‌شوند)"""
+        with self._cond:
+            if not self._cond.wait_for(lambda: self.versions[i] > last_version, timeout):
+                return None
+            return self.versions[i], self.parts[i]
+
+    def estimated_bytes(self, i, reference):
+        """حجم تقریبی هر فریم سطح i (اگر هنوز encode نشده از روی سطح reference تخمین زده می‌شود)"""
+        if self.sizes[i]:
+            return self.sizes[i]
+        ratio = (self.tiers[i]["scale"] / self.tiers[reference]["scale"]) ** 2
+        return self.sizes[reference] * ratio
+
+    def stream(self, tier=None):
+        """generator برای یک کلاینت؛ tier: نام سطح برای ثابت نگه داشتن، None یعنی تطبیقی"""
+        client = AdaptiveClient(self, next(self._ids), tier)
+        with self._clients_lock:
+            self.clients[client.id] = client
+        self._ensure_started()
+        try:
+            yield from client.run()
+        finally:
+            with self._clients_lock:
+                self.clients.pop(client.id, None)
+
+    def get_stats(self):
+        with self._clients_lock:
+            clients = [c.summary() for c in self.clients.values()]
+        return {
+            "tiers": [dict(t, subscribers=self.subscribers[i], frame_bytes=self.sizes[i], encoded=self.encoded[i])
+                      for i, t in enumerate(self.tiers)],
+            "clients": clients,
+        }
+
+
+class AdaptiveClient:
+    def __init__(self, encoder, client_id, tier=None):
+        self.encoder = encoder
+        self.id = client_id
+        names = [t["name"] for t in encoder.tiers]
+        self.pinned = tier is not None
+        self.tier = names.index(tier) if tier is not None else min(1, len(names) - 1)
+        self.throughput = None  # بایت در ثانیه، میانگین متحرک
+        self._good = 0
+        self.frames = 0
+        self.bytes = 0
+        self.switches = 0
+        self.started = time.monotonic()
+
+    def run(self):
+        tier = self.tier
+        self.encoder._subscribe(tier)
+        last_version = 0
+        try:
+            while True:
+                item = self.encoder.wait_tier(tier, last_version)
+                if item is None:
+                    continue
+                last_version, part = item
+
+                # مدت معلق ماندن generator همان زمان نوشتن روی socket است
+                t0 = time.monotonic()
+                yield part
+                elapsed = time.monotonic() - t0
+                self.frames += 1
+                self.bytes += len(part)
+                self._update(len(part), elapsed)
+
+                if self.tier != tier:
+                    self.encoder._unsubscribe(tier)
+                    self.encoder._subscribe(self.tier)
+                    tier = self.tier
+                    last_version = 0
+        finally:
+            self.encoder._unsubscribe(tier)
+
+    def _update(self, size, elapsed):
+        rate = size / max(elapsed, 1e-4)
+        self.throughput = rate if self.throughput is None else (
+            EWMA_ALPHA * rate + (1 - EWMA_ALPHA) * self.throughput)
+        if self.pinned:
+            return
+
+        enc = self.encoder
+        budget = HEADROOM * self.throughput
+
+        def needs(i):
+            return enc.estimated_bytes(i, self.tier) * enc.tiers[i]["fps"]
+
+        if needs(self.tier) > budget and self.tier < len(enc.tiers) - 1:
+            # کاهش فوری
+            self.tier += 1
+            self.switches += 1
+            self._good = 0
+        elif self.tier > 0 and needs(self.tier - 1) <= budget:
+            # افزایش فقط بعد از چند نمونه خوب پشت سر هم
+            self._good += 1
+            if self._good >= UPGRADE_AFTER:
+                self.tier -= 1
+                self.switches += 1
+                self._good = 0
+        else:
+            self._good = 0
+
+    def summary(self):
+        elapsed = time.monotonic() - self.started
+        return {
+            "id": self.id,
+            "tier": self.encoder.tiers[self.tier]["name"],
+            "pinned": self.pinned,
+            "frames": self.frames,
+            "fps": self.frames / elapsed if elapsed else 0.0,
+            "bitrate_kbps": self.bytes * 8 / 1000 / elapsed if elapsed else 0.0,
+            "throughput_kbps": (self.throughput or 0.0) * 8 / 1000,
+            "switches": self.switches,
+        }
+
+
+if __name__ == "__main__":
+    # شبیه‌سازی کلاینت‌های سریع و کند روی منبع مصنوعی
+    import argparse
+    from frame_hub import FrameHub
+    from frame_source import create_source
+
+    parser = argparse.ArgumentParser(description="Adaptive MJPEG preview simulation")
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--links", default="100000,2000,500,100", help="سرعت لینک هر کلاینت (kbps)")
+    args = parser.parse_args()
+
+    source = create_source("synthetic")
+    hub = FrameHub(lambda: cv2.cvtColor(source.capture_array("lores"), cv2.COLOR_YUV420p2RGB))
+    encoder = TierEncoder(hub)
+    deadline = time.monotonic() + args.seconds
+
+    def client(kbps):
+        for part in encoder.stream():
+            time.sleep(len(part) * 8 / 1000 / kbps)  # شبیه‌سازی نوشتن روی لینک کند
+            if time.monotonic() > deadline:
+                break
+
+    threads = [Thread(target=client, args=(float(k),), daemon=True) for k in args.links.split(",")]
+    for t in threads:
+        t.start()
+    time.sleep(args.seconds - 0.5)
+    stats = encoder.get_stats()
+    for t in threads:
+        t.join()
+
+    for c, link in zip(sorted(stats["clients"], key=lambda c: c["id"]), args.links.split(",")):
+        print(f"link={link:>7s}kbps tier={c['tier']:8s} fps={c['fps']:5.1f} "
+              f"bitrate={c['bitrate_kbps']:8.1f}kbps switches={c['switches']}")
+    for t in stats["tiers"]:
+        print(f"  {t['name']:8s} encoded={t['encoded']:4d} frame={t['frame_bytes']}B")
@@ -3,8 +3,12 @@
 app.py
 برنامه Flask برای کنترل دوربین Raspberry Pi
 """
+import json
 from flask import Flask, render_template, Response, jsonify, request
-from camera import gen_frames, capture_image, start_recording
+from event_bus import sse
+from camera import (gen_frames, submit_capture, submit_burst, submit_raw, submit_recording, submit_analysis, stop_recording, jobs,
+                    camera_modes, preview_tiers, detection_worker, particle_tracker, roi_set, camera_source,
+                    event_recorder, arm_events, gate_stats, DETECTION_MODE, transfer_queue, usb_storage, direct_writer, event_bus)
 # from updater import check_and_update  # اگر آپدیت خودکار داری
 
 app = Flask(__name__)
@@ -16,27 +20,285 @@ def index():
 
 @app.route('/video_feed')
 def video_feed():
-    """استریم ویدئو زنده"""
-    return Response(gen_frames(), mimetype='multipart/x-mixed-replace; boundary=frame')
+    """استریم ویدئو زنده (?adaptive=1 برای انتخاب خودکار کیفیت، ?tier=low برای سطح ثابت)"""
+    adaptive = request.args.get('adaptive') == '1'
+    tier = request.args.get('tier') or None
+    names = [t["name"] for t in preview_tiers.tiers]
+    if tier is not None and tier not in names:
+        return jsonify({"status": "error", "message": f"Unknown tier {tier!r} (expected one of {names})"}), 400
+    return Response(gen_frames(adaptive=adaptive, tier=tier),
+                    mimetype='multipart/x-mixed-replace; boundary=frame')
+
+@app.route('/preview_stats')
+def preview_stats():
+    """سطح انتخاب شده و bitrate مؤثر هر کلاینت پیش‌نمایش تطبیقی"""
+    return jsonify(preview_tiers.get_stats())
 
 @app.route('/capture', methods=['POST'])
 def capture():
-    """گرفتن عکس"""
-    filename = capture_image()
-    return jsonify({"status": "success", "filename": filename})
+    """گرفتن عکس (job؛ نتیجه با /jobs/<id> یا /jobs/<id>/stream)"""
+    job = submit_capture()
+    return jsonify({"status": "queued", "job_id": job["id"], "job": job}), 202
+
+@app.route('/burst', methods=['POST'])
+def burst():
+    """عکس‌برداری پشت سر هم یا time-lapse (job): count عکس با فاصله interval ثانیه، format jpg یا npz"""
+    try:
+        count = int(request.form.get("count", 10))
+        interval = float(request.form.get("interval") or 0)
+        fmt = request.form.get("format", "jpg")
+        quality = int(request.form.get("quality", 90))
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    if count < 1 or interval < 0 or fmt not in ("jpg", "npz"):
+        return jsonify({"status": "error", "message": "Invalid burst parameters"}), 400
+    job = submit_burst(count, interval=interval, fmt=fmt, quality=quality)
+    return jsonify({"status": "queued", "job_id": job["id"], "job": job}), 202
+
+@app.route('/raw_capture', methods=['POST'])
+def raw_capture():
+    """ضبط خام (job) در stack memory-mapped روی USB: frames، stream، plane، decimation و seconds اختیاری"""
+    try:
+        frames = int(request.form.get("frames", 300))
+        stream = request.form.get("stream", "lores")
+        plane = request.form.get("plane", "y")
+        decimation = int(request.form.get("decimation", 1))
+        seconds = float(request.form.get("seconds") or 0) or None
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    if frames < 1 or decimation < 1 or stream not in ("lores", "main") or plane not in ("y", "bgr", "native"):
+        return jsonify({"status": "error", "message": "Invalid raw capture parameters"}), 400
+    job = submit_raw(frames, stream=stream, plane=plane, decimation=decimation, seconds=seconds,
+                     sample_id=request.form.get("sampleId", "").strip())
+    return jsonify({"status": "queued", "job_id": job["id"], "job": job}), 202
 
 @app.route('/start_recording', methods=['POST'])
 def start_rec():
     """Start video recording"""
     try:
         duration = int(request.form.get("duration", 60))
-        print(f"Starting recording for {duration} seconds...")  # Debug
-        path = start_recording(duration=duration)
-        return jsonify({"status": "success", "path": path})
+        track = request.form.get("track") == "1"
+        sample_id = request.form.get("sampleId", "").strip()
+        roi = request.form.get("roi") or None
+        gate = request.form.get("gate") == "1"
+        # قطعه‌بندی: هر segment ثانیه یا segment_mb مگابایت یک فایل، منتقل شده در طول ضبط
+        segment_seconds = float(request.form.get("segment") or 0) or None
+        segment_bytes = int(float(request.form.get("segment_mb") or 0) * 2**20) or None
+        analyse = request.form.get("analyse") == "1"
+        # درخواست فقط job را ثبت می‌کند؛ ضبط بدون مدت (duration <= 0) تا /stop_recording ادامه دارد
+        print(f"Queueing recording for {duration} seconds...")  # Debug
+        job = submit_recording(duration, track=track, sample_id=sample_id, roi=roi, gate=gate,
+                               segment_seconds=segment_seconds, segment_bytes=segment_bytes, analyse=analyse)
+        return jsonify({"status": "queued", "duration": duration, "job_id": job["id"], "job": job}), 202
     except Exception as e:
         print("Route error:", str(e))  # Log the error
         return jsonify({"status": "error", "message": str(e)}), 500
 
+@app.route('/stop_recording', methods=['POST'])
+def stop_rec():
+    """پایان ضبط در حال اجرا (به‌ویژه ضبط بدون مدت)"""
+    if stop_recording():
+        return jsonify({"status": "success", "message": "Recording stopped"})
+    return jsonify({"status": "error", "message": "Not recording"}), 409
+
+@app.route('/analyse', methods=['POST'])
+def analyse_route():
+    """تحلیل دسته‌ای فایل‌ها (فهرست glob در patterns، جدا شده با کاما) در lane تحلیل"""
+    patterns = [p.strip() for p in request.form.get("patterns", "").split(",") if p.strip()]
+    if not patterns:
+        return jsonify({"status": "error", "message": "No input patterns"}), 400
+    job = submit_analysis(patterns, sample_id=request.form.get("sampleId", "").strip() or None)
+    return jsonify({"status": "queued", "job_id": job["id"], "job": job}), 202
+
+@app.route('/jobs')
+def jobs_list():
+    """همه کارها (?kind=record برای یک نوع) و وضعیت lane ها"""
+    return jsonify({"stats": jobs.summary(), "jobs": jobs.jobs(request.args.get("kind"))})
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    """وضعیت، پیشرفت و نتیجه یک کار"""
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({"status": "error", "message": "Unknown job"}), 404
+    return jsonify(job)
+
+@app.route('/jobs/<job_id>/cancel', methods=['POST'])
+def job_cancel(job_id):
+    """لغو کار در صف، یا توقف کار در حال اجرا (ضبط)"""
+    job = jobs.cancel(job_id)
+    if job is None:
+        return jsonify({"status": "error", "message": "Unknown job"}), 404
+    return jsonify(job)
+
+def _job_stream(job_id):
+    """SSE یک کار: هر تغییر وضعیت یک رویداد، بسته شده بعد از وضعیت نهایی"""
+    version = 0
+    while True:
+        version, changed = jobs.wait_for(version, timeout=15, job_id=job_id)
+        if not changed:
+            yield ": keep-alive\n\n"
+            continue
+        for job in changed:
+            yield f"event: job\ndata: {json.dumps(job)}\n\n"
+        if changed[-1]["state"] in ("done", "failed", "cancelled"):
+            return
+
+@app.route('/stream')
+def stream():
+    """
+    SSE همه وضعیت‌های زنده از event bus: job (پیشرفت ضبط/تحلیل)، transfer (بایت‌های کپی شده)،
+    mode، storage و particles (شمار و مسیرهای هر فریم)؛ ?topics=job,transfer برای محدود کردن
+    """
+    topics = [t for t in request.args.get("topics", "").split(",") if t] or None
+    return Response(sse(event_bus.subscribe(topics)), mimetype='text/event-stream',
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.route('/stream_stats')
+def stream_stats():
+    """تعداد مشترکان، هزینه publish و رویدادهای ادغام/حذف شده در صف کلاینت‌های کند"""
+    return jsonify(event_bus.summary())
+
+@app.route('/jobs/stream')
+def jobs_stream():
+    """SSE همه کارها (فقط topic job از event bus)"""
+    return Response(sse(event_bus.subscribe(["job"])), mimetype='text/event-stream',
+                    headers={"Cache-Control": "no-cache"})
+
+@app.route('/jobs/<job_id>/stream')
+def job_stream(job_id):
+    """SSE یک کار تا پایان آن"""
+    if jobs.get(job_id) is None:
+        return jsonify({"status": "error", "message": "Unknown job"}), 404
+    return Response(_job_stream(job_id), mimetype='text/event-stream', headers={"Cache-Control": "no-cache"})
+
+@app.route('/gate_stats')
+def gate_stats_route():
+    """نسبت فریم‌های بدون تغییر که encode/تشخیص نشدند و CPU صرفه‌جویی شده"""
+    return jsonify(gate_stats())
+
+@app.route('/check_transfer/<path:key>')
+def check_transfer(key):
+    """پیشرفت انتقال یک فایل به USB (با id کار یا مسیر فایل محلی)"""
+    status = transfer_queue.status(key)
+    if status is None:
+        return jsonify({"status": "error", "message": "Unknown transfer"}), 404
+    if status["state"] == "done":
+        return jsonify({"status": "completed", "message": "File transfer completed successfully",
+                        "transfer": status})
+    if status["state"] == "failed":
+        return jsonify({"status": "error", "message": status["error"], "transfer": status})
+    message = f"{status['state']}: {status['done'] / 2**20:.1f} / {status['size'] / 2**20:.1f} MB"
+    if status["state"] == "waiting":
+        message += " (waiting for USB storage)"
+    return jsonify({"status": "processing", "message": message, "transfer": status})
+
+@app.route('/transfers')
+def transfers():
+    """همه کارهای صف انتقال"""
+    return jsonify({"stats": transfer_queue.summary(), "jobs": transfer_queue.jobs(),
+                    "storage": usb_storage.summary(), "direct": direct_writer.summary()})
+
+@app.route('/camera_metrics')
+def camera_metrics():
+    """تأخیر تغییر حالت دوربین برای هر عمل"""
+    return jsonify(camera_modes.get_metrics())
+
+@app.route('/detections')
+def detections():
+    """آخرین نتایج تشخیص ذرات (اولین درخواست تشخیص را شروع می‌کند)"""
+    try:
+        limit = max(0, int(request.args.get('limit', 100)))
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    detection_worker.start()
+    latest = detection_worker.latest
+    return jsonify({
+        "frame": detection_worker.frame_index,
+        "count": len(latest),
+        "particles": [dict(zip(latest.dtype.names, row.tolist())) for row in latest[:limit]],
+        "mode": DETECTION_MODE,
+        "stats": detection_worker.summary(),
+    })
+
+@app.route('/tracks')
+def tracks():
+    """آمار مسیرهای ذرات (سرعت، جهت، مدت حضور)"""
+    try:
+        min_length = max(0, int(request.args.get('min_length', 3)))
+        limit = max(0, int(request.args.get('limit', 100)))
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    detection_worker.start()
+    summary = particle_tracker.track_summary(min_length)
+    return jsonify({
+        "stats": particle_tracker.summary(),
+        "count": len(summary),
+        # آخرین limit مسیر (summary[-0:] کل آرایه را برمی‌گرداند)
+        "tracks": [dict(zip(summary.dtype.names, row.tolist()))
+                   for row in summary[max(0, len(summary) - limit):]],
+    })
+
+@app.route('/roi', methods=['GET', 'POST', 'DELETE'])
+def roi():
+    """
+    ROIهای تشخیص/ضبط
+    POST {"rois": [{"name", "x", "y", "w", "h"}], "units": "normalized" | "main" | "lores"}
+    """
+    if request.method == 'DELETE':
+        roi_set.clear()
+    elif request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        units = data.get("units", "normalized")
+        if units not in ("normalized", "main", "lores"):
+            return jsonify({"status": "error", "message": f"Unknown units: {units}"}), 400
+        size = None if units == "normalized" else camera_source.sizes[units]
+        try:
+            roi_set.set(data.get("rois", []), size=size)
+        except ValueError as e:
+            return jsonify({"status": "error", "message": str(e)}), 400
+    return jsonify({
+        "rois": roi_set.to_list(),
+        "main": [{"name": n, "rect": r} for n, r in roi_set.pixels(camera_source.sizes["main"])],
+        "lores": [{"name": n, "rect": r} for n, r in roi_set.pixels(camera_source.sizes["lores"])],
+    })
+
+def _optional_float(data, key):
+    value = data.get(key)
+    return float(value) if value not in (None, "") else None
+
+@app.route('/events', methods=['GET'])
+def events():
+    """وضعیت ضبط رویدادمحور و رویدادهای ذخیره شده"""
+    return jsonify(event_recorder.summary())
+
+@app.route('/events/arm', methods=['POST'])
+def events_arm():
+    """فعال کردن trigger: count، motion، aggregation، pre، post"""
+    data = request.get_json(silent=True) or request.form
+    try:
+        summary = arm_events(count=_optional_float(data, "count"),
+                             motion=_optional_float(data, "motion"),
+                             aggregation=_optional_float(data, "aggregation"),
+                             pre_seconds=_optional_float(data, "pre") or 10.0,
+                             post_seconds=_optional_float(data, "post") or 10.0)
+    except (ValueError, RuntimeError) as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    return jsonify(dict(summary, status="success"))
+
+@app.route('/events/disarm', methods=['POST'])
+def events_disarm():
+    event_recorder.disarm()
+    return jsonify(dict(event_recorder.summary(), status="success"))
+
+@app.route('/events/trigger', methods=['POST'])
+def events_trigger():
+    """رویداد دستی (ضبط pre-roll + post-roll)"""
+    if not event_recorder.armed:
+        return jsonify({"status": "error", "message": "Event recording is not armed"}), 400
+    event_recorder.trigger("manual")
+    return jsonify({"status": "success"})
+
 if __name__ == '__main__':
     # check_and_update()  # اگر لازم داری
     app.run(host='0.0.0.0', port=5000, threaded=True)
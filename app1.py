@@ -1,10 +1,13 @@
 from flask import Flask, render_template, Response, jsonify, request
 from camera import Camera
+from job_scheduler import JobScheduler
 # from updater import check_and_update
-import threading
 
 app = Flask(__name__)
 camera = Camera()
+# ضبط‌ها پشت سر هم در یک رشته اجرا می‌شوند، با id و وضعیت قابل پرس‌وجو
+jobs = JobScheduler()
+jobs.start()
 
 @app.route('/')
 def index():
@@ -35,24 +38,37 @@ def capture():
 
 @app.route('/check_transfer/<path:temp_path>')
 def check_transfer(temp_path):
-    """بررسی وضعیت انتقال فایل"""
-    if os.path.exists(temp_path):
-        return jsonify({
-            'status': 'processing',
-            'message': 'Transfer still in progress...'
-        })
-    else:
+    """بررسی وضعیت انتقال فایل (بایت‌های کپی شده از صف انتقال)"""
+    status = camera.transfers.status(temp_path)
+    if status is None:
+        return jsonify({'status': 'error', 'message': 'Unknown transfer'}), 404
+    if status['state'] == 'done':
         return jsonify({
             'status': 'completed',
-            'message': 'File transfer completed successfully'
+            'message': 'File transfer completed successfully',
+            'transfer': status
         })
+    if status['state'] == 'failed':
+        return jsonify({'status': 'error', 'message': status['error'], 'transfer': status})
+    return jsonify({
+        'status': 'processing',
+        'message': f"Transfer still in progress... {status['percent']:.0f}%",
+        'transfer': status
+    })
 
 
 @app.route('/start_recording', methods=['POST'])
 def start_recording():
     duration = int(request.form.get("duration", 60))
-    threading.Thread(target=camera.start_recording, args=(duration,), daemon=True).start()
-    return jsonify({"status": "recording started", "duration": duration})
+    job = jobs.submit("record", lambda job, duration: camera.start_recording(duration), (duration,))
+    return jsonify({"status": "recording started", "duration": duration, "job_id": job["id"]})
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({'status': 'error', 'message': 'Unknown job'}), 404
+    return jsonify(job)
 
 if __name__ == '__main__':
     #check_and_update()
@@ -0,0 +1,469 @@
+#! /usr/bin/env python3
+"""
+asgi_app.py
+حالت سرویس async (ASGI) برای اتصال‌های طولانی: /video_feed و /stream
+
+در سرور توسعه Werkzeug هر بیننده MJPEG یک رشته سیستم‌عامل است که generator آن تا شکست اولین
+write بعد از قطع مرورگر ادامه دارد (در صحنه ثابت با ChangeGate ممکن است هرگز). اینجا:
+    - هر بیننده یک coroutine است؛ یک رشته (HubBridge) نسخه‌های FrameHub را به event loop می‌رساند
+      و همه بیننده‌ها همان part مشترک (یک بار ساخته شده) را می‌فرستند؛ بیننده کند فریم‌ها را جا
+      می‌اندازد و همیشه آخرین فریم را می‌گیرد
+    - پیام http.disconnect همزمان خوانده می‌شود و اشتراک FrameHub/EventBus همان لحظه آزاد می‌شود
+    - /stream و /jobs/stream (SSE) هم coroutine هستند؛ بقیه مسیرها به همان برنامه Flask می‌روند
+      (WsgiBridge در رشته‌های جدا؛ پیش‌نمایش تطبیقی ?adaptive/?tier هنوز رشته‌ای است)
+
+اجرا با سرور production (یک worker، چون دوربین فقط در یک پردازه باز می‌شود):
+    pip install uvicorn
+    uvicorn asgi_app:app --host 0.0.0.0 --port 5000 --workers 1
+یا:
+    python3 asgi_app.py --serve asgi --port 5000
+
+بنچمارک در برابر سرور رشته‌ای (اتصال، CPU و حافظه هر کلاینت، زمان آزاد شدن بعد از قطع):
+    CAMERA_SOURCE=synthetic python3 asgi_app.py --bench
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import asyncio
+from threading import Lock, Thread
+from urllib.parse import parse_qs
+from concurrent.futures import ThreadPoolExecutor
+
+
+async def _wait_disconnect(receive):
+    """تا رسیدن http.disconnect (بدنه درخواست قبلاً خوانده شده یا وجود ندارد)"""
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return
+
+
+async def _until_disconnect(coro, receive):
+    """اجرای coro تا پایان یا قطع کلاینت، هر کدام زودتر؛ دیگری لغو می‌شود"""
+    work = asyncio.ensure_future(coro)
+    watch = asyncio.ensure_future(_wait_disconnect(receive))
+    try:
+        await asyncio.wait({work, watch}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in (work, watch):
+            task.cancel()
+        await asyncio.gather(work, watch, return_exceptions=True)
+
+
+class HubBridge:
+    """یک رشته برای همه بیننده‌ها: نسخه‌های FrameHub را به event loop می‌رساند"""
+
+    def __init__(self, hub):
+        self.hub = hub
+        self.loop = None
+        self.version = 0
+        self.part = None
+        self.published = 0
+        self._future = None
+        self._latest = None
+        self._scheduled = False
+        self._thread = None
+        self._running = False
+
+    def start(self):
+        """از داخل event loop صدا زده می‌شود"""
+        if self._thread is not None:
+            return
+        self.loop = asyncio.get_running_loop()
+        self._future = self.loop.create_future()
+        self._running = True
+        self._thread = Thread(target=self._run, name="hub-bridge", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join(timeout=2)
+            self._thread = None
+
+    def _run(self):
+        version = 0
+        while self._running:
+            item = self.hub.wait_for(version, timeout=1.0)
+            if item is None:
+                continue
+            version, part = item[0], item[3]
+            if part is None:
+                continue  # بیننده‌ای نبود، JPEG ساخته نشده
+            self._latest = (version, part)
+            # اگر loop هنوز نسخه قبلی را برنداشته، فقط آخرین نسخه جایگزین می‌شود
+            if not self._scheduled:
+                self._scheduled = True
+                self.loop.call_soon_threadsafe(self._publish)
+
+    def _publish(self):
+        self._scheduled = False
+        self.version, self.part = self._latest
+        self.published += 1
+        future, self._future = self._future, self.loop.create_future()
+        future.set_result(None)
+
+    async def next(self, version):
+        """:return: (version، part) جدیدتر از version"""
+        while self.version <= version:
+            # shield: لغو یک بیننده future مشترک را لغو نمی‌کند
+            await asyncio.shield(self._future)
+        return self.version, self.part
+
+
+class WsgiBridge:
+    """اجرای برنامه WSGI (Flask) در رشته‌های جدا؛ پاسخ‌های stream شده تکه‌تکه فرستاده می‌شوند"""
+
+    def __init__(self, wsgi_app, workers=32):
+        self.app = wsgi_app
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="wsgi")
+        self.active = 0
+
+    @staticmethod
+    def _environ(scope, body):
+        server = scope.get("server") or ("localhost", 80)
+        client = scope.get("client") or ("", 0)
+        environ = {
+            "REQUEST_METHOD": scope["method"],
+            "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+            "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+            "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+            "SERVER_NAME": str(server[0]),
+            "SERVER_PORT": str(server[1]),
+            "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+            "REMOTE_ADDR": client[0],
+            "REMOTE_PORT": str(client[1]),
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": scope.get("scheme", "http"),
+            "wsgi.input": io.BytesIO(body),
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False,
+        }
+        for name, value in scope.get("headers", []):
+            name = name.decode("latin-1").upper().replace("-", "_")
+            value = value.decode("latin-1")
+            if name in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+                environ[name] = value
+            else:
+                key = f"HTTP_{name}"
+                environ[key] = f"{environ[key]},{value}" if key in environ else value
+        return environ
+
+    async def __call__(self, scope, receive, send):
+        body = bytearray()
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+            body += message.get("body", b"")
+            if not message.get("more_body", False):
+                break
+
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response["status"] = int(status.split(" ", 1)[0])
+            response["headers"] = [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in headers]
+
+        loop = asyncio.get_running_loop()
+        self.active += 1
+        iterable = await loop.run_in_executor(self.executor, self.app, self._environ(scope, bytes(body)),
+                                              start_response)
+        iterator = iter(iterable)
+        # بعد از قطع کلاینت، next در حال اجرا در رشته دیگر تمام نشده؛ close باید منتظر آن بماند
+        lock = Lock()
+
+        def step():
+            with lock:
+                return next(iterator, None)
+
+        def close():
+            with lock:
+                if hasattr(iterable, "close"):
+                    iterable.close()
+
+        try:
+            await _until_disconnect(self._send(loop, step, response, send), receive)
+        finally:
+            self.active -= 1
+            await loop.run_in_executor(self.executor, close)
+
+    async def _send(self, loop, step, response, send):
+        await send({"type": "http.response.start", "status": response["status"],
+                    "headers": response["headers"]})
+        while True:
+            chunk = await loop.run_in_executor(self.executor, step)
+            if chunk is None:
+                break
+            if chunk:
+                await send({"type": "http.response.body", "body": bytes(chunk), "more_body": True})
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+
+class CameraASGI:
+    def __init__(self, wsgi_app, hub, bus, keepalive=15.0):
+        self.wsgi = WsgiBridge(wsgi_app)
+        self.bridge = HubBridge(hub)
+        self.hub = hub
+        self.bus = bus
+        self.keepalive = keepalive
+        self.video_clients = 0
+        self.sse_clients = 0
+        self.released = 0
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+            return
+        if scope["type"] != "http":
+            return
+        path = scope["path"]
+        query = parse_qs(scope.get("query_string", b"").decode("latin-1"))
+        if path == "/video_feed" and not (query.get("adaptive") == ["1"] or query.get("tier")):
+            await self._video_feed(receive, send)
+        elif path in ("/stream", "/jobs/stream"):
+            topics = ["job"] if path == "/jobs/stream" else \
+                [t for t in query.get("topics", [""])[0].split(",") if t] or None
+            await self._sse(topics, receive, send)
+        elif path == "/async_stats":
+            await self._json(send, self.summary())
+        else:
+            await self.wsgi(scope, receive, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                self.bridge.stop()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def _json(self, send, data, status=200):
+        body = json.dumps(data).encode()
+        await send({"type": "http.response.start", "status": status,
+                    "headers": [(b"content-type", b"application/json"),
+                                (b"content-length", str(len(body)).encode())]})
+        await send({"type": "http.response.body", "body": body})
+
+    # -----------------------
+    # MJPEG
+    # -----------------------
+    async def _video_feed(self, receive, send):
+        self.bridge.start()
+        await send({"type": "http.response.start", "status": 200,
+                    "headers": [(b"content-type", b"multipart/x-mixed-replace; boundary=frame"),
+                                (b"cache-control", b"no-cache")]})
+        self.hub.subscribe()
+        self.video_clients += 1
+        try:
+            await _until_disconnect(self._frames(send), receive)
+        finally:
+            self.hub.unsubscribe()
+            self.video_clients -= 1
+            self.released += 1
+
+    async def _frames(self, send):
+        version = 0
+        while True:
+            version, part = await self.bridge.next(version)
+            # send تا خالی شدن بافر سوکت منتظر می‌ماند؛ در این مدت نسخه‌های میانی جا می‌افتند
+            await send({"type": "http.response.body", "body": part, "more_body": True})
+
+    # -----------------------
+    # SSE از event bus
+    # -----------------------
+    async def _sse(self, topics, receive, send):
+        loop = asyncio.get_running_loop()
+        ready = asyncio.Event()
+        subscription = self.bus.subscribe(topics)
+        subscription.on_ready = lambda: loop.call_soon_threadsafe(ready.set)
+        await send({"type": "http.response.start", "status": 200,
+                    "headers": [(b"content-type", b"text/event-stream"), (b"cache-control", b"no-cache"),
+                                (b"x-accel-buffering", b"no")]})
+        self.sse_clients += 1
+        try:
+            await _until_disconnect(self._events(subscription, ready, send), receive)
+        finally:
+            subscription.close()
+            self.sse_clients -= 1
+            self.released += 1
+
+    async def _events(self, subscription, ready, send):
+        await send({"type": "http.response.body", "body": b"retry: 2000\n\n", "more_body": True})
+        while True:
+            # clear قبل از خواندن: رویدادی که بعد از get برسد ready را دوباره set می‌کند
+            ready.clear()
+            events = subscription.get(timeout=0)
+            if events:
+                body = "".join(event[3] for event in events).encode()
+            else:
+                try:
+                    await asyncio.wait_for(ready.wait(), self.keepalive)
+                    continue
+                except asyncio.TimeoutError:
+                    body = b": keep-alive\n\n"
+            await send({"type": "http.response.body", "body": body, "more_body": True})
+
+    def summary(self):
+        return {"video_clients": self.video_clients, "sse_clients": self.sse_clients,
+                "released": self.released, "hub_subscribers": self.hub.subscribers,
+                "frames_published": self.bridge.published, "wsgi_active": self.wsgi.active}
+
+
+def _create_app():
+    from app import app as flask_app
+    from camera import frame_hub, event_bus
+    return CameraASGI(flask_app, frame_hub, event_bus)
+
+
+def __getattr__(name):
+    # «uvicorn asgi_app:app»: دوربین و Flask فقط با درخواست app ساخته می‌شوند، نه با import برای بنچمارک
+    if name == "app":
+        globals()["app"] = _create_app()
+        return globals()["app"]
+    raise AttributeError(name)
+
+
+# -----------------------
+# اجرا و بنچمارک
+# -----------------------
+def serve(kind, host, port):
+    if kind == "asgi":
+        import uvicorn
+        uvicorn.run(_create_app(), host=host, port=port, log_level="warning", workers=1)
+    else:
+        from werkzeug.serving import make_server
+        from app import app as flask_app
+        make_server(host, port, flask_app, threaded=True).serve_forever()
+
+
+def _proc_status(pid):
+    fields = {}
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            key, _, value = line.partition(":")
+            fields[key] = value.split()
+    with open(f"/proc/{pid}/stat") as f:
+        stat = f.read().rsplit(")", 1)[1].split()
+    ticks = os.sysconf("SC_CLK_TCK")
+    return {"rss_kb": int(fields["VmRSS"][0]), "threads": int(fields["Threads"][0]),
+            "cpu_s": (int(stat[11]) + int(stat[12])) / ticks}
+
+
+async def _viewer(host, port, counts, i, stop):
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(f"GET /video_feed HTTP/1.1\r\nHost: {host}\r\n\r\n".encode())
+    await writer.drain()
+    try:
+        while not stop.is_set():
+            chunk = await reader.read(1 << 16)
+            if not chunk:
+                break
+            counts[i] += chunk.count(b"--frame")
+    finally:
+        writer.close()
+
+
+async def _bench_clients(host, port, pid, clients, seconds):
+    counts = [0] * clients
+    stop = asyncio.Event()
+    tasks = [asyncio.ensure_future(_viewer(host, port, counts, i, stop)) for i in range(clients)]
+    await asyncio.sleep(2.0)  # گرم شدن
+    before, frames0 = _proc_status(pid), sum(counts)
+    await asyncio.sleep(seconds)
+    after, frames1 = _proc_status(pid), sum(counts)
+    stop.set()
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    return before, after, frames1 - frames0, sum(1 for n in counts if n)
+
+
+def _released(kind, port, pid, idle):
+    """آیا همه بیننده‌ها آزاد شده‌اند: سرور رشته‌ای با تعداد رشته‌ها، ASGI با /async_stats"""
+    if kind == "threaded":
+        return _proc_status(pid)["threads"] <= idle["threads"]
+    import urllib.request
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}/async_stats", timeout=2) as response:
+        return json.load(response)["video_clients"] == 0
+
+
+def bench(args):
+    import subprocess
+    import socket
+
+    results = []
+    for kind, port in (("threaded", args.port), ("asgi", args.port + 1)):
+        server = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--serve", kind,
+                                   "--port", str(port)], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            for _ in range(200):
+                try:
+                    socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+                    break
+                except OSError:
+                    time.sleep(0.1)
+            # یک دور گرم کردن تا بافرهای encode و رشته‌های ثابت در حالت پایه حساب شوند
+            asyncio.run(_bench_clients("127.0.0.1", port, server.pid, 1, 1.0))
+            time.sleep(1.0)
+            idle = _proc_status(server.pid)
+            for clients in args.clients:
+                before, after, frames, connected = asyncio.run(
+                    _bench_clients("127.0.0.1", port, server.pid, clients, args.seconds))
+                # آزاد شدن منابع بعد از قطع همه کلاینت‌ها
+                t0 = time.monotonic()
+                released = None
+                while time.monotonic() - t0 < 10:
+                    if _released(kind, port, server.pid, idle):
+                        released = time.monotonic() - t0
+                        break
+                    time.sleep(0.05)
+                cpu = (after["cpu_s"] - before["cpu_s"]) / args.seconds
+                results.append({
+                    "server": kind, "clients": clients, "connected": connected,
+                    "fps_per_client": frames / args.seconds / clients,
+                    "cpu_percent": 100 * cpu,
+                    "cpu_ms_per_frame": 1000 * cpu * args.seconds / frames if frames else 0.0,
+                    "kb_per_client": (after["rss_kb"] - idle["rss_kb"]) / clients,
+                    "threads": after["threads"], "released_s": released,
+                })
+                time.sleep(1.0)
+        finally:
+            server.terminate()
+            server.wait()
+
+    print(f"{'server':9s} {'clients':>7s} {'conn':>5s} {'fps/client':>10s} {'cpu%':>6s} {'ms/frame':>8s} "
+          f"{'KB/client':>9s} {'threads':>7s} {'released':>9s}")
+    for r in results:
+        released = f"{r['released_s']:.2f}s" if r["released_s"] is not None else ">10s"
+        print(f"{r['server']:9s} {r['clients']:7d} {r['connected']:5d} {r['fps_per_client']:10.1f} "
+              f"{r['cpu_percent']:6.1f} {r['cpu_ms_per_frame']:8.2f} {r['kb_per_client']:9.0f} "
+              f"{r['threads']:7d} {released:>9s}")
+    print(f"(clients run on the same machine; {os.cpu_count()} core(s))")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Async MJPEG/SSE serving and benchmark against the threaded server")
+    parser.add_argument("--serve", choices=("asgi", "threaded"), help="اجرای سرور")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--bench", action="store_true")
+    parser.add_argument("--clients", type=lambda s: [int(n) for n in s.split(",")], default=[25, 100])
+    parser.add_argument("--seconds", type=float, default=8.0)
+    args = parser.parse_args()
+
+    if args.bench:
+        if args.port == 5000:
+            args.port = 5080
+        bench(args)
+    else:
+        serve(args.serve or "asgi", args.host, args.port)
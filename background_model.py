@@ -0,0 +1,225 @@
+#! /usr/bin/env python3
+"""
+background_model.py
+مدل پس‌زمینه برای صحنه‌های ثابت (کووت/لام): به جای آستانه‌گذاری کل فریم با Otsu در هر فریم،
+پس‌زمینه تخمین زده و کم می‌شود و آستانه ثابت از روی نویز باقیمانده به دست می‌آید
+
+روش‌ها:
+    median   میانه تقریبی افزایشی (هر پیکسل یک گام به سمت مقدار جدید)، مقاوم به ذرات عبوری
+    ema      میانگین متحرک نمایی (cv2.accumulateWeighted)
+    mog2     cv2.createBackgroundSubtractorMOG2 و تصویر پس‌زمینه آن
+
+به‌روزرسانی فقط روی نسخه کوچک شده فریم و هر every فریم یک بار انجام می‌شود؛
+مدل در فایل npz ذخیره می‌شود تا بعد از راه‌اندازی مجدد گرم کردن لازم نباشد
+با ParticleDetector(background=...) استفاده می‌شود (رابط apply(gray) -> تصویر اختلاف)
+"""
+
+import os
+import time
+import cv2
+import numpy as np
+from buffer_pool import BufferPool
+
+METHODS = ("median", "ema", "mog2")
+
+
+class BackgroundModel:
+    def __init__(self, method="median", scale=0.25, every=10, alpha=0.02, step=1.0,
+                 polarity="bright", k=5.0, min_threshold=8, path=None, save_interval=60.0):
+        """
+        :param scale: ضریب کوچک کردن فریم برای مدل
+        :param every: به‌روزرسانی مدل هر every فریم یک بار
+        :param alpha: نرخ یادگیری ema و mog2
+        :param step: گام میانه افزایشی (سطح خاکستری در هر به‌روزرسانی)
+        :param polarity: 'bright'، 'dark' یا 'both' (قدر مطلق اختلاف)
+        :param k: آستانه پیشنهادی = k × انحراف معیار نویز باقیمانده
+        :param path: فایل npz برای ذخیره/بارگذاری مدل (None یعنی بدون ذخیره)
+        """
+        if method not in METHODS:
+            raise ValueError(f"Unknown background method: {method}")
+        self.method = method
+        self.scale = scale
+        self.every = max(1, int(every))
+        self.alpha = alpha
+        self.step = step
+        self.polarity = polarity
+        self.k = k
+        self.min_threshold = min_threshold
+        self.path = path
+        self.save_interval = save_interval
+
+        self._pool = BufferPool()
+        self._model = None       # float32 در اندازه کوچک
+        self._mog = None
+        self._full = None        # پس‌زمینه uint8 در اندازه کامل، فقط بعد از هر به‌روزرسانی ساخته می‌شود
+        self._last_save = time.monotonic()
+        self.threshold = None
+        self.noise = None
+
+        self.frames = 0
+        self.updates = 0
+        self.busy = 0.0
+        self.loaded = False
+        if path and os.path.exists(path):
+            self.load(path)
+
+    @property
+    def ready(self):
+        return self._model is not None
+
+    def _small(self, gray):
+        h, w = gray.shape[:2]
+        size = (max(1, int(w * self.scale)), max(1, int(h * self.scale)))
+        return cv2.resize(gray, size, dst=self._pool.get("small", (size[1], size[0])),
+                          interpolation=cv2.INTER_AREA)
+
+    def update(self, gray):
+        """به‌روزرسانی مدل با یک فریم (معمولاً از apply فراخوانی می‌شود)"""
+        small = self._small(gray)
+        if self._model is None or self._model.shape != small.shape:
+            self._model = small.astype(np.float32)
+            self._mog = None
+        elif self.method == "ema":
+            cv2.accumulateWeighted(small, self._model, self.alpha)
+        elif self.method == "median":
+            diff = self._pool.get("step", small.shape, np.float32)
+            np.subtract(small, self._model, out=diff, dtype=np.float32)
+            np.sign(diff, out=diff)
+            diff *= self.step
+            self._model += diff
+
+        if self.method == "mog2":
+            if self._mog is None:
+                self._mog = cv2.createBackgroundSubtractorMOG2(history=int(1 / self.alpha), detectShadows=False)
+            self._mog.apply(small, learningRate=self.alpha)
+            image = self._mog.getBackgroundImage()
+            if image is not None:
+                self._model[:] = image
+
+        # آستانه پیشنهادی از روی MAD باقیمانده (ذرات در میانه تأثیری ندارند)
+        residual = np.abs(small.astype(np.float32) - self._model)
+        self.noise = 1.4826 * float(np.median(residual))
+        self.threshold = max(self.min_threshold, int(round(self.k * self.noise)))
+
+        h, w = gray.shape[:2]
+        model8 = np.clip(self._model, 0, 255, out=self._pool.get("clip", self._model.shape, np.float32))
+        model8 = model8.astype(np.uint8)
+        self._full = cv2.resize(model8, (w, h), dst=self._pool.get("full", (h, w)),
+                                interpolation=cv2.INTER_LINEAR)
+        self.updates += 1
+
+    def apply(self, gray):
+        """تصویر اختلاف فریم با پس‌زمینه (uint8، اندازه کامل)"""
+        t0 = time.perf_counter()
+        if self._full is None or self._full.shape != gray.shape[:2] or self.frames % self.every == 0:
+            self.update(gray)
+        self.frames += 1
+
+        diff = self._pool.get("diff", gray.shape[:2])
+        if self.polarity == "dark":
+            cv2.subtract(self._full, gray, dst=diff)
+        elif self.polarity == "both":
+            cv2.absdiff(gray, self._full, dst=diff)
+        else:
+            cv2.subtract(gray, self._full, dst=diff)
+
+        if self.path and time.monotonic() - self._last_save > self.save_interval:
+            self.save()
+        self.busy += time.perf_counter() - t0
+        return diff
+
+    @property
+    def background(self):
+        """پس‌زمینه فعلی در اندازه کامل (uint8) یا None"""
+        return self._full
+
+    # -----------------------
+    # ذخیره و بارگذاری
+    # -----------------------
+    def save(self, path=None):
+        path = path or self.path
+        self._last_save = time.monotonic()
+        if not path or self._model is None:
+            return None
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp = path + ".tmp.npz"
+        try:
+            np.savez(tmp, method=self.method, scale=self.scale, model=self._model,
+                     threshold=self.threshold or 0, noise=self.noise or 0.0)
+            os.replace(tmp, path)
+        except OSError as e:
+            print(f"[Background Save Error]: {e}")
+            return None
+        return path
+
+    def load(self, path=None):
+        """بارگذاری مدل ذخیره شده؛ اگر روش یا مقیاس فرق کند نادیده گرفته می‌شود"""
+        path = path or self.path
+        try:
+            with np.load(path) as data:
+                if str(data["method"]) != self.method or float(data["scale"]) != self.scale:
+                    print(f"[Background] {path} was saved with different settings, ignoring")
+                    return False
+                self._model = data["model"].astype(np.float32)
+                self.threshold = int(data["threshold"]) or None
+                self.noise = float(data["noise"]) or None
+        except (OSError, KeyError, ValueError) as e:
+            print(f"[Background Load Error]: {e}")
+            return False
+        if self.method == "mog2":
+            # MOG2 قابل ذخیره نیست؛ با تصویر ذخیره شده گرم می‌شود
+            self._mog = cv2.createBackgroundSubtractorMOG2(history=int(1 / self.alpha), detectShadows=False)
+            seed = np.clip(self._model, 0, 255).astype(np.uint8)
+            self._mog.apply(seed, learningRate=1.0)
+            for _ in range(4):
+                self._mog.apply(seed, learningRate=self.alpha)
+        self._full = None
+        self.loaded = True
+        return True
+
+    def summary(self):
+        return {
+            "method": self.method,
+            "frames": self.frames,
+            "updates": self.updates,
+            "threshold": self.threshold,
+            "noise": self.noise,
+            "loaded": self.loaded,
+            "ms_per_frame": 1000 * self.busy / self.frames if self.frames else 0.0,
+        }
+
+
+if __name__ == "__main__":
+    # بنچمارک: هزینه هر فریم مدل و اثر آن روی fps تشخیص، با نورپردازی ناهموار ثابت (vignetting)
+    import argparse
+    from frame_source import create_source
+    from particle_detector import ParticleDetector, to_gray
+
+    parser = argparse.ArgumentParser(description="Background model benchmark")
+    parser.add_argument("--frames", type=int, default=300)
+    parser.add_argument("--every", type=int, default=10)
+    parser.add_argument("--scale", type=float, default=0.25)
+    args = parser.parse_args()
+
+    source = create_source("synthetic", realtime=False)
+    w, h = source.sizes["lores"]
+    yy, xx = np.mgrid[0:h, 0:w]
+    vignette = (90 * (1 - ((xx - w / 2) ** 2 + (yy - h / 2) ** 2) / ((w / 2) ** 2 + (h / 2) ** 2))).astype(np.uint8)
+    frames = [cv2.add(to_gray(source.capture_array("lores"), "YUV420"), vignette)
+              for _ in range(min(args.frames, 60))]
+
+    def run(detector):
+        counts = []
+        t0 = time.perf_counter()
+        for i in range(args.frames):
+            counts.append(len(detector.detect(frames[i % len(frames)], i)))
+        return args.frames / (time.perf_counter() - t0), np.mean(counts[len(frames):] or counts)
+
+    fps, count = run(ParticleDetector())
+    print(f"{'otsu (no model)':16s} detect={fps:6.1f} fps  particles/frame={count:6.1f}  (rendered {len(source.positions)})")
+    for method in METHODS:
+        model = BackgroundModel(method, scale=args.scale, every=args.every)
+        fps, count = run(ParticleDetector(background=model))
+        s = model.summary()
+        print(f"{method:16s} detect={fps:6.1f} fps  particles/frame={count:6.1f}  "
+              f"model={s['ms_per_frame']:.2f} ms/frame  threshold={s['threshold']}")
@@ -0,0 +1,437 @@
+#! /usr/bin/env python3
+"""
+batch_analysis.py
+تحلیل آفلاین فایل‌های ضبط شده (static/videos، raspberry_camera_temp یا فلش) روی همه هسته‌ها
+
+    python batch_analysis.py static/videos /media/pi/USB/videos "clips/*.mp4" -o results
+
+کار به واحدهای مستقل تقسیم می‌شود: هر فایل، و برای ویدئوهای طولانی هر بازه فریم (chunk)
+هر واحد در یک پردازه جدا تشخیص و ردیابی را اجرا می‌کند و نتیجه‌اش را بلافاصله در یک فایل part
+می‌نویسد؛ در اجرای دوباره partهای موجود رد می‌شوند، پس وقفه فقط کار نیمه‌تمام را هدر می‌دهد
+بازه‌های پشت سر هم یک فریم مشترک دارند که برای به هم دوختن trackها استفاده می‌شود
+"""
+
+import os
+import re
+import glob
+import time
+import hashlib
+import multiprocessing
+import cv2
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from particle_detector import ParticleDetector, DETECTION_DTYPE
+from particle_tracker import ParticleTracker, TRACK_DTYPE, summarize_tracks
+from raw_capture import open_stack
+from roi import TiledDetector
+
+VIDEO_EXTENSIONS = (".mp4", ".avi", ".mkv", ".h264")
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".tif", ".tiff")
+# stack خام raw_capture؛ فایل .timestamps.npy کنار آن ورودی جدا نیست
+STACK_EXTENSIONS = (".npy",)
+
+# اندازه هر بازه فریم برای ویدئوهای طولانی (حدود 30 ثانیه در 30fps)
+CHUNK_FRAMES = 900
+# تعداد عکس در هر واحد کار
+IMAGE_BATCH = 64
+
+# فاصله شناسه track بین بازه‌ها تا قبل از دوختن تداخل نداشته باشند
+_ID_SPAN = 10 ** 9
+
+# نام فایل‌های ضبط: <sampleId>_<YYYYmmdd>_<HHMMSS> (یا video_/image_ بدون sampleId)
+_SAMPLE_NAME = re.compile(r"^(.+?)_\d{8}[-_]\d{6}$")
+# پسوند hash مسیر که _clip_name به نام clip اضافه می‌کند
+_CLIP_HASH = re.compile(r"-[0-9a-f]{8}$")
+
+
+def collect_inputs(patterns):
+    """فایل‌های ویدئو و عکس از فهرست پوشه‌ها، فایل‌ها یا globها"""
+    found = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            for root, _, files in os.walk(pattern):
+                found.extend(os.path.join(root, f) for f in files)
+        else:
+            found.extend(glob.glob(pattern))
+    media = [f for f in found if f.lower().endswith(VIDEO_EXTENSIONS + IMAGE_EXTENSIONS + STACK_EXTENSIONS)
+             and not f.endswith(".timestamps.npy")]
+    return sorted(set(os.path.abspath(f) for f in media))
+
+
+def _clip_name(path, stem=None):
+    """
+    کلید یکتای clip: نام فایل + hash کوتاه مسیر کامل
+    دو فایل هم‌نام در پوشه‌های مختلف (مثلاً static/videos و فلش) partهای هم را بازنویسی نمی‌کنند
+    """
+    path = os.path.abspath(path)
+    if stem is None:
+        stem = os.path.splitext(os.path.basename(path))[0]
+    return f"{stem}-{hashlib.sha1(path.encode()).hexdigest()[:8]}"
+
+
+def plan_jobs(files, chunk_frames=CHUNK_FRAMES, image_batch=IMAGE_BATCH):
+    """
+    تقسیم کار: ویدئوها به بازه‌های [start, stop] (فریم stop با بازه بعد مشترک است)،
+    عکس‌های هر پوشه به دسته‌های image_batch تایی
+    :return: فهرست dict با کلیدهای clip، kind، path(s)، start، stop، frames
+    """
+    jobs = []
+    images = {}
+    for path in files:
+        if path.lower().endswith(IMAGE_EXTENSIONS):
+            images.setdefault(os.path.dirname(path), []).append(path)
+            continue
+        kind = "stack" if path.lower().endswith(STACK_EXTENSIONS) else "video"
+        if kind == "stack":
+            try:
+                total = len(open_stack(path)[0])   # بدون خواندن داده
+            except (OSError, ValueError) as e:
+                print(f"[Batch] skipping unreadable stack: {path}: {e}")
+                continue
+        else:
+            cap = cv2.VideoCapture(path)
+            total = int(cap.get(cv2.CAP_PROP_FRAME_COUNT)) if cap.isOpened() else 0
+            cap.release()
+        if total <= 0:
+            print(f"[Batch] skipping unreadable {kind}: {path}")
+            continue
+        for index, start in enumerate(range(0, total, chunk_frames)):
+            stop = min(start + chunk_frames, total - 1)
+            jobs.append({"clip": _clip_name(path), "kind": kind, "path": path, "chunk_frames": chunk_frames,
+                         "chunk": index, "start": start, "stop": stop, "frames": stop - start + 1})
+
+    for folder, paths in sorted(images.items()):
+        clip = _clip_name(folder, os.path.basename(folder) or "images")
+        for index, start in enumerate(range(0, len(paths), image_batch)):
+            batch = paths[start:start + image_batch]
+            jobs.append({"clip": clip, "kind": "images", "paths": batch, "chunk_frames": image_batch,
+                         "chunk": index, "start": start, "stop": start + len(batch) - 1, "frames": len(batch)})
+
+    # طولانی‌ترین کارها اول تا آخر اجرا پردازه‌ای بیکار نماند
+    jobs.sort(key=lambda job: -job["frames"])
+    return jobs
+
+
+def part_path(out_dir, job):
+    return os.path.join(out_dir, job["clip"], f"part-{job['chunk']:05d}.npz")
+
+
+def invalidate_parts(out_dir, clip, chunk_frames):
+    """
+    حذف partهایی که با اندازه بازه دیگری ساخته شده‌اند (یا اندازه‌شان ثبت نشده)
+    مرز بازه‌ها با chunk_frames عوض می‌شود، پس ادغام آن‌ها با partهای جدید نتیجه غلط می‌دهد
+    :return: تعداد part حذف شده
+    """
+    folder = os.path.join(out_dir, clip)
+    if not os.path.isdir(folder):
+        return 0
+    removed = 0
+    for name in os.listdir(folder):
+        if not (name.startswith("part-") and name.endswith(".npz")) or name.endswith(".tmp.npz"):
+            continue
+        path = os.path.join(folder, name)
+        try:
+            with np.load(path) as data:
+                valid = "chunk_frames" in data.files and int(data["chunk_frames"]) == chunk_frames
+        except (OSError, ValueError):
+            valid = False
+        if not valid:
+            os.remove(path)
+            removed += 1
+    if removed:
+        # نتیجه ادغام شده قبلی هم از همان partها ساخته شده بود
+        merged = os.path.join(out_dir, f"{clip}.npz")
+        if os.path.exists(merged):
+            os.remove(merged)
+    return removed
+
+
+def process_pool(workers):
+    """
+    ProcessPoolExecutor با forkserver (یا spawn)، نه fork پیش‌فرض: این pool داخل پردازه Flask/دوربین با
+    رشته‌های capture، encoder و OpenCV ساخته می‌شود و fork وقتی رشته دیگری قفلی در دست دارد
+    فرزند را برای همیشه قفل می‌کند
+    """
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+    if context.get_start_method() == "forkserver":
+        # ماژول‌های سنگین (cv2، numpy) یک بار در forkserver بارگذاری می‌شوند نه در هر worker
+        context.set_forkserver_preload(["batch_analysis"])
+    return ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, mp_context=context)
+
+
+def _init_worker():
+    # هر پردازه یک هسته؛ رشته‌های داخلی OpenCV باعث رقابت بین پردازه‌ها می‌شوند
+    cv2.setNumThreads(1)
+
+
+def make_detector(detector_kwargs=None):
+    """
+    ParticleDetector، یا TiledDetector وقتی detector_kwargs کلید tile (اندازه کاشی) دارد؛
+    tile_threads تعداد رشته‌های کاشی در هر پردازه است
+    """
+    kwargs = dict(detector_kwargs or {})
+    tile = kwargs.pop("tile", None)
+    threads = kwargs.pop("tile_threads", 1)
+    if not tile:
+        return ParticleDetector(**kwargs)
+    return TiledDetector((tile, tile), overlap=64, workers=threads, factory=lambda index: ParticleDetector(**kwargs))
+
+
+def run_job(job, out_dir, detector_kwargs=None, tracker_kwargs=None):
+    """
+    اجرای یک واحد کار در پردازه worker و نوشتن اتمیک نتیجه
+    :return: (job، تعداد فریم، تعداد تشخیص، ثانیه)
+    """
+    t0 = time.perf_counter()
+    detector = make_detector(detector_kwargs)
+    chunks = []
+
+    if job["kind"] == "video":
+        tracker = ParticleTracker(**(tracker_kwargs or {}))
+        cap = cv2.VideoCapture(job["path"])
+        if not cap.isOpened():
+            raise RuntimeError(f"Cannot open video: {job['path']}")
+        try:
+            fps = cap.get(cv2.CAP_PROP_FPS) or 30.0
+            if job["start"]:
+                cap.set(cv2.CAP_PROP_POS_FRAMES, job["start"])
+            frame = None
+            for index in range(job["start"], job["stop"] + 1):
+                ret, frame = cap.read(frame)
+                if not ret:
+                    break
+                detections = detector.detect(frame, index, int(index / fps * 1e9))
+                tracker.update(detections, index)
+        finally:
+            cap.release()
+        tracks = tracker.trajectories()
+        tracks["track_id"] += job["chunk"] * _ID_SPAN
+        detections = tracks
+        frames = tracker.frames
+    elif job["kind"] == "stack":
+        # هر worker فقط بازه خودش را از memmap می‌خواند؛ بدون decode و با زمان واقعی سنسور
+        tracker = ParticleTracker(**(tracker_kwargs or {}))
+        stack, timestamps, meta = open_stack(job["path"])
+        fmt = meta.get("format") if meta.get("plane") == "native" else None
+        for index in range(job["start"], job["stop"] + 1):
+            detections = detector.detect(stack[index], index, int(timestamps[index]), fmt=fmt)
+            tracker.update(detections, index)
+        del stack
+        tracks = tracker.trajectories()
+        tracks["track_id"] += job["chunk"] * _ID_SPAN
+        detections = tracks
+        frames = tracker.frames
+    else:
+        for index, path in enumerate(job["paths"], start=job["start"]):
+            frame = cv2.imread(path)
+            if frame is None:
+                print(f"[Batch] unreadable image: {path}")
+                continue
+            mtime = int(os.path.getmtime(path) * 1e9)
+            chunks.append(detector.detect(frame, index, mtime))
+        detections = np.concatenate(chunks) if chunks else np.empty(0, dtype=DETECTION_DTYPE)
+        frames = len(chunks)
+
+    if isinstance(detector, TiledDetector):
+        detector.close()
+
+    target = part_path(out_dir, job)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    tmp = target + ".tmp.npz"
+    np.savez_compressed(tmp, rows=detections, start=job["start"], stop=job["stop"], chunk_frames=job["chunk_frames"],
+                        source=job.get("path") or os.path.dirname(job["paths"][0]))
+    os.replace(tmp, target)
+    return job, frames, len(detections), time.perf_counter() - t0
+
+
+def stitch_tracks(parts):
+    """
+    دوختن trackهای بازه‌های پشت سر هم با فریم مشترک: تشخیص‌های فریم مرزی در هر دو بازه یکسان‌اند،
+    پس با مرتب کردن بر اساس مختصات جفت می‌شوند و شناسه بازه بعد با شناسه بازه قبل جایگزین می‌شود
+    :param parts: فهرست (start, stop, rows) مرتب بر اساس start
+    """
+    merged = []
+    previous = None
+    for start, stop, rows in parts:
+        if previous is not None and previous[0] == start and len(rows):
+            shared = rows["frame"] == start
+            a = previous[1][previous[1]["frame"] == start]
+            b = rows[shared]
+            if len(a) == len(b) and len(a):
+                a = a[np.lexsort((a["y"], a["x"]))]
+                b = b[np.lexsort((b["y"], b["x"]))]
+                # شناسه‌های b در یک فریم یکتا هستند
+                order = np.argsort(b["track_id"])
+                keys = b["track_id"][order]
+                values = a["track_id"][order]
+                pos = np.minimum(np.searchsorted(keys, rows["track_id"]), len(keys) - 1)
+                hit = keys[pos] == rows["track_id"]
+                rows = rows.copy()
+                rows["track_id"][hit] = values[pos[hit]]
+            else:
+                print(f"[Batch] frame {start}: chunk boundary detections differ, tracks not stitched")
+            # فریم مشترک فقط یک بار نگه داشته می‌شود
+            rows = rows[~shared]
+        merged.append(rows)
+        previous = (stop, rows)
+    if not merged:
+        return np.empty(0, dtype=TRACK_DTYPE)
+    rows = np.concatenate(merged)
+    return rows[np.lexsort((rows["frame"], rows["track_id"]))]
+
+
+def sample_from_clip(clip):
+    """sampleId از روی نام فایل ضبط شده؛ 'unknown' برای فایل‌های بدون sampleId"""
+    match = _SAMPLE_NAME.match(_CLIP_HASH.sub("", clip))
+    if not match or match.group(1) in ("video", "image", "raw"):
+        return "unknown"
+    return match.group(1)
+
+
+def merge_clip(out_dir, clip, store=None, sample_id=None):
+    """
+    ادغام partهای یک clip در <clip>.npz (نقاط + آمار مسیرها)
+    :param store: ResultsStore اختیاری برای افزودن نتایج به جدول‌های detections/tracks
+    """
+    folder = os.path.join(out_dir, clip)
+    parts = []
+    kind = "video"
+    for name in sorted(os.listdir(folder)):
+        if not (name.startswith("part-") and name.endswith(".npz")) or name.endswith(".tmp.npz"):
+            continue
+        with np.load(os.path.join(folder, name)) as data:
+            rows = data["rows"]
+            parts.append((int(data["start"]), int(data["stop"]), rows))
+        if rows.dtype.names and "track_id" not in rows.dtype.names:
+            kind = "images"
+    parts.sort(key=lambda p: p[0])
+
+    if kind == "video":
+        rows = stitch_tracks(parts)
+        summary = summarize_tracks(rows)
+    else:
+        rows = np.concatenate([p[2] for p in parts]) if parts else np.empty(0, dtype=DETECTION_DTYPE)
+        summary = None
+    target = os.path.join(out_dir, f"{clip}.npz")
+    tmp = target + ".tmp.npz"
+    if summary is None:
+        np.savez_compressed(tmp, rows=rows)
+    else:
+        np.savez_compressed(tmp, rows=rows, tracks=summary)
+    os.replace(tmp, target)
+    if store is not None:
+        key = (sample_id or sample_from_clip(clip), clip)
+        # جدول detections به ترتیب زمان نوشته می‌شود (خواندن بازه زمانی با searchsorted)
+        store.append("detections", rows[np.argsort(rows["timestamp"], kind="stable")], *key)
+        if summary is not None:
+            store.append("tracks", summary, *key)
+        store.flush()
+        store.compact("detections", *key)
+    return target, len(rows), (len(summary) if summary is not None else None)
+
+
+def analyse(patterns, out_dir, workers=None, chunk_frames=CHUNK_FRAMES,
+            detector_kwargs=None, tracker_kwargs=None, resume=True, store=None, sample_id=None, progress=None):
+    """
+    اجرای کامل: برنامه‌ریزی، اجرای موازی، ادغام clipهای کامل شده
+    :param progress: progress(fraction, message) بعد از هر chunk (مثلاً Job.update)
+    :return: خلاصه (تعداد فریم، زمان، fps کل)
+    """
+    workers = workers or os.cpu_count() or 1
+    jobs = plan_jobs(collect_inputs(patterns), chunk_frames)
+    if resume:
+        for clip, size in sorted({(job["clip"], job["chunk_frames"]) for job in jobs}):
+            removed = invalidate_parts(out_dir, clip, size)
+            if removed:
+                print(f"[Batch] {clip}: {removed} parts from a different chunk size discarded")
+    pending = [job for job in jobs if not (resume and os.path.exists(part_path(out_dir, job)))]
+    remaining = {}
+    for job in pending:
+        remaining[job["clip"]] = remaining.get(job["clip"], 0) + 1
+    print(f"[Batch] {len(jobs)} jobs, {len(jobs) - len(pending)} already done, {workers} workers")
+
+    frames = 0
+    t0 = time.perf_counter()
+    with process_pool(workers) as pool:
+        futures = [pool.submit(run_job, job, out_dir, detector_kwargs, tracker_kwargs) for job in pending]
+        for done, future in enumerate(as_completed(futures), 1):
+            try:
+                job, n, rows, seconds = future.result()
+            except Exception as e:
+                print(f"[Batch Error]: {e}")
+                continue
+            frames += n
+            print(f"[Batch] {job['clip']} chunk {job['chunk']}: {n} frames, {rows} rows, {n / seconds:.1f} fps")
+            if progress is not None:
+                progress(done / len(futures), f"{job['clip']} chunk {job['chunk']}")
+            remaining[job["clip"]] -= 1
+            if remaining[job["clip"]] == 0:
+                target, count, tracks = merge_clip(out_dir, job["clip"], store, sample_id)
+                print(f"[Batch] merged {target}: {count} rows" + (f", {tracks} tracks" if tracks is not None else ""))
+
+    # clipهایی که همه partهایشان از اجرای قبلی موجود بود
+    for clip in sorted({job["clip"] for job in jobs} - set(remaining)):
+        if not os.path.exists(os.path.join(out_dir, f"{clip}.npz")):
+            merge_clip(out_dir, clip, store, sample_id)
+
+    elapsed = time.perf_counter() - t0
+    return {"jobs": len(pending), "frames": frames, "seconds": elapsed,
+            "fps": frames / elapsed if elapsed else 0.0, "workers": workers}
+
+
+if __name__ == "__main__":
+    import argparse
+    import shutil
+    import tempfile
+
+    parser = argparse.ArgumentParser(description="Offline particle detection and tracking over recorded clips")
+    parser.add_argument("inputs", nargs="+", help="پوشه، فایل یا glob (.mp4/.jpg/.npy)")
+    parser.add_argument("-o", "--out", default="analysis_results")
+    parser.add_argument("-j", "--workers", type=int, default=None, help="پیش‌فرض: همه هسته‌ها")
+    parser.add_argument("--chunk-frames", type=int, default=CHUNK_FRAMES)
+    parser.add_argument("--threshold", type=int, default=None)
+    parser.add_argument("--min-area", type=int, default=3)
+    parser.add_argument("--tiled", type=int, default=None, metavar="TILE",
+                        help="تشخیص کاشی‌ای با کاشی‌های TILE پیکسلی (برای ویدئو و stack های 4K)")
+    parser.add_argument("--gate", type=float, default=20.0)
+    parser.add_argument("--no-resume", action="store_true", help="partهای موجود دوباره محاسبه شوند")
+    parser.add_argument("--store", help="پوشه ResultsStore برای ذخیره ستونی نتایج")
+    parser.add_argument("--sample", help="sampleId (پیش‌فرض: از نام فایل)")
+    parser.add_argument("--scaling", action="store_true",
+                        help="اندازه‌گیری مقیاس‌پذیری با 1، 2، 4، ... worker (خروجی در پوشه موقت)")
+    args = parser.parse_args()
+
+    detector_kwargs = {"threshold": args.threshold, "min_area": args.min_area}
+    if args.tiled:
+        # هسته‌هایی که پردازه‌ها پر نکرده‌اند بین کاشی‌های هر پردازه تقسیم می‌شوند
+        detector_kwargs.update(tile=args.tiled,
+                               tile_threads=max(1, (os.cpu_count() or 1) // (args.workers or os.cpu_count() or 1)))
+    tracker_kwargs = {"gate": args.gate}
+
+    if args.scaling:
+        counts = []
+        n = 1
+        while n < (args.workers or os.cpu_count() or 1):
+            counts.append(n)
+            n *= 2
+        counts.append(args.workers or os.cpu_count() or 1)
+        base = None
+        for n in counts:
+            scratch = tempfile.mkdtemp()
+            try:
+                result = analyse(args.inputs, scratch, n, args.chunk_frames, detector_kwargs, tracker_kwargs)
+            finally:
+                shutil.rmtree(scratch, ignore_errors=True)
+            base = base or result["fps"]
+            print(f"workers={n:3d}: {result['fps']:8.1f} fps  speedup={result['fps'] / base:5.2f}x")
+    else:
+        store = None
+        if args.store:
+            from results_store import ResultsStore
+            store = ResultsStore(args.store)
+        result = analyse(args.inputs, args.out, args.workers, args.chunk_frames,
+                         detector_kwargs, tracker_kwargs, resume=not args.no_resume,
+                         store=store, sample_id=args.sample)
+        print(f"[Batch] done: {result['frames']} frames in {result['seconds']:.1f}s "
+              f"({result['fps']:.1f} fps, {result['workers']} workers)")
@@ -0,0 +1,167 @@
+#! /usr/bin/env python3
+"""
+buffer_pool.py
+بافرهای numpy ثابت که در هر فریم دوباره استفاده می‌شوند (به جای تخصیص حدود 25MB در هر فریم 4K)
+برای خروجی capture و cvtColor(dst=...) در مسیر پیش‌نمایش و ضبط
+"""
+
+import numpy as np
+from threading import Lock
+
+
+class BufferPool:
+    """بافر ثابت برای هر نقش (key)؛ فقط وقتی اندازه یا نوع عوض شود دوباره تخصیص داده می‌شود"""
+
+    def __init__(self):
+        self._buffers = {}
+        self._lock = Lock()
+        self.allocations = 0
+        self.reuses = 0
+        self.bytes_allocated = 0
+
+    def get(self, key, shape, dtype=np.uint8):
+        shape = tuple(shape)
+        dtype = np.dtype(dtype)
+        with self._lock:
+            buf = self._buffers.get(key)
+            if buf is None or buf.shape != shape or buf.dtype != dtype:
+                buf = self._buffers[key] = np.empty(shape, dtype)
+                self.allocations += 1
+                self.bytes_allocated += buf.nbytes
+            else:
+                self.reuses += 1
+            return buf
+
+    def rotating(self, key, count=3):
+        return RotatingBuffers(self, key, count)
+
+    def summary(self):
+        with self._lock:
+            return {
+                "buffers": len(self._buffers),
+                "allocations": self.allocations,
+                "reuses": self.reuses,
+                "resident_bytes": sum(b.nbytes for b in self._buffers.values()),
+            }
+
+
+class RotatingBuffers:
+    """
+    چند بافر به نوبت، برای الگوی «منتشر کن و بعداً دوباره استفاده کن»
+    مصرف‌کننده‌ای که فریم منتشر شده را نگه می‌دارد hold/release می‌کند؛ next هرگز بافر نگه داشته شده را
+    برنمی‌گرداند و اگر همه گرفته باشند یک بافر تازه اضافه می‌کند (حداکثر یکی به ازای هر مصرف‌کننده کند)
+    """
+
+    def __init__(self, pool, key, count=3):
+        self.pool = pool
+        self.key = key
+        self.count = count
+        self.grown = 0
+        self._index = -1
+        self._lock = Lock()
+        self._slots = {}    # index -> آخرین آرایه برگردانده شده
+        self._holds = {}    # index -> تعداد نگه‌دارنده
+
+    def next(self, shape, dtype=np.uint8):
+        with self._lock:
+            for step in range(1, self.count + 1):
+                index = (self._index + step) % self.count
+                if not self._holds.get(index):
+                    break
+            else:
+                index = self.count
+                self.count += 1
+                self.grown += 1
+            self._index = index
+            buf = self._slots[index] = self.pool.get((self.key, index), shape, dtype)
+            return buf
+
+    def reuse(self):
+        """next بعدی همین بافر را برمی‌گرداند (بافر آخر منتشر نشد و هنوز آزاد است)"""
+        with self._lock:
+            self._index = (self._index - 1) % self.count
+
+    def _find(self, buf):
+        for index, slot in self._slots.items():
+            if slot is buf:
+                return index
+        return None
+
+    def hold(self, buf):
+        """بافر تا release بازنویسی نمی‌شود؛ آرایه‌ای که از این مجموعه نیست نادیده گرفته می‌شود"""
+        with self._lock:
+            index = self._find(buf)
+            if index is not None:
+                self._holds[index] = self._holds.get(index, 0) + 1
+
+    def release(self, buf):
+        with self._lock:
+            index = self._find(buf)
+            if index is not None and self._holds.get(index):
+                self._holds[index] -= 1
+
+    def held(self):
+        with self._lock:
+            return sum(1 for n in self._holds.values() if n)
+
+
+if __name__ == "__main__":
+    # بنچمارک حافظه: RSS پایدار و حجم تخصیص در هر فریم، قبل و بعد از استفاده از pool
+    import argparse
+    import gc
+    import time
+    import tracemalloc
+    import cv2
+    from frame_source import create_source
+
+    parser = argparse.ArgumentParser(description="Per-frame allocation benchmark")
+    parser.add_argument("--stream", default="main", choices=["main", "lores"])
+    parser.add_argument("--frames", type=int, default=60)
+    parser.add_argument("--mode", default="both", choices=["before", "after", "both"],
+                        help="برای RSS دقیق هر حالت را در یک پردازه جدا اجرا کنید")
+    args = parser.parse_args()
+
+    def rss_mb():
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * 4096 / 2**20
+
+    source = create_source("synthetic", realtime=False)
+    fmt = source.formats[args.stream]
+    code = cv2.COLOR_RGBA2BGR if fmt == "XBGR8888" else cv2.COLOR_YUV420p2RGB
+
+    def before():
+        frame = source.capture_array(args.stream)
+        frame = cv2.cvtColor(frame, code)
+        ret, buffer = cv2.imencode('.jpg', frame, [int(cv2.IMWRITE_JPEG_QUALITY), 80])
+        return b'--frame\r\nContent-Type: image/jpeg\r\n\r\n' + buffer.tobytes() + b'\r\n'
+
+    pool = BufferPool()
+    converted = pool.rotating("converted", 3)
+    w, h = source.sizes[args.stream]
+
+    def after():
+        out = converted.next((h, w, 3))
+        source.capture_into(args.stream, out, code=code)
+        ret, buffer = cv2.imencode('.jpg', out, [int(cv2.IMWRITE_JPEG_QUALITY), 80])
+        return memoryview(buffer)
+
+    for name, step in (("before", before), ("after", after)):
+        if args.mode not in (name, "both"):
+            continue
+        for _ in range(5):  # warm-up
+            step()
+        gc.collect()
+        tracemalloc.start()
+        transient = 0
+        t0 = time.monotonic()
+        for _ in range(args.frames):
+            tracemalloc.reset_peak()
+            base, _ = tracemalloc.get_traced_memory()
+            step()
+            _, peak = tracemalloc.get_traced_memory()
+            transient += peak - base
+        elapsed = time.monotonic() - t0
+        tracemalloc.stop()
+        print(f"{name:6s} {args.stream}: {transient / args.frames / 2**20:7.2f} MB allocated/frame  "
+              f"RSS={rss_mb():7.1f} MB  {args.frames / elapsed:5.1f} fps")
+    print(f"pool: {pool.summary()}")
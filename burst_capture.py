@@ -0,0 +1,315 @@
+#! /usr/bin/env python3
+"""
+burst_capture.py
+عکس‌برداری پشت سر هم (burst) و time-lapse از استریم در حال اجرای main
+
+به جای capture_file برای هر عکس (گرفتن، تبدیل رنگ، فشرده‌سازی و نوشتن پشت سر هم در یک رشته):
+    - رشته گرفتن فقط فریم را در یکی از چند بافر از پیش تخصیص داده می‌نویسد (capture_into) و طبق
+      زمان‌بندی interval جلو می‌رود؛ اگر همه بافرها منتظر فشرده‌سازی باشند صبر می‌کند (حافظه محدود)
+    - فشرده‌سازی JPEG در حافظه (cv2.imencode) در یک ThreadPool؛ OpenCV در imencode قفل GIL را آزاد
+      می‌کند پس روی چند هسته واقعاً موازی است
+    - یک رشته نویسنده خروجی را می‌نویسد: دنباله شماره‌دار <name>_000001.jpg یا قطعه‌های npz که هر کدام
+      chunk عکس JPEG پشت سر هم با offset ها و زمان‌ها هستند (فایل کمتر روی FAT فلش)
+
+فایل‌های نوشته شده دسته‌ای (هر handoff_batch فایل یا handoff_seconds ثانیه، و در پایان همراه فهرست)
+به on_files داده می‌شوند، نه یکی‌یکی؛ سپردن به صف انتقال برای هر دسته فقط یک نوشتن در journal دارد
+
+زمان هر فریم t_ms میلی‌ثانیه از اولین فریم با ساعت سنسور (یکنواخت، نه ساعت دیواری) است؛ فهرست همه
+فریم‌ها در <name>.json کنار خروجی نوشته می‌شود
+"""
+
+import os
+import json
+import time
+import queue
+import cv2
+import numpy as np
+from threading import Thread
+from concurrent.futures import ThreadPoolExecutor
+from frame_source import bgr_code
+
+FORMATS = ("jpg", "npz")
+
+
+def load_chunk(path):
+    """
+    خواندن یک قطعه npz
+    :return: فهرست (index، t_ms، jpeg bytes)
+    """
+    with np.load(path) as chunk:
+        data, offsets = chunk["data"], chunk["offsets"]
+        return [(int(i), float(t), data[offsets[n]:offsets[n + 1]].tobytes())
+                for n, (i, t) in enumerate(zip(chunk["index"], chunk["t_ms"]))]
+
+
+class BurstCapture:
+    def __init__(self, source, folder, fmt="jpg", quality=90, workers=None, buffers=None, chunk=32,
+                 stream="main", on_files=None, handoff_batch=64, handoff_seconds=60.0):
+        """
+        :param source: FrameSource
+        :param folder: پوشه مادر؛ هر burst زیرپوشه <name> خود را دارد
+        :param fmt: 'jpg' دنباله شماره‌دار یا 'npz' قطعه‌های chunk تایی
+        :param workers: تعداد رشته‌های فشرده‌سازی (پیش‌فرض تعداد هسته‌ها)
+        :param buffers: تعداد بافرهای فریم خام (پیش‌فرض workers + 2)؛ سقف حافظه burst
+        :param on_files: on_files(paths) برای هر دسته فایل نوشته شده (مثلاً سپردن به صف انتقال)؛
+                         در رشته نویسنده صدا زده می‌شود، دسته آخر شامل فایل فهرست است
+        :param handoff_batch: حداکثر تعداد فایل هر دسته
+        :param handoff_seconds: دسته نیمه‌پر هم بعد از این مدت سپرده می‌شود (time-lapse طولانی)
+        """
+        if fmt not in FORMATS:
+            raise ValueError(f"Unknown burst format: {fmt}")
+        self.source = source
+        self.folder = folder
+        self.fmt = fmt
+        self.quality = quality
+        self.workers = workers or os.cpu_count() or 1
+        self.buffers = buffers or self.workers + 2
+        self.chunk = max(1, int(chunk))
+        self.stream = stream
+        self.on_files = on_files
+        self.handoff_batch = max(1, int(handoff_batch))
+        self.handoff_seconds = handoff_seconds
+
+    def run(self, count, interval=0.0, name=None, progress=None, cancelled=None):
+        """
+        :param count: تعداد فریم
+        :param interval: فاصله شروع فریم‌ها (ثانیه)؛ 0 یعنی با حداکثر سرعت
+        :param progress: progress(fraction، message) بعد از نوشتن هر فریم
+        :param cancelled: cancelled() -> True برای توقف زودتر (فریم‌های گرفته شده نوشته می‌شوند)
+        :return: خلاصه burst
+        """
+        if count < 1:
+            raise ValueError("Burst needs at least one frame")
+        name = name or time.strftime("burst_%Y%m%d_%H%M%S")
+        folder = os.path.join(self.folder, name)
+        os.makedirs(folder, exist_ok=True)
+        width, height = self.source.sizes[self.stream]
+        code = bgr_code(self.source.formats[self.stream])
+        free = queue.Queue()
+        for _ in range(self.buffers):
+            free.put(np.empty((height, width, 3), np.uint8))
+        encoded = queue.Queue()
+        state = {"name": name, "folder": folder, "count": count, "frames": [], "files": [], "bytes": 0,
+                 "failed": set(), "encode_s": 0.0, "last_write": None, "progress": progress,
+                 "handoff": [], "handed_at": time.monotonic()}
+        writer = Thread(target=self._write, args=(encoded, state), name="burst-writer", daemon=True)
+        writer.start()
+
+        params = [int(cv2.IMWRITE_JPEG_QUALITY), int(self.quality)]
+        captured = late = 0
+        stall = 0.0
+        error = None
+        t0 = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="burst-encode") as pool:
+            for index in range(count):
+                if cancelled is not None and cancelled():
+                    break
+                delay = t0 + index * interval - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                elif interval and -delay > interval:
+                    late += 1
+                t = time.monotonic()
+                buffer = free.get()  # همه بافرها در حال فشرده‌سازی: صبر به جای تخصیص بیشتر
+                stall += time.monotonic() - t
+                try:
+                    _, timestamp = self.source.capture_into(self.stream, buffer, code=code)
+                except Exception as e:
+                    # فریم‌های گرفته شده تا اینجا نوشته و در فهرست ثبت می‌شوند
+                    print(f"[Burst Capture Error]: frame {index}: {e}")
+                    error = str(e)
+                    break
+                captured += 1
+                state.setdefault("first_ns", timestamp)
+                pool.submit(self._encode, index, buffer, timestamp, params, free, encoded)
+            capture_s = time.monotonic() - t0
+        encoded.put(None)
+        writer.join()
+        if not captured and error:
+            raise RuntimeError(f"Burst capture failed: {error}")
+
+        frames = sorted(state["frames"], key=lambda frame: frame["index"])
+        for frame in frames:
+            frame["t_ms"] = round((frame["sensor_ns"] - state["first_ns"]) / 1e6, 3)
+        elapsed = (state["last_write"] or time.monotonic()) - t0
+        summary = {
+            "name": name, "folder": folder, "format": self.fmt, "stream": self.stream,
+            "size": [width, height], "quality": self.quality, "interval": interval,
+            "requested": count, "captured": captured, "written": len(frames), "failed": len(state["failed"]),
+            "late": late, "files": len(state["files"]), "bytes": state["bytes"],
+            "capture_fps": captured / capture_s if capture_s > 0 else 0.0,
+            "sustained_fps": len(frames) / elapsed if elapsed > 0 else 0.0,
+            "stall_ms": 1000 * stall,
+            "encode_ms": 1000 * state["encode_s"] / max(1, len(frames)),
+            "workers": self.workers, "buffers": self.buffers, "error": error,
+        }
+        index_path = os.path.join(folder, f"{name}.json")
+        self._save_index(index_path, dict(summary, frames=frames))
+        summary["index"] = index_path
+        state["handoff"].append(index_path)
+        self._hand_off(state)
+        return summary
+
+    # -----------------------
+    # رشته‌های فشرده‌سازی و نوشتن
+    # -----------------------
+    def _encode(self, index, buffer, timestamp, params, free, encoded):
+        t = time.perf_counter()
+        try:
+            ok, data = cv2.imencode(".jpg", buffer, params)
+            if not ok:
+                raise RuntimeError("imencode failed")
+        except Exception as e:
+            print(f"[Burst Encode Error]: frame {index}: {e}")
+            data = None
+        finally:
+            free.put(buffer)
+        encoded.put((index, timestamp, data, time.perf_counter() - t))
+
+    def _write(self, encoded, state):
+        pending = {}   # فقط npz: index -> (timestamp، data) تا کامل شدن قطعه
+        next_chunk = 0
+        while True:
+            item = encoded.get()
+            if item is None:
+                break
+            index, timestamp, data, seconds = item
+            state["encode_s"] += seconds
+            if data is None:
+                state["failed"].add(index)
+            elif self.fmt == "jpg":
+                file = f"{state['name']}_{index + 1:06d}.jpg"
+                if self._write_file(os.path.join(state["folder"], file), data, state):
+                    state["frames"].append({"index": index, "file": file, "sensor_ns": timestamp})
+                    self._report(state)
+                else:
+                    state["failed"].add(index)
+            else:
+                pending[index] = (timestamp, data)
+            if self.fmt != "npz":
+                continue
+            # قطعه‌ها به ترتیب نوشته می‌شوند؛ فریم خراب فقط جای خالی در قطعه‌اش می‌گذارد
+            while self._chunk_ready(next_chunk, pending, state):
+                self._write_chunk(next_chunk, pending, state)
+                next_chunk += 1
+        while pending:
+            self._write_chunk(next_chunk, pending, state)
+            next_chunk += 1
+
+    def _chunk_ready(self, chunk, pending, state):
+        start = chunk * self.chunk
+        stop = min(start + self.chunk, state["count"])
+        return start < stop and all(i in pending or i in state["failed"] for i in range(start, stop))
+
+    def _write_chunk(self, chunk, pending, state):
+        start = chunk * self.chunk
+        indices = [i for i in range(start, start + self.chunk) if i in pending]
+        if not indices:
+            return
+        items = [pending.pop(i) for i in indices]
+        offsets = np.zeros(len(items) + 1, np.int64)
+        offsets[1:] = np.cumsum([len(data) for _, data in items])
+        file = f"{state['name']}_{chunk:04d}.npz"
+        path = os.path.join(state["folder"], file)
+        tmp = path + ".tmp.npz"
+        try:
+            # JPEG ها از قبل فشرده‌اند؛ savez بدون فشرده‌سازی دوباره
+            np.savez(tmp, data=np.concatenate([data.reshape(-1) for _, data in items]), offsets=offsets,
+                     index=np.array(indices, np.int64), sensor_ns=np.array([t for t, _ in items], np.int64),
+                     t_ms=np.array([(t - state["first_ns"]) / 1e6 for t, _ in items]))
+            os.replace(tmp, path)
+        except OSError as e:
+            print(f"[Burst Write Error]: {e}")
+            state["failed"].update(indices)
+            return
+        self._wrote(path, int(offsets[-1]), state)
+        state["frames"].extend({"index": i, "file": file, "offset": int(offsets[n]), "sensor_ns": t}
+                               for n, (i, (t, _)) in enumerate(zip(indices, items)))
+        self._report(state)
+
+    def _write_file(self, path, data, state):
+        try:
+            with open(path, "wb") as f:
+                f.write(data)
+        except OSError as e:
+            print(f"[Burst Write Error]: {e}")
+            return False
+        self._wrote(path, len(data), state)
+        return True
+
+    def _wrote(self, path, size, state):
+        state["files"].append(path)
+        state["bytes"] += size
+        state["last_write"] = time.monotonic()
+        state["handoff"].append(path)
+        if (len(state["handoff"]) >= self.handoff_batch
+                or state["last_write"] - state["handed_at"] >= self.handoff_seconds):
+            self._hand_off(state)
+
+    def _hand_off(self, state):
+        paths, state["handoff"] = state["handoff"], []
+        state["handed_at"] = time.monotonic()
+        if self.on_files is None or not paths:
+            return
+        try:
+            self.on_files(paths)
+        except Exception as e:
+            print(f"[Burst Handoff Error]: {e}")
+
+    def _report(self, state):
+        if state["progress"] is not None:
+            written = len(state["frames"])
+            state["progress"](written / state["count"], f"{written}/{state['count']} frames")
+
+    @staticmethod
+    def _save_index(path, data):
+        tmp = path + ".tmp"
+        try:
+            with open(tmp, "w") as f:
+                json.dump(data, f, indent=1)
+            os.replace(tmp, path)
+        except OSError as e:
+            print(f"[Burst Index Error]: {e}")
+
+
+if __name__ == "__main__":
+    # fps پایدار عکس 4K: capture_file پشت سر هم در برابر burst با فشرده‌سازی موازی و نوشتن دسته‌ای
+    import argparse
+    import shutil
+    import tempfile
+    from frame_source import create_source
+
+    parser = argparse.ArgumentParser(description="Burst still capture: sustained fps for full-resolution stills")
+    parser.add_argument("--frames", type=int, default=30)
+    parser.add_argument("--size", default="3840x2160")
+    parser.add_argument("--quality", type=int, default=90)
+    parser.add_argument("--interval", type=float, default=0.0, help="فاصله فریم‌ها برای آزمون time-lapse")
+    args = parser.parse_args()
+
+    size = tuple(int(v) for v in args.size.split("x"))
+    source = create_source("synthetic", main_size=size, realtime=False)
+    work = tempfile.mkdtemp(prefix="burst_")
+    source.capture_array("main")  # باز کردن منبع خارج از زمان‌گیری
+
+    t0 = time.monotonic()
+    for n in range(args.frames):
+        source.capture_file(os.path.join(work, f"image_{n:06d}.jpg"))
+    naive = args.frames / (time.monotonic() - t0)
+    print(f"{size[0]}x{size[1]} stills, {args.frames} frames, {os.cpu_count()} CPU(s)")
+    print(f"  capture_file loop     : {naive:5.2f} fps")
+
+    cpus = os.cpu_count() or 1
+    runs = [("jpg", 1)] + ([("jpg", cpus)] if cpus > 1 else []) + [("npz", cpus)]
+    for fmt, workers in runs:
+        burst = BurstCapture(source, work, fmt=fmt, quality=args.quality, workers=workers)
+        result = burst.run(args.frames, interval=args.interval, name=f"{fmt}_{workers}")
+        print(f"  burst {fmt} x{workers} workers: {result['sustained_fps']:5.2f} fps sustained "
+              f"(capture {result['capture_fps']:5.2f} fps, encode {result['encode_ms']:.0f} ms/frame, "
+              f"stalled {result['stall_ms']:.0f} ms, late {result['late']}), "
+              f"{result['files']} files, {result['bytes'] / 2**20:.1f} MB")
+        with open(result["index"]) as f:
+            frames = json.load(f)["frames"]
+        print(f"    t_ms: first {frames[0]['t_ms']}, last {frames[-1]['t_ms']}, "
+              f"monotonic {all(a['t_ms'] < b['t_ms'] for a, b in zip(frames, frames[1:]))}")
+    source.close()
+    shutil.rmtree(work)
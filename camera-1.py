@@ -2,23 +2,18 @@ import os
 import time
 import cv2
 from threading import Lock
-from picamera2 import Picamera2
-from libcamera import controls
+from frame_source import get_source, format_to_bgr
 
 class Camera:
     def __init__(self):
-        self.picam2 = Picamera2()
-               # پیکربندی دوربین: main برای ضبط با کیفیت بالا، lores برای استریم سریع
-        config = self.picam2.create_video_configuration(
-            main={"size": (3840, 2160)},
-            lores={"size": (1024, 768), "format": "RGB888"},  # RGB مستقیم
-            display="lores",
-            encode="main"
+        # پیکربندی دوربین: main برای ضبط با کیفیت بالا، lores برای استریم سریع
+        # منبع تا اولین capture باز نمی‌شود
+        self.source = get_source(
+            main_size=(3840, 2160),
+            lores_size=(1024, 768),
+            fps=30.0,
+            formats={"lores": "RGB888"}  # RGB مستقیم
         )
-        self.picam2.set_controls({"FrameRate": 30.0})
-        self.picam2.configure(config)
-        self.picam2.start()
-        time.sleep(2)  # منتظر ماندن برای پایدار شدن دوربین
 
         # متغیرهای ضبط
         self.recording = False
@@ -32,21 +27,12 @@ class Camera:
         os.makedirs(self.video_folder, exist_ok=True)
 
     def stream_frames(self):
-        self.picam2.stop()
-        stream_config = self.picam2.create_video_configuration(
-            main={"size": (800, 600)},  
-            lores={"size": (1024, 768)},
-            display="lores",
-            encode="main"
-        )
-        self.picam2.configure(stream_config)
-        self.picam2.start()
-        time.sleep(1)  # فرصت برای پایدار شدن
         """استریم ویدئو با کیفیت پایین برای روانی بیشتر"""
+        self.source.configure(main_size=(800, 600), lores_size=(1024, 768))
         while True:
             try:
-                frame = self.picam2.capture_array("main")
-                frame = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
+                frame = self.source.capture_array("main")
+                frame = format_to_bgr(frame, self.source.formats["main"])
                 ret, buffer = cv2.imencode('.jpg', frame, [int(cv2.IMWRITE_JPEG_QUALITY), 10])
                 if ret:
                     yield (b'--frame\r\n'
@@ -56,34 +42,16 @@ class Camera:
                 time.sleep(0.1)
 
     def capture_image(self):
-        self.picam2.stop()
-        fullres_config = self.picam2.create_video_configuration(
-            main={"size": (3840, 2160)},  # رزولوشن کامل برای عکس
-            lores={"size": (1024, 768)},
-            display="lores",
-            encode="main"
-        )
-        self.picam2.configure(fullres_config)
-        self.picam2.start()
-        time.sleep(1)  # فرصت برای پایدار شدن
         """گرفتن عکس با کیفیت بالا"""
+        self.source.configure(main_size=(3840, 2160), lores_size=(1024, 768))  # رزولوشن کامل برای عکس
         timestamp = time.strftime("%Y%m%d-%H%M%S")
         filepath = os.path.join(self.image_folder, f"image_{timestamp}.jpg")
-        self.picam2.capture_file(filepath)
+        self.source.capture_file(filepath)
         return filepath
 
     def start_recording(self, duration=30):
-        self.picam2.stop()
-        video_config = self.picam2.create_video_configuration(
-            main={"size": (1920, 1080)},  # رزولوشن کامل برای عکس
-            lores={"size": (1024, 768)},
-            display="lores",
-            encode="main"
-        )
-        self.picam2.configure(video_config)
-        self.picam2.start()
-        time.sleep(1)  # فرصت برای پایدار شدن
         """شروع ضبط ویدئو با کیفیت بالا"""
+        self.source.configure(main_size=(1920, 1080), lores_size=(1024, 768))
         timestamp = time.strftime("%Y%m%d_%H%M%S")
         video_path = os.path.join(self.video_folder, f"video_{timestamp}.mp4")
         fourcc = cv2.VideoWriter_fourcc(*'mp4v')
@@ -102,8 +70,8 @@ class Camera:
             max_frames = int(fps * duration)  # مثلا fps=15 و duration=30
             frames_captured = 0
             while self.recording and frames_captured < max_frames:
-                frame = self.picam2.capture_array("main")
-                frame = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
+                frame = self.source.capture_array("main")
+                frame = format_to_bgr(frame, self.source.formats["main"])
                 with self.recording_lock:
                     self.video_writer.write(frame)
                 #time.sleep(1 / 30)
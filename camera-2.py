@@ -2,17 +2,19 @@ import os
 import time
 import cv2
 from threading import Lock
-from picamera2 import Picamera2
-from libcamera import controls
+from frame_source import get_source, format_to_bgr
 from safe_storage import SafeStorage
 
 class Camera:
     def __init__(self):
         self.storage = SafeStorage()
-        self.picam2 = Picamera2()
-        
-        # پیکربندی اولیه دوربین
-        self.configure_camera(3840, 2160)  # رزولوشن اولیه 4K
+        # منبع تا اولین capture باز نمی‌شود
+        self.source = get_source(
+            main_size=(3840, 2160),  # رزولوشن اولیه 4K
+            lores_size=(1024, 768),
+            fps=30.0,
+            formats={"main": "RGB888", "lores": "YUV420"}
+        )
         
         # متغیرهای ضبط
         self.recording = False
@@ -27,23 +29,15 @@ class Camera:
         os.makedirs(self.video_folder, exist_ok=True)
 
     def configure_camera(self, width, height):
-        """پیکربندی دوربین با اندازه‌های مشخص"""
-        config = self.picam2.create_video_configuration(
-            main={"size": (width, height), "format": "RGB888"},
-            lores={"size": (1024, 768), "format": "YUV420"},
-            display="lores"
-        )
-        self.picam2.configure(config)
-        self.picam2.set_controls({"FrameRate": 30.0})
-        self.picam2.start()
-        time.sleep(2)  # زمان برای پایدار شدن دوربین
+        """پیکربندی دوربین با اندازه‌های مشخص (اگر منبع باز باشد دوباره پیکربندی می‌شود)"""
+        self.source.configure(main_size=(width, height), lores_size=(1024, 768))
 
     def stream_frames(self):
         """استریم ویدئو با کیفیت پایین برای روانی بیشتر"""
         try:
             while True:
-                frame = self.picam2.capture_array("lores")
-                frame = cv2.cvtColor(frame, cv2.COLOR_YUV420p2RGB)
+                frame = self.source.capture_array("lores")
+                frame = format_to_bgr(frame, self.source.formats["lores"])
                 frame = cv2.resize(frame, (640, 480))  # کاهش سایز برای استریم روان
                 ret, buffer = cv2.imencode('.jpg', frame, [
                     int(cv2.IMWRITE_JPEG_QUALITY), 50
@@ -54,25 +48,17 @@ class Camera:
         except Exception as e:
             print(f"[Stream Error]: {e}")
         finally:
-            self.picam2.stop()
+            self.source.close()
 
     def capture_image(self):
         """گرفتن عکس با کیفیت بالا"""
         try:
             # تغییر به حالت عکسبرداری با کیفیت بالا
-            self.picam2.stop()
-            config = self.picam2.create_still_configuration(
-                main={"size": (3840, 2160)},
-                lores={"size": (1024, 768)},
-                display="lores"
-            )
-            self.picam2.configure(config)
-            self.picam2.start()
-            time.sleep(1)
+            self.configure_camera(3840, 2160)
             
             timestamp = time.strftime("%Y%m%d-%H%M%S")
             # filepath = os.path.join(self.image_folder, f"image_{timestamp}.jpg")
-            # self.picam2.capture_file(filepath)
+            # self.source.capture_file(filepath)
             # return filepath
             
         except Exception as e:
@@ -85,15 +71,7 @@ class Camera:
     def start_recording(self, duration=30):
         """شروع ضبط ویدئو با کیفیت بالا"""
         try:
-            self.picam2.stop()
-            config = self.picam2.create_video_configuration(
-                main={"size": (1920, 1080)},
-                lores={"size": (1024, 768)},
-                display="lores"
-            )
-            self.picam2.configure(config)
-            self.picam2.start()
-            time.sleep(1)
+            self.configure_camera(1920, 1080)
             
             timestamp = time.strftime("%Y%m%d_%H%M%S")
             video_path = os.path.join(self.video_folder, f"video_{timestamp}.mp4")
@@ -112,8 +90,8 @@ class Camera:
             frames_captured = 0
             
             while self.recording and frames_captured < max_frames:
-                frame = self.picam2.capture_array("main")
-                frame = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
+                frame = self.source.capture_array("main")
+                frame = format_to_bgr(frame, self.source.formats["main"])
                 
                 with self.recording_lock:
                     if self.video_writer:
@@ -2,102 +2,86 @@ import os
 import time
 import cv2
 import tempfile
-import shutil
-from threading import Lock, Thread
-from picamera2 import Picamera2
-from libcamera import controls
+from threading import Lock
+from frame_source import get_source
+from camera_modes import CameraModeManager
+from record_pipeline import RecordingPipeline
+from particle_tracker import TrackingTap
+from transfer_queue import TransferQueue
+from storage_presence import StoragePresence
 
 class Camera:
     def __init__(self):
-        self.picam2 = Picamera2()
-        
-        # پیکربندی دوربین
-        config = self.picam2.create_video_configuration(
-            main={"size": (3840, 2160)},
-            lores={"size": (1024, 768), "format": "RGB888"},
-            display="lores",
-            encode="main"
+        # منبع فریم؛ دوربین در اولین capture باز می‌شود
+        self.source = get_source(
+            main_size=(3840, 2160),
+            lores_size=(1024, 768),
+            fps=30.0,
+            formats={"lores": "RGB888"}
         )
-        self.picam2.set_controls({"FrameRate": 30.0})
-        self.picam2.configure(config)
-        self.picam2.start()
-        time.sleep(2)
+        # یک پیکربندی دو استریمی دائمی برای عکس، ضبط و پیش‌نمایش
+        self.modes = CameraModeManager(self.source)
 
         # متغیرهای ضبط
         self.recording = False
         self.recording_lock = Lock()
-        self.video_writer = None
+        self.recorder = None
+
+        # زمان آخرین عکس (میلی‌ثانیه) برای نام‌های یکتا
+        self._still_lock = Lock()
+        self._last_still_ms = 0
+
+        # ردیابی زنده ذرات کنار ضبط (روی استریم lores)
+        self.tracking = TrackingTap()
+        self.last_tracks = None
         
         # مسیرهای ذخیره‌سازی موقت
         self.temp_dir = os.path.join(tempfile.gettempdir(), 'raspberry_camera_temp')
         os.makedirs(self.temp_dir, exist_ok=True)
         
-        # فلش دیسک
+        # فلش دیسک؛ وضعیت mount از mountinfo کش و با رویداد به‌روز می‌شود
         self.flash_mounted = False
         self.flash_path = None
+        self.storage = StoragePresence(roots=('/media/pi', '/mnt/usb'))
         self._check_flash()
 
+        # صف پایدار انتقال به فلش (یک رشته I/O، با fsync و sha256، ادامه بعد از قطع)
+        self.transfers = TransferQueue(os.path.join(self.temp_dir, 'transfers.json'), self._flash_root)
+        self.transfers.start()
+        self.storage.add_listener(lambda mount: mount and self.transfers.wake())
+
     def _check_flash(self):
         """بررسی وجود و وضعیت فلش دیسک"""
         try:
-            # این بخش را با کدهای تشخیص فلش از ماژول flash_detector جایگزین کنید
-            # برای مثال ساده:
-            possible_mounts = ['/media/pi', '/mnt/usb']
-            for mount in possible_mounts:
-                if os.path.exists(mount) and os.path.ismount(mount):
-                    self.flash_path = mount
-                    self.flash_mounted = True
-                    os.makedirs(os.path.join(self.flash_path, 'images'), exist_ok=True)
-                    os.makedirs(os.path.join(self.flash_path, 'videos'), exist_ok=True)
-                    return True
-            
+            mount = self.storage.current()
+            if mount:
+                if mount != self.flash_path:
+                    # پوشه‌ها فقط وقتی فلش جدید دیده شد ساخته می‌شوند
+                    os.makedirs(os.path.join(mount, 'images'), exist_ok=True)
+                    os.makedirs(os.path.join(mount, 'videos'), exist_ok=True)
+                self.flash_path = mount
+                self.flash_mounted = True
+                return True
+
             self.flash_mounted = False
+            self.flash_path = None
             return False
         except Exception as e:
             print(f"خطا در بررسی فلش دیسک: {e}")
             self.flash_mounted = False
             return False
 
-    def _transfer_to_flash(self, src_path, file_type, callback=None):
-        """انتقال فایل به فلش دیسک"""
-        try:
-            if not self.flash_mounted and not self._check_flash():
-                raise RuntimeError("ذخیره ساز خارجی یافت نشد")
-            
-            filename = os.path.basename(src_path)
-            dest_path = os.path.join(self.flash_path, file_type, filename)
-            
-            # کپی فایل به فلش
-            shutil.copy2(src_path, dest_path)
-            
-            # حذف فایل موقت
-            os.remove(src_path)
-            
-            if callback:
-                callback(dest_path)
-            return dest_path
-        except Exception as e:
-            if callback:
-                callback(None, str(e))
-            raise RuntimeError(f"خطا در انتقال به فلش: {str(e)}")
+    def _flash_root(self):
+        """مسیر فلش برای صف انتقال؛ None تا وقتی فلش وصل نیست"""
+        return self.flash_path if self._check_flash() else None
 
     def stream_frames(self):
-        """استریم ویدئو (بدون تغییر)"""
-        self.picam2.stop()
-        stream_config = self.picam2.create_video_configuration(
-            main={"size": (1024, 768)},  
-            lores={"size": (700, 460)},
-            display="lores",
-            encode="main"
-        )
-        self.picam2.configure(stream_config)
-        self.picam2.start()
-        time.sleep(1)
-        
+        """استریم ویدئو از lores (RGB888 همان ترتیب BGR است، تبدیل رنگ لازم نیست)"""
+        stream = self.modes.prepare("preview")
+
         while True:
             try:
-                frame = self.picam2.capture_array("main")
-                frame = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
+                frame = self.source.capture_array(stream)
                 ret, buffer = cv2.imencode('.jpg', frame, [int(cv2.IMWRITE_JPEG_QUALITY), 10])
                 if ret:
                     yield (b'--frame\r\n'
@@ -106,29 +90,26 @@ class Camera:
                 print(f"[Stream Error]: {e}")
                 time.sleep(0.1)
 
+    def _still_timestamp(self):
+        """زمان با دقت میلی‌ثانیه و یکتا؛ دو عکس در یک ثانیه روی هم نوشته نمی‌شوند"""
+        with self._still_lock:
+            ms = max(int(time.time() * 1000), self._last_still_ms + 1)
+            self._last_still_ms = ms
+        return time.strftime("%Y%m%d-%H%M%S", time.localtime(ms // 1000)) + f"-{ms % 1000:03d}"
+
     def capture_image(self):
         """گرفتن عکس با ذخیره‌سازی موقت و انتقال به فلش"""
         try:
-            # تغییر به حالت عکسبرداری با کیفیت بالا
-            self.picam2.stop()
-            fullres_config = self.picam2.create_video_configuration(
-                main={"size": (3840, 2160)},
-                lores={"size": (1024, 768)},
-                display="lores",
-                encode="main"
-            )
-            self.picam2.configure(fullres_config)
-            self.picam2.start()
-            time.sleep(1)
+            # عکس از استریم main که همیشه در 4K در حال اجراست
+            stream = self.modes.prepare("still")
 
             # ذخیره موقت
-            timestamp = time.strftime("%Y%m%d-%H%M%S")
+            timestamp = self._still_timestamp()
             temp_path = os.path.join(self.temp_dir, f"image_{timestamp}.jpg")
-            self.picam2.capture_file(temp_path)
+            self.source.capture_file(temp_path, name=stream)
             
             # انتقال به فلش در پس‌زمینه
-            Thread(target=self._transfer_to_flash, 
-                  args=(temp_path, 'images', self._image_transfer_callback)).start()
+            self.transfers.submit(temp_path, 'images', self._image_transfer_callback)
             
             return temp_path  # مسیر موقت برای پیگیری وضعیت
             
@@ -143,56 +124,38 @@ class Camera:
         elif final_path:
             print(f"عکس با موفقیت انتقال یافت: {final_path}")
 
-    def start_recording(self, duration=30):
-        """شروع ضبط ویدئو با ذخیره‌سازی موقت"""
+    def start_recording(self, duration=30, track=False):
+        """شروع ضبط ویدئو با ذخیره‌سازی موقت (track: ردیابی ذرات همزمان روی lores)"""
         try:
             if not self._check_flash():
                 raise RuntimeError("ذخیره ساز خارجی یافت نشد")
             
-            self.picam2.stop()
-            video_config = self.picam2.create_video_configuration(
-                main={"size": (1920, 1080)},
-                lores={"size": (1024, 768)},
-                display="lores",
-                encode="main"
-            )
-            self.picam2.configure(video_config)
-            self.picam2.start()
-            time.sleep(1)
-
             # آماده‌سازی ضبط
             timestamp = time.strftime("%Y%m%d_%H%M%S")
             temp_path = os.path.join(self.temp_dir, f"video_{timestamp}.mp4")
-            fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-            fps = 30
-            frame_size = (1920, 1080)
 
+            # capture، تبدیل و نوشتن در سه رشته جدا با بافر محدود بین آن‌ها
+            tap = None
+            if track:
+                self.tracking.start()
+                tap = self.tracking
+            recorder = RecordingPipeline(self.source, self.modes, frame_size=(1920, 1080), fps=30,
+                                         capacity=8, policy="drop-oldest", tap=tap, tap_stream="lores")
             with self.recording_lock:
-                self.video_writer = cv2.VideoWriter(temp_path, fourcc, fps, frame_size)
-                if not self.video_writer.isOpened():
-                    raise RuntimeError("خطا در باز کردن ذخیره کننده ویدئو")
+                recorder.start(temp_path)
+                self.recorder = recorder
                 self.recording = True
 
             # ضبط ویدئو
-            start_time = time.time()
-            max_frames = int(fps * duration)
-            frames_captured = 0
-            
-            while self.recording and frames_captured < max_frames:
-                frame = self.picam2.capture_array("main")
-                frame = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
-                
-                with self.recording_lock:
-                    if self.video_writer:
-                        self.video_writer.write(frame)
-                
-                frames_captured += 1
-                time.sleep(1 / fps)
+            end_time = time.monotonic() + duration
+            while self.recording and recorder.recording and time.monotonic() < end_time:
+                time.sleep(0.1)
+            completed = self.recording
+            self.stop_recording()
 
             # انتقال به فلش در پس‌زمینه
-            if self.recording:
-                Thread(target=self._transfer_to_flash, 
-                      args=(temp_path, 'videos', self._video_transfer_callback)).start()
+            if completed:
+                self.transfers.submit(temp_path, 'videos', self._video_transfer_callback)
             
             return temp_path  # مسیر موقت برای پیگیری وضعیت
             
@@ -213,6 +176,10 @@ class Camera:
         """توقف ضبط"""
         with self.recording_lock:
             self.recording = False
-            if self.video_writer:
-                self.video_writer.release()
-                self.video_writer = None
\ No newline at end of file
+            recorder, self.recorder = self.recorder, None
+        if recorder:
+            # فریم‌های مانده در بافرها قبل از بستن فایل نوشته می‌شوند
+            print(f"Recording stats: {recorder.stop()}")
+            if recorder.tap is not None:
+                self.last_tracks = self.tracking.stop()
+                print(f"Tracking stats: {self.last_tracks}")
\ No newline at end of file
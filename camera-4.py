@@ -4,12 +4,12 @@ camera.py
 مدیریت دوربین Raspberry Pi با Picamera2 برای عکس و ویدئو
 """
 
-from picamera2 import Picamera2
-from libcamera import controls
 import cv2
 import os
 import time
 from threading import Lock
+from frame_pacer import FramePacer
+from frame_source import get_source, format_to_bgr
 
 # -----------------------
 # پیکربندی مسیر ذخیره فایل‌ها
@@ -19,25 +19,12 @@ MEDIA_FOLDER = os.path.join(BASE_DIR, 'static', 'images')
 os.makedirs(MEDIA_FOLDER, exist_ok=True)
 
 # -----------------------
-# راه‌اندازی Picamera2
+# منبع فریم (تا اولین capture باز نمی‌شود)
 # -----------------------
-picam2 = Picamera2()
+FULLRES_SIZE = (3840, 2160)  # رزولوشن کامل 4K برای عکس
+PREVIEW_SIZE = (1024, 768)   # برای نمایش پیش‌نمایش
 
-# پیکربندی پیش‌فرض برای عکس (رزولوشن کامل)
-fullres_config = picam2.create_video_configuration(
-    main={"size": (3840, 2160)},  # رزولوشن کامل 4K
-    lores={"size": (1024, 768)},   # برای نمایش پیش‌نمایش
-    display="lores",
-    encode="main"
-)
-
-picam2.set_controls({
-    "FrameRate": 30.0,
-})
-
-picam2.configure(fullres_config)
-picam2.start()
-time.sleep(2)  # فرصت برای پایدار شدن
+camera_source = get_source(main_size=FULLRES_SIZE, lores_size=PREVIEW_SIZE, fps=30.0)
 
 # -----------------------
 # متغیرهای ضبط ویدئو
@@ -54,8 +41,8 @@ def gen_frames():
     """تولید فریم برای نمایش لحظه‌ای در مرورگر"""
     while True:
         try:
-            frame = picam2.capture_array("lores")  # استفاده از استریم کم‌حجم برای پیش‌نمایش
-            frame = cv2.cvtColor(frame, cv2.COLOR_YUV420p2RGB)
+            frame = camera_source.capture_array("lores")  # استفاده از استریم کم‌حجم برای پیش‌نمایش
+            frame = format_to_bgr(frame, camera_source.formats["lores"])
 
             ret, buffer = cv2.imencode('.jpg', frame, [int(cv2.IMWRITE_JPEG_QUALITY), 80])
             if not ret:
@@ -79,7 +66,7 @@ def capture_image():
     filename = f"image_{timestamp}.jpg"
     filepath = os.path.join(MEDIA_FOLDER, filename)
 
-    picam2.capture_file(filepath)  # با کانفیگ fullres عکس گرفته می‌شود
+    camera_source.capture_file(filepath)  # با کانفیگ fullres عکس گرفته می‌شود
     return filename
 
 
@@ -93,17 +80,8 @@ def start_recording(duration=30):
     """
     global recording, video_writer
 
-    # --- توقف و تغییر به کانفیگ ویدئو ---
-    picam2.stop()
-    video_config = picam2.create_video_configuration(
-        main={"size": (1920, 1080)},  # رزولوشن پایین‌تر برای ضبط ویدئو
-        lores={"size": (640, 480)},
-        display="lores",
-        encode="main"
-    )
-    picam2.configure(video_config)
-    picam2.start()
-    time.sleep(1)
+    # --- تغییر به کانفیگ ویدئو ---
+    camera_source.configure(main_size=(1920, 1080), lores_size=(640, 480))  # رزولوشن پایین‌تر برای ضبط ویدئو
 
     # --- آماده‌سازی ضبط ---
     timestamp = time.strftime("%Y%m%d_%H%M%S")
@@ -121,17 +99,20 @@ def start_recording(duration=30):
 
     print(f"Recording started: {video_path}")
 
-    start_time = time.time()
+    pacer = FramePacer(fps)
+    pacer.start()
     try:
-        while recording and (time.time() - start_time) < duration:
-            frame = picam2.capture_array("main")
-            frame = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
+        while recording and time.monotonic() - pacer.t0 < duration:
+            frame, timestamp = camera_source.capture_with_timestamp("main")
+            count = pacer.slots_for(timestamp)  # جایگاه زمانی فریم بر اساس زمان سنسور (تکرار/حذف برای حفظ timeline)
+            if count == 0:
+                continue
+            frame = format_to_bgr(frame, camera_source.formats["main"])
 
             with recording_lock:
                 if video_writer is not None:
-                    video_writer.write(frame)
-
-            time.sleep(1 / fps)
+                    for _ in range(count):
+                        video_writer.write(frame)
 
     finally:
         with recording_lock:
@@ -140,12 +121,9 @@ def start_recording(duration=30):
                 video_writer.release()
                 video_writer = None
 
-        print(f"Recording saved: {video_path}")
+        print(f"Recording saved: {video_path} {pacer.summary()}")
 
         # --- برگرداندن رزولوشن کامل برای عکس ---
-        picam2.stop()
-        picam2.configure(fullres_config)
-        picam2.start()
-        time.sleep(1)
+        camera_source.configure(main_size=FULLRES_SIZE, lores_size=PREVIEW_SIZE)
 
     return video_path
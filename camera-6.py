@@ -1,23 +1,13 @@
 from flask import Flask, render_template, Response, request, jsonify
-from picamera2 import Picamera2
 import time, os, cv2
 from threading import Lock
-from libcamera import controls
+from frame_source import get_source, format_to_bgr
 
 app = Flask(__name__)
-picam2 = Picamera2()
 
 # ØªÙ†Ø¸ÛŒÙ… Ø¯ÙˆØ±Ø¨ÛŒÙ†
-config = picam2.create_video_configuration(
-    main={"size": (3840, 2160)},
-    lores={"size": (1024, 768)},
-    display="lores",
-    encode="main"
-)
-picam2.set_controls({"FrameRate": 30.0})
-picam2.configure(config)
-picam2.start()
-time.sleep(2)
+# منبع تا اولین capture باز نمی‌شود
+camera_source = get_source(main_size=(3840, 2160), lores_size=(1024, 768), fps=30.0)
 
 # Ù…Ø³ÛŒØ± Ø°Ø®ÛŒØ±Ù‡ ÙØ§ÛŒÙ„â€ŒÙ‡Ø§
 IMAGE_FOLDER = os.path.join(os.path.dirname(__file__), 'static/images')
@@ -31,8 +21,8 @@ video_path = None
 
 def gen_frames():
     while True:
-        frame = picam2.capture_array("lores")
-        frame = cv2.cvtColor(frame, cv2.COLOR_YUV420p2RGB)
+        frame = camera_source.capture_array("lores")
+        frame = format_to_bgr(frame, camera_source.formats["lores"])
         ret, buffer = cv2.imencode('.jpg', frame, [int(cv2.IMWRITE_JPEG_QUALITY), 80])
         if ret:
             yield (b'--frame\r\nContent-Type: image/jpeg\r\n\r\n' + buffer.tobytes() + b'\r\n')
@@ -54,7 +44,7 @@ def capture():
     timestamp = time.strftime("%Y%m%d-%H%M%S")
     filename = f"{sample_id}_{timestamp}.jpg"
     filepath = os.path.join(IMAGE_FOLDER, filename)
-    picam2.capture_file(filepath)
+    camera_source.capture_file(filepath)
     return {'status': 'success', 'filename': filename}
 
 @app.route('/start_recording', methods=['POST'])
@@ -81,8 +71,8 @@ def start_recording():
             if paused:
                 time.sleep(0.1)
                 continue
-            frame = picam2.capture_array("main")
-            frame = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
+            frame = camera_source.capture_array("main")
+            frame = format_to_bgr(frame, camera_source.formats["main"])
             video_writer.write(frame)
             time.sleep(1/30)
         stop_recording()
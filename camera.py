@@ -1,14 +1,37 @@
 import os
 import time
 import cv2
-from picamera2 import Picamera2
-from libcamera import controls
 from threading import Lock
-import shutil
+from frame_hub import FrameHub
+from frame_source import get_source
+from camera_modes import CameraModeManager
+from recorders import create_recorder, hardware_encoder_available
+from buffer_pool import BufferPool
+from adaptive_preview import TierEncoder
+from particle_detector import ParticleDetector, DetectionWorker
+from particle_tracker import ParticleTracker
+from results_store import ResultsStore
+from background_model import BackgroundModel
+from roi import RoiSet, RoiDetector, TiledDetector
+from event_recorder import create_event_recorder, make_triggers
+from change_gate import ChangeGate
+from transfer_queue import TransferQueue
+from storage_presence import StoragePresence
+from direct_writer import DirectWriter
+from segmented_recorder import LocalSink, Manifest, SegmentHandoff
+from job_scheduler import JobScheduler
+from event_bus import EventBus
+from burst_capture import BurstCapture
+from raw_capture import RawCapture, copy_plane
 
 # 📌 مسیرهای ذخیره
 LOCAL_IMAGE_FOLDER = os.path.join(os.path.dirname(__file__), 'static/images')
 LOCAL_VIDEO_FOLDER = os.path.join(os.path.dirname(__file__), 'static/videos')
+RESULTS_FOLDER = os.path.join(os.path.dirname(__file__), 'results')
+SEGMENT_RESULTS_FOLDER = os.path.join(RESULTS_FOLDER, 'segments')
+ANALYSIS_FOLDER = os.path.join(RESULTS_FOLDER, 'batch')
+EVENT_FOLDER = os.path.join(LOCAL_VIDEO_FOLDER, 'events')
+BURST_FOLDER = os.path.join(LOCAL_IMAGE_FOLDER, 'bursts')
 os.makedirs(LOCAL_IMAGE_FOLDER, exist_ok=True)
 os.makedirs(LOCAL_VIDEO_FOLDER, exist_ok=True)
 
@@ -18,145 +41,465 @@ USB_MOUNT_PATH = "/media/pi/USB"
 # قفل برای جلوگیری از تداخل ضبط
 recording_lock = Lock()
 recording = False
-video_writer = None
-
-# راه‌اندازی دوربین
-picam2 = Picamera2()
-config = picam2.create_video_configuration(
-    main={"size": (3840, 2160)},
-    lores={"size": (1024, 768)},
-    display="lores",
-    encode="main"
-)
-picam2.set_controls({
-    "FrameRate": 30.0
-})
-picam2.configure(config)
-picam2.start()
-time.sleep(2)
+active_recorder = None
+
+# منبع فریم (Picamera2 / replay / synthetic بر اساس CAMERA_SOURCE)
+# دوربین در اولین capture باز می‌شود، نه هنگام import
+camera_source = get_source(main_size=(3840, 2160), lores_size=(1024, 768), fps=30.0)
+
+# پیکربندی دو استریمی دائمی؛ عکس و ضبط بدون configure مجدد
+camera_modes = CameraModeManager(camera_source)
+
+# کانال push برای همه کلاینت‌ها: job، transfer، mode، storage، particles (SSE روی /stream)
+event_bus = EventBus()
+camera_modes.add_listener(lambda mode, action, elapsed: event_bus.publish(
+    "mode", {"mode": mode, "action": action, "switch_ms": 1000 * elapsed}))
+
+# اندازه فایل ویدئو (فریم‌های main به این اندازه کوچک می‌شوند)
+RECORD_SIZE = (1920, 1080)
+
+# مسیر ضبط: 'h264' (encoder سخت‌افزاری، در نبود آن pipeline)، 'pipeline' یا 'opencv'
+RECORD_ENCODER = os.environ.get("RECORD_ENCODER", "h264")
+
+# محل نوشتن ضبط: 'temp' (روی SD و بعد صف انتقال) یا 'direct' (مستقیم روی USB، SD فقط برای spill)
+STORAGE_MODE = os.environ.get("STORAGE_MODE", "temp")
+SEGMENT_SECONDS = 10.0
+
+# مدل پس‌زمینه برای تشخیص: 'median'، 'ema'، 'mog2' یا 'none' (Otsu در هر فریم)
+BACKGROUND_MODEL = os.environ.get("BACKGROUND_MODEL", "median")
+
+# تشخیص تغییر: 'diff'، 'hash' یا 'none'؛ فریم‌های بدون تغییر encode/تشخیص نمی‌شوند
+CHANGE_GATE = os.environ.get("CHANGE_GATE", "diff")
+
+# تشخیص زنده: 'lores' (همان فریم‌های پیش‌نمایش) یا 'tiled' (صفحه Y استریم main 4K، کاشی‌ها روی همه هسته‌ها)
+DETECTION_MODE = os.environ.get("DETECTION_MODE", "lores")
+DETECTION_TILE = 1024
+
+# وضعیت فلش از /proc/self/mountinfo، کش شده و به‌روز با رویداد mount/umount
+usb_storage = StoragePresence(roots=("/media",))
+usb_storage.start()
+usb_storage.add_listener(lambda mount: event_bus.publish("storage", {"mount": mount, "connected": bool(mount)}))
 
 def find_usb_mount():
     """
-    جستجوی خودکار مسیر فلش USB
-    مسیرها معمولاً در /media/<username>/USB_NAME قرار دارند
+    مسیر فلش USB (هر mount زیر /media، معمولاً /media/<username>/USB_NAME)
+    از کش خوانده می‌شود و هزینه‌ای به عکس/ضبط اضافه نمی‌کند
     """
-    media_root = "/media"
-    if not os.path.exists(media_root):
-        return None
-
-    # بررسی تمام پوشه‌ها در /media
-    for root, dirs, files in os.walk(media_root):
-        for dir_name in dirs:
-            mount_path = os.path.join(root, dir_name)
-            # اگر مسیر mount شده باشد و پوشه باشد، به عنوان USB در نظر می‌گیریم
-            if os.path.ismount(mount_path):
-                return mount_path
-    return None
+    return usb_storage.current()
 
 def is_usb_connected():
-    """بررسی اتصال فلش USB با جستجوی خودکار"""
-    usb_path = find_usb_mount()
-    return usb_path is not None
+    """بررسی اتصال فلش USB"""
+    return usb_storage.connected
+
+# صف پایدار انتقال به USB: یک رشته I/O، کپی قطعه‌ای با fsync و sha256، ادامه بعد از قطع
+TRANSFER_JOURNAL = os.path.join(os.path.dirname(__file__), 'logs', 'transfers.json')
+transfer_queue = TransferQueue(TRANSFER_JOURNAL, find_usb_mount)
+transfer_queue.start()
+# پیشرفت هر فایل با key همان کار؛ کلاینت کند فقط آخرین درصد را می‌گیرد
+transfer_queue.add_listener(lambda status: event_bus.publish("transfer", status, key=status["id"]))
+# با وصل شدن دوباره فلش کارهای منتظر بدون صبر تا retry بعدی ادامه پیدا می‌کنند
+usb_storage.add_listener(lambda mount: mount and transfer_queue.wake())
+
+# نوشتن مستقیم قطعه‌های H.264 روی USB؛ قطعه‌هایی که USB نتوانست بگیرد از SD با صف انتقال می‌روند
+direct_writer = DirectWriter(find_usb_mount, os.path.join(LOCAL_VIDEO_FOLDER, 'spill'), transfers=transfer_queue)
 
 def move_to_usb(local_path):
-    """انتقال فایل به USB و حذف نسخه محلی"""
-    usb_path = find_usb_mount()
-    if not usb_path:
-        raise RuntimeError("حافظه خارجی متصل نیست")
+    """
+    افزودن فایل به صف انتقال؛ نسخه محلی بعد از تأیید کپی حذف می‌شود
+    :return: وضعیت کار انتقال (id برای /check_transfer)
+    """
+    return transfer_queue.submit(local_path)
 
-    destination_path = os.path.join(usb_path, os.path.basename(local_path))
-    shutil.move(local_path, destination_path)  # انتقال و حذف فایل محلی
-    return destination_path
-
-def gen_frames():
-    """ارسال فریم‌ها برای پیش‌نمایش"""
-    while True:
-        try:
-            frame = picam2.capture_array("lores")
-            frame = cv2.cvtColor(frame, cv2.COLOR_YUV420p2RGB)
-            ret, buffer = cv2.imencode('.jpg', frame, [int(cv2.IMWRITE_JPEG_QUALITY), 80])
-            if not ret:
-                continue
-            yield (b'--frame\r\n'
-                   b'Content-Type: image/jpeg\r\n\r\n' + buffer.tobytes() + b'\r\n')
-        except Exception as e:
-            print(f"Frame capture error: {e}")
-            time.sleep(0.1)
-            continue
+# بافرهای ثابت؛ سه بافر به نوبت چون فریم منتشر شده در hub هنوز خوانده می‌شود
+# (مصرف‌کننده‌ها با acquire/release آن را نگه می‌دارند و capture بافر گرفته شده را بازنویسی نمی‌کند)
+buffer_pool = BufferPool()
+_preview_buffers = buffer_pool.rotating("preview", count=3)
+
+def _capture_preview():
+    """یک فریم lores برای پیش‌نمایش، تبدیل رنگ مستقیم از بافر دوربین به بافر ثابت"""
+    width, height = camera_source.sizes["lores"]
+    out = _preview_buffers.next((height, width, 3))
+    frame, _ = camera_source.capture_into("lores", out, code=cv2.COLOR_YUV420p2RGB)
+    return frame
+
+def _change_gate(keyframe_interval=1.0):
+    if CHANGE_GATE == "none":
+        return None
+    return ChangeGate(CHANGE_GATE, keyframe_interval=keyframe_interval)
+
+# یک capture و یک encode مشترک برای همه بینندگان؛ در صحنه ثابت حداقل یک فریم در ثانیه منتشر می‌شود
+frame_hub = FrameHub(_capture_preview, quality=80, gate=_change_gate(), reuse=_preview_buffers.reuse,
+                     buffers=_preview_buffers)
+
+# سطح‌های اندازه/کیفیت/fps برای کلاینت‌های با پهنای باند متفاوت
+preview_tiers = TierEncoder(frame_hub)
+
+# تشخیص ذرات روی همان فریم‌های lores که برای پیش‌نمایش گرفته می‌شوند
+# مدل روی lores در یک چهارم اندازه و هر 10 فریم به‌روز می‌شود و بین اجراها ذخیره می‌ماند
+def _background(name="full"):
+    if BACKGROUND_MODEL == "none":
+        return None
+    return BackgroundModel(BACKGROUND_MODEL, scale=0.25, every=10,
+                           path=os.path.join(RESULTS_FOLDER, f"background_{BACKGROUND_MODEL}_{name}.npz"))
+
+background_model = _background()
+
+# ROIها (کسری از تصویر) برای تشخیص و ضبط؛ بدون ROI کل فریم پردازش می‌شود
+roi_set = RoiSet()
+if DETECTION_MODE == "tiled":
+    # hub جدا روی main بدون مشترک MJPEG (پس بدون encode)؛ فقط صفحه Y کپی می‌شود
+    _detection_buffers = buffer_pool.rotating("detect_main", count=3)
+
+    def _capture_main_luma():
+        width, height = camera_source.sizes["main"]
+        out = _detection_buffers.next((height, width))
+        with camera_source.mapped("main") as (frame, _):
+            return copy_plane(frame, camera_source.formats["main"], "y", out)
+
+    detection_hub = FrameHub(_capture_main_luma, buffers=_detection_buffers)
+    full_detector = TiledDetector((DETECTION_TILE, DETECTION_TILE), overlap=64, workers=os.cpu_count() or 1,
+                                  factory=lambda index: ParticleDetector(background=_background(f"tile_{index}")))
+    # مختصات بر حسب پیکسل main؛ دروازه ردیابی به همان نسبت بزرگ می‌شود
+    detection_scale = camera_source.sizes["main"][0] / camera_source.sizes["lores"][0]
+else:
+    detection_hub = frame_hub
+    full_detector = ParticleDetector(background=background_model)
+    detection_scale = 1.0
+particle_detector = RoiDetector(roi_set, full=full_detector,
+                                factory=lambda name: ParticleDetector(background=_background(f"roi_{name}")))
+detection_worker = DetectionWorker(detection_hub, particle_detector)
+
+# ردیابی ذرات روی خروجی تشخیص؛ حداکثر 5 دقیقه (در 30fps) مسیر در حافظه نگه داشته می‌شود
+particle_tracker = ParticleTracker(gate=20.0 * detection_scale, history=9000)
+
+# نتایج ستونی بر اساس sampleId و clip؛ نوشتن در رشته جدا و دسته‌ای
+results_store = ResultsStore(RESULTS_FOLDER)
+_results_key = None  # (sample_id, clip) در حین ضبط با ردیابی
+
+# حداکثر مسیر در هر رویداد particles (شمار کامل جدا فرستاده می‌شود)
+LIVE_TRACKS = 200
+
+def _on_detections(detections):
+    # شماره فریم از رشته تشخیص (همین رشته)؛ با detections خالی هم فاصله فریم‌ها درست می‌ماند
+    rows = particle_tracker.update(detections, detection_worker.frame_index)
+    key = _results_key
+    if key is not None:
+        results_store.append("detections", rows, *key)
+    if event_bus.wants("particles"):
+        live = rows[:LIVE_TRACKS]
+        event_bus.publish("particles", {
+            "frame": int(rows["frame"][0]) if len(rows) else None,
+            "count": len(detections),
+            "active_tracks": particle_tracker.active,
+            "tracks": [[int(t), round(float(x), 1), round(float(y), 1)]
+                       for t, x, y in zip(live["track_id"], live["x"], live["y"])],
+        }, key="live")
+
+detection_worker.add_listener(_on_detections)
+
+# ضبط رویدادمحور: pre-roll در حافظه، فقط رویدادها روی دیسک
+event_recorder = create_event_recorder(frame_hub, EVENT_FOLDER, camera_source, camera_modes,
+                                       prefer=RECORD_ENCODER, fps=30)
+detection_worker.add_listener(event_recorder.on_detections)
+
+def arm_events(count=None, motion=None, aggregation=None, pre_seconds=10.0, post_seconds=10.0):
+    """فعال کردن ضبط رویدادمحور؛ بدون trigger فقط با /events/trigger دستی"""
+    if recording:
+        raise RuntimeError("Recording in progress")
+    event_recorder.pre_seconds = pre_seconds
+    event_recorder.post_seconds = post_seconds
+    triggers = make_triggers(count, motion, aggregation)
+    if count is not None or aggregation is not None:
+        detection_worker.start()
+    event_recorder.arm(triggers)
+    return event_recorder.summary()
+
+def gate_stats():
+    """نسبت فریم‌های رد شده و تخمین CPU صرفه‌جویی شده (encode پیش‌نمایش + تشخیص)"""
+    gate = frame_hub.gate
+    if gate is None:
+        return {"enabled": False}
+    stages = {"encode": frame_hub.encode_ms if frame_hub.subscribers else 0.0}
+    if detection_worker.running and detection_hub is frame_hub:
+        stages["detection"] = particle_detector.summary()["ms_per_frame"]
+    summary = gate.summary(saved_ms_per_frame=sum(stages.values()))
+    summary.update(enabled=True, stages_ms=stages, captured=frame_hub.frames_captured,
+                   published=frame_hub.version)
+    return summary
+
+def gen_frames(adaptive=False, tier=None):
+    """ارسال فریم‌ها برای پیش‌نمایش (adaptive یا tier: انتخاب سطح برای هر کلاینت)"""
+    if adaptive or tier:
+        return preview_tiers.stream(tier)
+    return frame_hub.mjpeg()
+
+_still_lock = Lock()
+_last_still_ms = 0
+
+def _still_timestamp():
+    """زمان با دقت میلی‌ثانیه و یکتا؛ دو عکس در یک ثانیه (یا عکس پیش‌دستی همزمان) روی هم نوشته نمی‌شوند"""
+    global _last_still_ms
+    with _still_lock:
+        ms = max(int(time.time() * 1000), _last_still_ms + 1)
+        _last_still_ms = ms
+    return time.strftime("%Y%m%d-%H%M%S", time.localtime(ms // 1000)) + f"-{ms % 1000:03d}"
 
 def capture_image():
     """گرفتن عکس و ذخیره در USB"""
     if not is_usb_connected():
         raise RuntimeError("حافظه خارجی متصل نیست")
 
-    timestamp = time.strftime("%Y%m%d-%H%M%S")
+    timestamp = _still_timestamp()
     local_path = os.path.join(LOCAL_IMAGE_FOLDER, f"image_{timestamp}.jpg")
     
-    picam2.capture_file(local_path)
+    # عکس در حین ضبط (پیش‌دستی) از همان حالت فعلی گرفته می‌شود تا ضبط قطع نشود
+    stream = camera_modes.prepare("still", mode=camera_modes.current_mode if recording else None)
+    camera_source.capture_file(local_path, name=stream)
 
-    usb_path = move_to_usb(local_path)
-    return usb_path
+    # انتقال در پس‌زمینه؛ پیشرفت با /check_transfer/<id>
+    return move_to_usb(local_path)
 
-def start_recording(duration):
+def capture_burst(count, interval=0.0, fmt="jpg", quality=90, progress=None, cancelled=None):
+    """
+    عکس‌برداری پشت سر هم یا time-lapse از استریم main؛ فایل‌ها دسته‌دسته (با یک نوشتن journal) به صف انتقال می‌روند
+    :param interval: فاصله عکس‌ها (ثانیه)؛ 0 یعنی با حداکثر سرعت
+    :param fmt: 'jpg' دنباله شماره‌دار یا 'npz' قطعه‌های چند عکسی
+    :return: خلاصه burst (فهرست فریم‌ها با t_ms در <name>.json)
+    """
     if not is_usb_connected():
         raise RuntimeError("USB not connected")
+    name = f"burst_{_still_timestamp()}"
+    # مثل capture_image: در حین ضبط حالت فعلی حفظ می‌شود
+    stream = camera_modes.prepare("still", mode=camera_modes.current_mode if recording else None)
+    burst = BurstCapture(camera_source, BURST_FOLDER, fmt=fmt, quality=quality, stream=stream,
+                         on_files=lambda paths: transfer_queue.submit_many(paths, name))
+    return burst.run(count, interval, name=name, progress=progress, cancelled=cancelled)
+
+def capture_raw(frames, stream="lores", plane="y", decimation=1, seconds=None, sample_id="", progress=None,
+                cancelled=None):
+    """
+    ضبط فریم‌های خام در stack memory-mapped (.npy + timestamps + json) مستقیماً روی USB؛
+    stack های چند گیگابایتی دوباره از SD کپی نمی‌شوند و batch_analysis آن‌ها را بدون decode می‌خواند
+    :param frames: ظرفیت stack (کل فایل از اول رزرو می‌شود)
+    :param plane: 'y'، 'bgr' یا 'native'
+    :param decimation: از هر چند فریم دوربین یکی
+    :param seconds: توقف زودتر بعد از این مدت
+    """
+    mount = find_usb_mount()
+    if mount is None:
+        raise RuntimeError("USB not connected")
+    prefix = f"{sample_id}_" if sample_id else "raw_"
+    name = f"{prefix}{time.strftime('%Y%m%d_%H%M%S')}"
+    # مثل capture_image: در حین ضبط حالت فعلی حفظ می‌شود
+    camera_modes.prepare("analysis" if stream == "lores" else "still",
+                         mode=camera_modes.current_mode if recording else None)
+    capture = RawCapture(camera_source, os.path.join(mount, "raw"), stream=stream, plane=plane,
+                         decimation=decimation)
+    return capture.run(frames, name=name, seconds=seconds, progress=progress, cancelled=cancelled)
+
+def _roi_recording(name):
+    """(rect, frame_size) برای ضبط فقط ROI روی استریم main؛ اندازه خروجی حداکثر RECORD_SIZE"""
+    rects = dict(roi_set.pixels(camera_modes.stream_size("main"), align=2))
+    if name not in rects:
+        raise RuntimeError(f"ROI not found: {name}")
+    rect = rects[name]
+    scale = min(1.0, RECORD_SIZE[0] / rect[2], RECORD_SIZE[1] / rect[3])
+    size = (max(2, int(rect[2] * scale) // 2 * 2), max(2, int(rect[3] * scale) // 2 * 2))
+    return rect, size
 
-    config = picam2.create_video_configuration(
-        main={"size": (1920, 1080)},
-        lores={"size": (1024, 768)},
-        display="lores",
-        encode="main"
-    )
-    picam2.configure(config)
-    picam2.start()
-    global recording, video_writer
+def _segment_handoff(stem, sample_id, segment_seconds, segment_bytes, analyse, direct):
+    """manifest و handoff یک ضبط قطعه‌قطعه؛ manifest کنار قطعه‌های محلی و در پایان به USB منتقل می‌شود"""
+    manifest = Manifest(os.path.join(LOCAL_VIDEO_FOLDER, f"{stem}.manifest.json"), stem, fps=30,
+                        sample_id=sample_id, segment_seconds=segment_seconds, segment_bytes=segment_bytes,
+                        storage=STORAGE_MODE)
+    return SegmentHandoff(manifest, transfer_queue, analysis_dir=SEGMENT_RESULTS_FOLDER if analyse else None,
+                          store=results_store, sample_id=sample_id or "unknown", transfer_segments=not direct)
+
+def stop_recording():
+    """پایان ضبط در حال اجرا (ضبط بدون مدت فقط با این تابع تمام می‌شود)"""
+    global recording
+    with recording_lock:
+        if not recording:
+            return False
+        recording = False
+    return True
+
+def start_recording(duration, track=False, sample_id="", roi=None, gate=False, segment_seconds=None,
+                    segment_bytes=None, analyse=False, progress=None):
+    """
+    :param duration: ثانیه؛ 0 یا کمتر یعنی تا stop_recording() (همیشه قطعه‌قطعه، پیش‌فرض SEGMENT_SECONDS)
+    :param segment_seconds: هر چند ثانیه فایل جدید (روی keyframe)
+    :param segment_bytes: یا بعد از این حجم؛ هر قطعه بسته شده فوراً منتقل (و با analyse تحلیل) می‌شود
+    :param progress: progress(fraction یا None، message) در طول ضبط (مثلاً Job.update)
+    """
+    if not is_usb_connected():
+        raise RuntimeError("USB not connected")
+    if event_recorder.armed:
+        raise RuntimeError("Event recording is armed")
+
+    global recording, active_recorder, _results_key
     timestamp = time.strftime("%Y%m%d_%H%M%S")
-    local_path = os.path.join(LOCAL_VIDEO_FOLDER, f"video_{timestamp}.mp4")
+    prefix = f"{sample_id}_" if sample_id else "video_"
+    local_path = os.path.join(LOCAL_VIDEO_FOLDER, f"{prefix}{timestamp}.mp4")
     os.makedirs(LOCAL_VIDEO_FOLDER, exist_ok=True)  # Ensure folder exists
 
+    direct = STORAGE_MODE == "direct"
+    if duration <= 0 and not (segment_seconds or segment_bytes):
+        segment_seconds = SEGMENT_SECONDS
+    handoff = None
+    segment_kwargs = {}
+    if segment_seconds or segment_bytes:
+        handoff = _segment_handoff(f"{prefix}{timestamp}", sample_id, segment_seconds, segment_bytes,
+                                   analyse, direct)
+        segment_kwargs = dict(segment_seconds=segment_seconds, segment_bytes=segment_bytes, on_segment=handoff)
+    # OpenCVRecorder قطعه‌بندی ندارد
+    encoder = "pipeline" if handoff is not None and RECORD_ENCODER == "opencv" else RECORD_ENCODER
+    # gate: فریم‌های بدون تغییر کپی/تبدیل نمی‌شوند و در فایل با فریم قبلی پر می‌شوند (فقط pipeline)
+    change_gate = _change_gate(keyframe_interval=None) if gate else None
+    if roi:
+        # encoder سخت‌افزاری برش نمی‌دهد؛ ROI با pipeline ضبط می‌شود
+        rect, size = _roi_recording(roi)
+        recorder = create_recorder(camera_source, camera_modes, prefer="pipeline",
+                                   frame_size=size, fps=30, roi=rect, gate=change_gate, **segment_kwargs)
+    elif change_gate is not None:
+        recorder = create_recorder(camera_source, camera_modes, prefer="pipeline",
+                                   frame_size=RECORD_SIZE, fps=30, gate=change_gate, **segment_kwargs)
+    else:
+        # H.264 سخت‌افزاری روی Pi، در غیر این صورت pipeline سه مرحله‌ای با cv2.VideoWriter
+        kwargs = dict(segment_kwargs)
+        if encoder == "h264" and hardware_encoder_available(camera_source):
+            if direct:
+                kwargs.update(sink=direct_writer, segment_seconds=segment_seconds or SEGMENT_SECONDS)
+                # قطعه هنگام بسته شدن هنوز روی USB کامل نشده؛ تحلیل فقط برای قطعه‌های محلی
+                if handoff is not None:
+                    handoff.analysis_dir = None
+                    handoff.expect_stored = True
+                direct_writer.on_segment = handoff.stored if handoff is not None else None
+            elif handoff is not None:
+                kwargs.update(sink=LocalSink(LOCAL_VIDEO_FOLDER))
+        recorder = create_recorder(camera_source, camera_modes, prefer=encoder,
+                                   frame_size=RECORD_SIZE, fps=30, **kwargs)
+    sink = getattr(recorder, "sink", None)
+    if direct and sink is None:
+        # VideoWriter فقط مسیر فایل می‌پذیرد؛ فایل مستقیم روی USB نوشته می‌شود (کش صفحه write-behind است)
+        mount = find_usb_mount()
+        if mount is not None:
+            local_path = os.path.join(mount, os.path.basename(local_path))
+        else:
+            # فلش بعد از بررسی اول جدا شد: ضبط روی SD و بعد با صف انتقال، مثل حالت temp
+            print("[Direct Storage]: USB disappeared before recording, writing to SD instead")
+            direct = False
+            if handoff is not None:
+                handoff.transfer_segments = True
 
-    # Get camera resolution dynamically
-    test_frame = picam2.capture_array("main")
-    frame_size = (test_frame.shape[1], test_frame.shape[0])  # (width, height)
-    fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-    fps = 10
+    if track:
+        # مسیرها از شروع همین ضبط
+        particle_tracker.reset()
+        _results_key = (sample_id or "unknown", os.path.splitext(os.path.basename(local_path))[0])
+        detection_worker.start()
 
     with recording_lock:
-        video_writer = cv2.VideoWriter(local_path, fourcc, fps, frame_size)
-        if not video_writer.isOpened():  # Critical check!
-            raise RuntimeError(f"VideoWriter failed for {local_path}")
+        recorder.start(local_path)
+        active_recorder = recorder
         recording = True
 
     start_time = time.time()
     try:
-        while recording and (time.time() - start_time) < duration:
-            frame = picam2.capture_array("main")
-            if frame is None:  # Check for empty frames
-                print("Warning: Empty frame captured")
-                continue
-            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-            with recording_lock:
-                if video_writer is not None:
-                    video_writer.write(frame)
-            time.sleep(1 / fps*2)
+        while recording and recorder.recording and (duration <= 0 or (time.time() - start_time) < duration):
+            if progress is not None:
+                elapsed = time.time() - start_time
+                progress(elapsed / duration if duration > 0 else None, f"recording {elapsed:.0f}s")
+            time.sleep(0.1)
     except Exception as e:
         print("Recording error:", str(e))
         raise
     finally:
         with recording_lock:
             recording = False
-            if video_writer is not None:
-                video_writer.release()
-                video_writer = None
-                
-        config = picam2.create_video_configuration(
-        main={"size": (3840, 2160)},
-        lores={"size": (1024, 768)},
-        display="lores",
-        encode="main"
-    )
-    picam2.configure(config)
-    picam2.start()
-
-    usb_path = move_to_usb(local_path)
-    return usb_path
\ No newline at end of file
+            active_recorder = None
+            stats = recorder.stop()
+        if sink is direct_writer:
+            # آخرین قطعه‌ها قبل از handoff.finish روی USB commit شوند تا manifest با وضعیت نهایی منتقل شود
+            if not direct_writer.close(timeout=60):
+                print("[Direct Storage]: segments still pending after recording; manifest follows when they finish")
+            direct_writer.on_segment = None
+        print(f"Recording saved: {local_path} {stats}")
+        if track:
+            key, _results_key = _results_key, None
+            results_store.append("tracks", particle_tracker.track_summary(), *key)
+            results_store.flush()
+            results_store.compact("detections", *key)
+            print(f"Tracking: {particle_tracker.summary()} results: {results_store.summary()}")
+    if stats.get("error"):
+        # فایل نیمه‌کاره روی SD می‌ماند؛ job شکست خورده گزارش می‌شود نه ضبط موفق
+        raise RuntimeError(f"Recording failed: {stats['error']}")
+
+    if handoff is not None:
+        # قطعه‌ها در طول ضبط منتقل شده‌اند؛ manifest بعد از آخرین قطعه می‌رود
+        handoff.finish(duration_s=time.time() - start_time)
+        return {"id": None, "name": handoff.manifest.data["stem"], "state": "segmented",
+                "manifest": os.path.basename(handoff.manifest.path),
+                "segments": [entry["name"] for entry in handoff.manifest.data["segments"]],
+                "handoff": handoff.summary()}
+
+    if direct:
+        result = {"id": None, "name": os.path.basename(local_path), "state": "direct", "path": local_path}
+        if sink is not None:
+            result.update(name=os.path.splitext(result["name"])[0], path=None,
+                          segments=list(recorder.segments.names), storage=sink.summary())
+        return result
+
+    # انتقال در پس‌زمینه؛ پیشرفت با /check_transfer/<id>
+    return move_to_usb(local_path)
+
+# -----------------------
+# کارهای زمان‌بندی شده: درخواست‌ها فوراً برمی‌گردند و lane دوربین کارها را یکی‌یکی اجرا می‌کند
+# -----------------------
+jobs = JobScheduler(lanes=("camera", "analysis"))
+# پیشرفت ضبط و تحلیل با key همان job
+jobs.add_listener(lambda job: event_bus.publish("job", job, key=job["id"]))
+jobs.start()
+
+def _capture_job(job):
+    job.update(message="capturing")
+    return capture_image()
+
+def _record_job(job, duration, **kwargs):
+    def progress(fraction, message):
+        # لغو قبل از شروع ضبط هم دیده می‌شود چون این تابع در هر دور حلقه ضبط صدا زده می‌شود
+        if job.cancelled:
+            stop_recording()
+        job.update(fraction, message)
+    job.on_cancel = stop_recording
+    return start_recording(duration, progress=progress, **kwargs)
+
+def _burst_job(job, count, **kwargs):
+    return capture_burst(count, progress=job.update, cancelled=lambda: job.cancelled, **kwargs)
+
+def _raw_job(job, frames, **kwargs):
+    return capture_raw(frames, progress=job.update, cancelled=lambda: job.cancelled, **kwargs)
+
+def _analysis_job(job, patterns, sample_id=None):
+    from batch_analysis import analyse
+    return analyse(patterns, ANALYSIS_FOLDER, store=results_store, sample_id=sample_id, progress=job.update)
+
+def submit_capture():
+    """عکس با اولویت بالا؛ اگر ضبطی در حال اجراست منتظر پایان آن نمی‌ماند"""
+    return jobs.submit("capture", _capture_job, priority="high", preempt=True)
+
+def submit_recording(duration, **kwargs):
+    """ضبط در صف lane دوربین (آرگومان‌ها مثل start_recording)"""
+    return jobs.submit("record", _record_job, (duration,), kwargs, preemptible=True)
+
+def submit_burst(count, **kwargs):
+    """burst در صف lane دوربین (آرگومان‌ها مثل capture_burst)؛ عکس تکی می‌تواند در میان آن گرفته شود"""
+    return jobs.submit("burst", _burst_job, (count,), kwargs, preemptible=True)
+
+def submit_raw(frames, **kwargs):
+    """ضبط خام در صف lane دوربین (آرگومان‌ها مثل capture_raw)"""
+    return jobs.submit("raw", _raw_job, (frames,), kwargs, preemptible=True)
+
+def submit_analysis(patterns, sample_id=None):
+    """تحلیل دسته‌ای فایل‌های ضبط شده در lane جدا با اولویت پایین"""
+    return jobs.submit("analysis", _analysis_job, (patterns,), {"sample_id": sample_id}, priority="low",
+                       lane="analysis")
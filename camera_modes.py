@@ -0,0 +1,110 @@
+#! /usr/bin/env python3
+"""
+camera_modes.py
+مدیریت حالت دوربین: یک پیکربندی دو استریمی (main 4K + lores) همیشه روشن می‌ماند
+و عکس، ضبط و پیش‌نمایش از استریم مناسب سرویس می‌گیرند، بدون stop/configure/sleep
+تغییر حالت فقط وقتی واقعاً لازم است انجام می‌شود و زمان هر عمل به عنوان metric ثبت می‌شود
+"""
+
+import time
+from threading import RLock
+
+# -----------------------
+# حالت‌های از پیش تعریف شده
+# -----------------------
+DEFAULT_MODES = {
+    # حالت دائمی: عکس و ضبط از main، پیش‌نمایش و تحلیل از lores
+    "dual": {"main_size": (3840, 2160), "lores_size": (1024, 768)},
+    # فقط برای encoder سخت‌افزاری که بیشتر از 1080p را نمی‌پذیرد
+    "video": {"main_size": (1920, 1080), "lores_size": (1024, 768)},
+}
+
+# هر عمل از کدام استریم می‌خواند
+ACTION_STREAMS = {
+    "still": "main",
+    "record": "main",
+    "preview": "lores",
+    "analysis": "lores",
+}
+
+
+class CameraModeManager:
+    def __init__(self, source, modes=None, default_mode="dual"):
+        self.source = source
+        self.modes = dict(DEFAULT_MODES)
+        if modes:
+            self.modes.update(modes)
+        self.default_mode = default_mode
+        self.current_mode = None
+        self._lock = RLock()
+        self.metrics = {}
+        self._listeners = []
+
+        # اندازه‌ها را تنظیم می‌کنیم؛ منبع تا اولین capture باز نمی‌شود
+        self.ensure_mode(default_mode, action="startup")
+
+    def add_listener(self, fn):
+        """fn(mode, action, elapsed) بعد از هر تغییر واقعی حالت"""
+        self._listeners.append(fn)
+
+    def add_mode(self, name, main_size, lores_size):
+        self.modes[name] = {"main_size": tuple(main_size), "lores_size": tuple(lores_size)}
+
+    def ensure_mode(self, mode=None, action="switch"):
+        """
+        اگر حالت فعلی با mode فرق دارد تغییر می‌دهد
+        :return: زمان صرف شده بر حسب ثانیه (تقریباً صفر وقتی تغییری لازم نیست)
+        """
+        mode = mode or self.default_mode
+        with self._lock:
+            start = time.monotonic()
+            switched = mode != self.current_mode
+            if switched:
+                self.source.configure(**self.modes[mode])
+                self.current_mode = mode
+            elapsed = time.monotonic() - start
+            self._record(action, elapsed, switched)
+        if switched:
+            for fn in self._listeners:
+                try:
+                    fn(mode, action, elapsed)
+                except Exception as e:
+                    print(f"[Camera Mode Listener Error]: {e}")
+        return elapsed
+
+    def prepare(self, action, mode=None):
+        """
+        آماده‌سازی برای یک عمل
+        :return: نام استریمی که عمل باید از آن بخواند
+        """
+        self.ensure_mode(mode, action=action)
+        return ACTION_STREAMS.get(action, "main")
+
+    def restore(self):
+        """بازگشت به حالت دائمی بعد از عملی که مجبور به تغییر حالت بود"""
+        return self.ensure_mode(self.default_mode, action="restore")
+
+    def stream_size(self, stream):
+        return self.source.sizes[stream]
+
+    # -----------------------
+    # metric تأخیر هر عمل
+    # -----------------------
+    def _record(self, action, elapsed, switched):
+        m = self.metrics.setdefault(action, {
+            "count": 0, "switches": 0, "total_ms": 0.0, "last_ms": 0.0, "max_ms": 0.0
+        })
+        ms = elapsed * 1000
+        m["count"] += 1
+        m["switches"] += int(switched)
+        m["total_ms"] += ms
+        m["last_ms"] = ms
+        m["max_ms"] = max(m["max_ms"], ms)
+
+    def get_metrics(self):
+        """خلاصه تأخیر تغییر حالت برای هر عمل"""
+        with self._lock:
+            result = {}
+            for action, m in self.metrics.items():
+                result[action] = dict(m, mean_ms=m["total_ms"] / m["count"] if m["count"] else 0.0)
+            return {"mode": self.current_mode, "actions": result}
@@ -0,0 +1,175 @@
+#! /usr/bin/env python3
+"""
+change_gate.py
+تشخیص تغییر ارزان برای رد کردن فریم‌های بدون تغییر (مثلاً دوره‌های طولانی ته‌نشینی)
+فریم به یک تصویر خیلی کوچک (پیش‌فرض 64x48) تبدیل و با آخرین فریم «عبور کرده» مقایسه می‌شود؛
+چون مرجع فقط با فریم‌های عبور کرده عوض می‌شود، تغییر آهسته هم در نهایت انباشته و دیده می‌شود
+
+روش‌ها:
+    diff   اختلاف هر خانه تصویر کوچک؛ هر خانه معادل یک بلوک 16x16 است، پس نویز سنسور میانگین
+           گرفته می‌شود ولی جابجایی حتی یک ذره کوچک میانگین آن بلوک را عوض می‌کند
+    hash   dHash شصت و چهار بیتی و فاصله همینگ (کم‌حساس‌تر به تغییر نور کلی)
+
+مصرف‌کننده‌ها (FrameHub، RecordingPipeline) فریم رد شده را منتشر/تبدیل نمی‌کنند و
+نتیجه قبلی (JPEG، تشخیص، فریم تبدیل شده) دوباره استفاده می‌شود
+"""
+
+import time
+import cv2
+import numpy as np
+
+METHODS = ("diff", "hash")
+
+
+class ChangeGate:
+    def __init__(self, method="diff", size=(64, 48), cell_threshold=4, min_cells=1,
+                 hash_bits=3, keyframe_interval=1.0):
+        """
+        :param cell_threshold: اختلاف سطح خاکستری یک خانه برای «تغییر کرده» (روش diff)
+        :param min_cells: حداقل خانه‌های تغییر کرده برای عبور فریم
+        :param hash_bits: حداقل فاصله همینگ برای عبور (روش hash)
+        :param keyframe_interval: حداکثر فاصله بین دو فریم عبور کرده (ثانیه)، تا کلاینت‌ها
+                                  و timeline حتی در صحنه کاملاً ثابت به‌روز بمانند؛ None یعنی بدون سقف
+        """
+        if method not in METHODS:
+            raise ValueError(f"Unknown change gate method: {method}")
+        self.method = method
+        self.size = size
+        self.cell_threshold = cell_threshold
+        self.min_cells = min_cells
+        self.hash_bits = hash_bits
+        self.keyframe_interval = keyframe_interval
+
+        self._reference = None
+        self._last_pass = None
+        self._small = np.empty((size[1], size[0]), np.uint8)
+        self._diff = np.empty((size[1], size[0]), np.uint8)
+
+        self.frames = 0
+        self.skipped = 0
+        self.busy = 0.0
+        self.last_score = 0.0
+
+    def _thumbnail(self, frame, fmt=None):
+        if fmt == "YUV420" and frame.ndim == 2:
+            frame = frame[:frame.shape[0] * 2 // 3]
+        h, w = frame.shape[:2]
+        # نمونه‌برداری با گام قبل از resize تا برای 4K هم فقط چند هزار پیکسل خوانده شود
+        sy = max(1, h // (self.size[1] * 4))
+        sx = max(1, w // (self.size[0] * 4))
+        view = frame[::sy, ::sx]
+        if view.ndim == 3:
+            view = cv2.resize(view, self.size, interpolation=cv2.INTER_AREA)
+            code = cv2.COLOR_BGRA2GRAY if view.shape[2] == 4 else cv2.COLOR_RGB2GRAY
+            return cv2.cvtColor(view, code, dst=self._small)
+        return cv2.resize(view, self.size, dst=self._small, interpolation=cv2.INTER_AREA)
+
+    @staticmethod
+    def _dhash(small):
+        tiny = cv2.resize(small, (9, 8), interpolation=cv2.INTER_AREA)
+        return np.packbits(tiny[:, 1:] > tiny[:, :-1])
+
+    def changed(self, frame, fmt=None, now=None):
+        """True اگر فریم باید پردازش شود (تغییر کرده، اولین فریم، یا keyframe)"""
+        t0 = time.perf_counter()
+        now = time.monotonic() if now is None else now
+        small = self._thumbnail(frame, fmt)
+        self.frames += 1
+
+        if self.method == "hash":
+            signature = self._dhash(small)
+            if self._reference is None:
+                changed = True
+            else:
+                self.last_score = int(np.unpackbits(signature ^ self._reference).sum())
+                changed = self.last_score >= self.hash_bits
+        else:
+            signature = small
+            if self._reference is None:
+                changed = True
+            else:
+                cv2.absdiff(small, self._reference, dst=self._diff)
+                self.last_score = int(np.count_nonzero(self._diff > self.cell_threshold))
+                changed = self.last_score >= self.min_cells
+
+        if not changed and self.keyframe_interval is not None and now - self._last_pass >= self.keyframe_interval:
+            changed = True
+        if changed:
+            self._reference = signature.copy()
+            self._last_pass = now
+        else:
+            self.skipped += 1
+        self.busy += time.perf_counter() - t0
+        return changed
+
+    def reset(self):
+        self._reference = None
+
+    @property
+    def skip_ratio(self):
+        return self.skipped / self.frames if self.frames else 0.0
+
+    def summary(self, saved_ms_per_frame=None):
+        """
+        :param saved_ms_per_frame: هزینه پردازش پایین‌دست هر فریم (ms) برای تخمین CPU صرفه‌جویی شده
+        """
+        summary = {
+            "method": self.method,
+            "frames": self.frames,
+            "skipped": self.skipped,
+            "skip_ratio": self.skip_ratio,
+            "gate_ms_per_frame": 1000 * self.busy / self.frames if self.frames else 0.0,
+            "last_score": self.last_score,
+        }
+        if saved_ms_per_frame is not None:
+            summary["saved_ms_per_frame"] = saved_ms_per_frame
+            summary["cpu_saved_ms"] = self.skipped * saved_ms_per_frame - self.busy * 1000
+        return summary
+
+
+if __name__ == "__main__":
+    # بنچمارک: دوره ته‌نشینی (صحنه ثابت با نویز سنسور) بعد از چند ثانیه حرکت
+    import argparse
+    from frame_source import create_source
+    from particle_detector import ParticleDetector, to_gray
+
+    parser = argparse.ArgumentParser(description="Change gate benchmark on a mostly static scene")
+    parser.add_argument("--frames", type=int, default=600)
+    parser.add_argument("--moving", type=float, default=0.1, help="کسر فریم‌هایی که ذرات حرکت می‌کنند")
+    parser.add_argument("--method", default="diff", choices=METHODS)
+    parser.add_argument("--noise", type=float, default=2.0, help="انحراف معیار نویز سنسور")
+    args = parser.parse_args()
+
+    source = create_source("synthetic", realtime=False)
+    rng = np.random.default_rng(0)
+    moving = int(args.frames * args.moving)
+    base = [cv2.cvtColor(source.capture_array("lores"), cv2.COLOR_YUV420p2RGB) for _ in range(moving + 1)]
+    noise = [rng.normal(0, args.noise, base[0].shape).astype(np.int16) for _ in range(8)]
+
+    def frame_at(i):
+        src = base[min(i, moving)]
+        return np.clip(src.astype(np.int16) + noise[i % len(noise)], 0, 255).astype(np.uint8)
+
+    frames = [frame_at(i) for i in range(args.frames)]
+    detector = ParticleDetector()
+
+    def downstream(frame):
+        cv2.imencode('.jpg', frame, [int(cv2.IMWRITE_JPEG_QUALITY), 80])
+        detector.detect(to_gray(frame))
+
+    t0 = time.process_time()
+    for frame in frames:
+        downstream(frame)
+    baseline = time.process_time() - t0
+
+    gate = ChangeGate(args.method, keyframe_interval=None)
+    t0 = time.process_time()
+    for frame in frames:
+        if gate.changed(frame):
+            downstream(frame)
+    gated = time.process_time() - t0
+
+    s = gate.summary(1000 * baseline / args.frames)
+    print(f"frames={args.frames} moving={moving} skipped={s['skipped']} ({100 * s['skip_ratio']:.1f}%)  "
+          f"gate={s['gate_ms_per_frame']:.3f} ms/frame")
+    print(f"CPU: every frame {baseline:.2f}s, gated {gated:.2f}s -> saved {100 * (1 - gated / baseline):.1f}%")
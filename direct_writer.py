@@ -0,0 +1,432 @@
+#! /usr/bin/env python3
+"""
+direct_writer.py
+نوشتن مستقیم خروجی encoder روی حافظه USB با بافر write-behind، بدون نوشتن موقت روی کارت SD
+
+حالت قبلی (temp-copy): کل فایل روی SD نوشته و بعد دوباره روی USB کپی می‌شود (دو برابر I/O و
+فرسایش SD برای کلیپ‌های چند گیگابایتی 4K). اینجا خروجی به قطعه‌ها (segment) تقسیم می‌شود و:
+    - encoder فقط در حافظه می‌نویسد (write غیرمسدودکننده)؛ یک رشته I/O قطعه را روی USB می‌نویسد،
+      fsync و از .part به نام نهایی rename می‌کند
+    - بایت‌های هر قطعه تا fsync شدن روی USB در حافظه می‌مانند؛ اگر فلش جدا شود، خطای I/O بدهد
+      یا آن‌قدر کند باشد که حافظه از memory_bytes بیشتر شود، همان قطعه کامل روی SD (محل spill)
+      نوشته و به صف انتقال سپرده می‌شود، پس داده‌ای از دست نمی‌رود
+    - قطعه‌هایی که وقتی فلش وصل نیست باز می‌شوند مستقیماً روی SD نوشته می‌شوند
+پس SD فقط وقتی نوشته می‌شود که USB کند یا غایب است
+
+اندازه قطعه (segment_seconds × bitrate) باید کمتر از memory_bytes باشد
+"""
+
+import os
+import time
+import queue
+from threading import Lock, Thread
+
+
+class _Segment:
+    """یک فایل خروجی؛ رابط file-like (write، close) برای encoder"""
+
+    def __init__(self, sink, name, subdir):
+        self.sink = sink
+        self.name = name
+        self.subdir = subdir
+        self.lock = Lock()
+        self.mode = "direct"
+        self.retained = []       # بایت‌هایی که هنوز روی USB fsync نشده‌اند
+        self.retained_bytes = 0
+        self.size = 0
+        self.dest = None         # مسیر نهایی روی USB
+        self.usb = None          # فایل .part روی USB (فقط در رشته I/O)
+        self.spill = None        # فایل روی SD
+        self.spill_path = None
+        self.closed = False
+        self.state = "writing"   # writing، done، spilled، failed
+        self.error = None
+        # callback همان ضبطی که قطعه را باز کرد؛ callback ضبط بعدی گزارش دیرهنگام این قطعه را نمی‌گیرد
+        self.on_segment = sink.on_segment
+
+    def write(self, data):
+        data = bytes(data)  # بافر encoder دوباره استفاده می‌شود
+        with self.lock:
+            self.size += len(data)
+            if self.mode == "spill":
+                self.spill.write(data)
+                self.sink.bytes_sd += len(data)
+                return len(data)
+            self.retained.append(data)
+            self.retained_bytes += len(data)
+        self.sink._enqueue(self, data)
+        if self.sink.retained_bytes > self.sink.memory_bytes:
+            # USB عقب مانده؛ به جای رشد نامحدود حافظه این قطعه روی SD ادامه پیدا می‌کند
+            self.sink._divert(self, "write-behind buffer full")
+        return len(data)
+
+    @property
+    def path(self):
+        return self.spill_path if self.mode == "spill" else self.dest
+
+    def flush(self):
+        pass
+
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            spilled = self.mode == "spill"
+        if spilled:
+            self.sink._finish_spill(self)
+        self.sink._enqueue(self, None)
+
+    def summary(self):
+        return {"name": self.name, "state": self.state, "mode": self.mode, "bytes": self.size,
+                "path": self.dest if self.state == "done" else self.spill_path, "error": self.error}
+
+
+class DirectWriter:
+    def __init__(self, resolve_dest, spill_dir, transfers=None, subdir="", memory_bytes=64 << 20,
+                 fsync=True, on_segment=None):
+        """
+        :param resolve_dest: تابع resolve_dest() -> پوشه ریشه USB یا None
+        :param spill_dir: پوشه روی SD برای قطعه‌هایی که مستقیم نوشته نشدند
+        :param transfers: TransferQueue برای انتقال بعدی قطعه‌های spill شده (None یعنی روی SD بمانند)
+        :param memory_bytes: حداکثر بایت نگه داشته شده در حافظه برای همه قطعه‌ها
+        :param on_segment: on_segment(segment_summary) بعد از بسته شدن هر قطعه (برای قطعه‌هایی که
+                           از این به بعد باز می‌شوند)
+        """
+        self.resolve_dest = resolve_dest
+        self.spill_dir = spill_dir
+        self.transfers = transfers
+        self.subdir = subdir
+        self.memory_bytes = memory_bytes
+        self.fsync = fsync
+        self.on_segment = on_segment
+
+        self._queue = queue.Queue()
+        self._lock = Lock()
+        self._thread = None
+        self.segments = []
+
+        # آمار
+        self.retained_bytes = 0
+        self.bytes_in = 0
+        self.bytes_usb = 0
+        self.bytes_sd = 0
+        self.busy = 0.0
+        self.started = None
+
+    def open(self, name, subdir=None):
+        """باز کردن یک قطعه جدید؛ اگر فلش وصل نیست از ابتدا روی SD نوشته می‌شود"""
+        self.start()
+        segment = _Segment(self, name, self.subdir if subdir is None else subdir)
+        with self._lock:
+            self.segments.append(segment)
+        root = self.resolve_dest()
+        if root:
+            folder = os.path.join(root, segment.subdir) if segment.subdir else root
+            segment.dest = os.path.join(folder, name)
+        else:
+            self._divert(segment, "destination not available")
+        return segment
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self.started = time.monotonic()
+            self._thread = Thread(target=self._run, name="direct-writer", daemon=True)
+            self._thread.start()
+
+    def close(self, timeout=None):
+        """صبر تا نوشته شدن همه قطعه‌های بسته شده"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self._queue.unfinished_tasks:
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+            time.sleep(0.02)
+        return True
+
+    def _enqueue(self, segment, data):
+        if data is not None:
+            with self._lock:
+                self.retained_bytes += len(data)
+                self.bytes_in += len(data)
+        self._queue.put((segment, data))
+
+    def _release(self, segment):
+        """آزاد کردن بایت‌های نگه داشته شده قطعه (صدا زده شده با segment.lock)"""
+        with self._lock:
+            self.retained_bytes -= segment.retained_bytes
+        segment.retained = []
+        segment.retained_bytes = 0
+
+    def _divert(self, segment, reason):
+        """ادامه قطعه روی SD؛ همه بایت‌های fsync نشده از حافظه روی فایل spill نوشته می‌شوند"""
+        with segment.lock:
+            if segment.mode == "spill":
+                return
+            os.makedirs(self.spill_dir, exist_ok=True)
+            segment.spill_path = os.path.join(self.spill_dir, segment.name)
+            segment.spill = open(segment.spill_path, "wb")
+            for data in segment.retained:
+                segment.spill.write(data)
+                self.bytes_sd += len(data)
+            segment.mode = "spill"
+            segment.error = reason
+            self._release(segment)
+            closed = segment.closed
+        print(f"[Direct Writer] {segment.name} spilled to SD: {reason}")
+        if closed:
+            self._finish_spill(segment)
+
+    def _finish_spill(self, segment):
+        try:
+            segment.spill.flush()
+            os.fsync(segment.spill.fileno())
+            segment.spill.close()
+        except OSError as e:
+            segment.state, segment.error = "failed", str(e)
+            print(f"[Direct Writer Error]: {e}")
+            return
+        segment.state = "spilled"
+        if self.transfers is not None:
+            self.transfers.submit(segment.spill_path, segment.subdir)
+        self._notify(segment)
+
+    def _notify(self, segment):
+        if segment.on_segment is not None:
+            try:
+                segment.on_segment(segment.summary())
+            except Exception as e:
+                print(f"[Direct Writer Callback Error]: {e}")
+
+    # -----------------------
+    # رشته I/O
+    # -----------------------
+    def _run(self):
+        while True:
+            segment, data = self._queue.get()
+            t0 = time.monotonic()
+            try:
+                if segment.mode == "direct":
+                    if data is None:
+                        self._commit(segment)
+                    else:
+                        self._write_usb(segment, data)
+                elif data is None:
+                    self._discard_usb(segment)
+            except OSError as e:
+                # فلش جدا شد یا خطای نوشتن؛ قطعه از حافظه روی SD نوشته می‌شود
+                self._discard_usb(segment)
+                self._divert(segment, str(e))
+            finally:
+                self.busy += time.monotonic() - t0
+                self._queue.task_done()
+
+    def _write_usb(self, segment, data):
+        if segment.usb is None:
+            os.makedirs(os.path.dirname(segment.dest), exist_ok=True)
+            segment.usb = open(segment.dest + ".part", "wb")
+        segment.usb.write(data)
+        self.bytes_usb += len(data)
+
+    def _commit(self, segment):
+        if segment.usb is None:
+            # قطعه خالی
+            os.makedirs(os.path.dirname(segment.dest), exist_ok=True)
+            segment.usb = open(segment.dest + ".part", "wb")
+        segment.usb.flush()
+        if self.fsync:
+            os.fsync(segment.usb.fileno())
+        segment.usb.close()
+        segment.usb = None
+        with segment.lock:
+            if segment.mode != "direct":
+                return
+            os.replace(segment.dest + ".part", segment.dest)
+            segment.state = "done"
+            self._release(segment)
+        self._notify(segment)
+
+    def _discard_usb(self, segment):
+        if segment.usb is None:
+            return
+        try:
+            segment.usb.close()
+            os.remove(segment.dest + ".part")
+        except OSError:
+            pass
+        segment.usb = None
+
+    def summary(self):
+        elapsed = time.monotonic() - self.started if self.started else 0.0
+        states = {}
+        for segment in list(self.segments):
+            states[segment.state] = states.get(segment.state, 0) + 1
+        return {
+            "segments": states,
+            "bytes_in": self.bytes_in,
+            "bytes_usb": self.bytes_usb,
+            "bytes_sd": self.bytes_sd,
+            "buffered_bytes": self.retained_bytes,
+            "pending_writes": self._queue.qsize(),
+            "usb_mb_per_s": self.bytes_usb / self.busy / 2**20 if self.busy else 0.0,
+            "elapsed_s": elapsed,
+        }
+
+
+class SegmentWriter:
+    """
+    تقسیم یک جریان encode شده به قطعه‌ها، فقط روی keyframe (هر قطعه مستقلاً قابل پخش است؛
+    برای H.264 خام encoder باید SPS/PPS را روی هر keyframe تکرار کند)
+    """
+
+    def __init__(self, sink, stem, ext=".h264", segment_seconds=10.0, subdir=None, segment_bytes=None,
+                 on_segment=None):
+        """
+        :param sink: DirectWriter یا هر شیء با open(name, subdir) -> فایل
+        :param segment_bytes: قطعه بعد از این حجم هم (روی keyframe بعدی) بسته می‌شود
+        :param on_segment: on_segment(dict) بعد از بستن هر قطعه با index، name، start_ns، end_ns، frames، bytes
+        """
+        self.sink = sink
+        self.stem = stem
+        self.ext = ext
+        self.segment_seconds = segment_seconds
+        self.segment_bytes = segment_bytes
+        self.subdir = subdir
+        self.on_segment = on_segment
+        self.index = 0
+        self._file = None
+        self._info = None
+        self.names = []
+
+    def _full(self, timestamp):
+        info = self._info
+        if self.segment_seconds and timestamp - info["start_ns"] / 1e9 >= self.segment_seconds:
+            return True
+        return bool(self.segment_bytes) and info["bytes"] >= self.segment_bytes
+
+    def write(self, data, keyframe=True, timestamp=None):
+        """:param timestamp: ثانیه (None یعنی ساعت monotonic)"""
+        timestamp = time.monotonic() if timestamp is None else timestamp
+        if self._file is None or (keyframe and self._full(timestamp)):
+            self.close()
+            self.index += 1
+            name = f"{self.stem}_{self.index:04d}{self.ext}"
+            self._file = self.sink.open(name, self.subdir)
+            path = getattr(self._file, "path", None) or getattr(self._file, "name", None)
+            self._info = {"index": self.index, "name": name, "path": path,
+                          "start_ns": int(timestamp * 1e9), "end_ns": None, "frames": 0, "bytes": 0}
+            self.names.append(name)
+        self._file.write(data)
+        self._info["end_ns"] = int(timestamp * 1e9)
+        self._info["frames"] += 1
+        self._info["bytes"] += len(data)
+
+    def close(self):
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+        if self.on_segment is not None:
+            try:
+                self.on_segment(dict(self._info))
+            except Exception as e:
+                print(f"[Segment Callback Error]: {e}")
+
+
+def picamera2_output(segments):
+    """خروجی picamera2 که بسته‌های encoder را به SegmentWriter می‌دهد"""
+    from picamera2.outputs import Output
+
+    class SegmentedOutput(Output):
+        def outputframe(self, frame, keyframe=True, timestamp=None, *args, **kwargs):
+            # timestamp picamera2 میکروثانیه است
+            segments.write(frame, keyframe, None if timestamp is None else timestamp / 1e6)
+
+        def stop(self):
+            super().stop()
+            segments.close()
+
+    return SegmentedOutput()
+
+
+if __name__ == "__main__":
+    # بنچمارک: temp-copy (SD سپس کپی به USB) در برابر نوشتن مستقیم، و مستقیم با USB کند
+    # SD و USB با دو پوشه شبیه‌سازی می‌شوند (--sd و --usb برای دیسک‌های واقعی)
+    import argparse
+    import shutil
+    import tempfile
+    from transfer_queue import TransferQueue
+
+    parser = argparse.ArgumentParser(description="Direct-to-USB vs temp-then-copy recording")
+    parser.add_argument("--seconds", type=float, default=10, help="طول کلیپ شبیه‌سازی شده")
+    parser.add_argument("--mbps", type=float, default=40, help="bitrate encoder")
+    parser.add_argument("--fps", type=int, default=30)
+    parser.add_argument("--segment", type=float, default=5.0)
+    parser.add_argument("--slow-mb-per-s", type=float, default=2.0, help="سرعت USB کند")
+    parser.add_argument("--sd", default=None)
+    parser.add_argument("--usb", default=None)
+    args = parser.parse_args()
+
+    sd = args.sd or tempfile.mkdtemp(prefix="sd_")
+    usb = args.usb or tempfile.mkdtemp(prefix="usb_")
+    frame = os.urandom(int(args.mbps * 1e6 / 8 / args.fps))
+    frames = int(args.seconds * args.fps)
+    clip_mb = len(frame) * frames / 2**20
+
+    def encode(write):
+        """encoder با سرعت واقعی (fps)؛ هر fps فریم یک keyframe"""
+        start = time.monotonic()
+        for i in range(frames):
+            delay = start + i / args.fps - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            write(frame, i % args.fps == 0, i / args.fps)
+        return time.monotonic()
+
+    def report(name, t0, encoded, sd_bytes, usb_bytes):
+        now = time.monotonic()
+        print(f"{name:18s} clip={clip_mb:6.1f} MB  on USB {now - encoded:5.2f}s after clip end "
+              f"({clip_mb / (now - t0):5.1f} MB/s)  SD written={sd_bytes / 2**20:6.1f} MB  "
+              f"USB written={usb_bytes / 2**20:6.1f} MB")
+
+    # temp-copy: کل کلیپ روی SD، بعد صف انتقال
+    transfers = TransferQueue(os.path.join(sd, "transfers.json"), lambda: usb, verify=False)
+    t0 = time.monotonic()
+    path = os.path.join(sd, "clip.h264")
+    with open(path, "wb") as f:
+        encoded = encode(lambda data, keyframe, ts: f.write(data))
+        f.flush()
+        os.fsync(f.fileno())
+    transfers.submit(path)
+    transfers.wait()
+    transfers.stop()
+    size = frames * len(frame)
+    report("temp-copy", t0, encoded, size, size)
+
+    for name, delay in (("direct", 0.0), ("direct, slow USB", 1.0 / (args.slow_mb_per_s * 2**20))):
+        transfers = TransferQueue(os.path.join(sd, f"transfers-{int(delay > 0)}.json"), lambda: usb, verify=False)
+        sink = DirectWriter(lambda: usb, os.path.join(sd, "spill"), transfers, subdir=f"run{int(delay > 0)}",
+                            memory_bytes=int(1.5 * args.segment * args.mbps * 1e6 / 8))
+        if delay:
+            original = sink._write_usb
+
+            def slow_write(segment, data, original=original):
+                time.sleep(len(data) * delay)
+                original(segment, data)
+            sink._write_usb = slow_write
+        segments = SegmentWriter(sink, "clip", segment_seconds=args.segment)
+        t0 = time.monotonic()
+        encoded = encode(segments.write)
+        segments.close()
+        sink.close()
+        transfers.wait()
+        transfers.stop()
+        s = sink.summary()
+        report(name, t0, encoded, s["bytes_sd"], s["bytes_usb"] + transfers.summary()["bytes_copied"])
+        print(f"{'':18s} segments={s['segments']}")
+
+    if args.sd is None:
+        shutil.rmtree(sd)
+    if args.usb is None:
+        shutil.rmtree(usb)
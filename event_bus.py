@@ -0,0 +1,253 @@
+#! /usr/bin/env python3
+"""
+event_bus.py
+کانال push برای وضعیت زنده: یک bus داخلی که رویدادها را به همه کلاینت‌های SSE پخش می‌کند
+
+    publish(topic, data, key)  رویداد یک بار به JSON تبدیل و متن SSE آن ساخته می‌شود و فقط
+                               به صف مشترکانی که آن topic را خواسته‌اند اضافه می‌شود
+    Subscription               صف محدود هر کلاینت؛ رویدادهای key دار (پیشرفت انتقال، شمار ذرات)
+                               جایگزین نسخه قبلی همان key می‌شوند و کلاینت کند فقط آخرین مقدار را
+                               می‌گیرد؛ وقتی صف پر است قدیمی‌ترین رویداد حذف و شمرده می‌شود
+    sse(subscription)          generator متن text/event-stream با keep-alive
+
+حافظه هر کلاینت حداکثر buffer رویداد است، هر چقدر هم کند باشد؛ publish کننده هرگز منتظر کلاینت نمی‌ماند
+"""
+
+import json
+import time
+import itertools
+from collections import OrderedDict
+from threading import Condition, Lock
+
+
+def _default(value):
+    """مقادیر numpy در JSON"""
+    if hasattr(value, "tolist"):
+        return value.tolist()
+    return str(value)
+
+
+class Subscription:
+    def __init__(self, bus, topics, buffer):
+        self.bus = bus
+        self.topics = frozenset(topics) if topics else None
+        self.buffer = buffer
+        self.closed = False
+        self.delivered = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.max_pending = 0
+        self._pending = OrderedDict()   # (topic, key) یا seq -> (seq, topic, data, text)
+        self._cond = Condition(Lock())
+        self.on_ready = None            # on_ready() وقتی صف خالی پر می‌شود (برای مصرف‌کننده async)
+
+    def wants(self, topic):
+        return self.topics is None or topic in self.topics
+
+    def _put(self, slot, event):
+        with self._cond:
+            if slot in self._pending:
+                # فقط آخرین مقدار همان key لازم است؛ به انتهای صف می‌رود تا ترتیب زمانی حفظ شود
+                del self._pending[slot]
+                self.coalesced += 1
+            elif len(self._pending) >= self.buffer:
+                self._pending.popitem(last=False)
+                self.dropped += 1
+            waiting = not self._pending
+            self._pending[slot] = event
+            self.max_pending = max(self.max_pending, len(self._pending))
+            if waiting:
+                # کلاینتی که هنوز صف قبلی را نخوانده بیدار است؛ notify دوباره فقط تعویض رشته اضافه است
+                self._cond.notify()
+        if waiting and self.on_ready is not None:
+            self.on_ready()
+
+    def get(self, timeout=None):
+        """
+        همه رویدادهای در انتظار (seq، topic، data، text) به ترتیب
+        :return: فهرست خالی در timeout یا بعد از close
+        """
+        with self._cond:
+            if not self._pending and not self.closed:
+                self._cond.wait(timeout)
+            events = list(self._pending.values())
+            self._pending.clear()
+        self.delivered += len(events)
+        return events
+
+    def close(self):
+        self.bus.unsubscribe(self)
+        with self._cond:
+            self.closed = True
+            self._cond.notify()
+
+    def summary(self):
+        return {"topics": sorted(self.topics) if self.topics else None, "pending": len(self._pending),
+                "max_pending": self.max_pending, "delivered": self.delivered, "dropped": self.dropped,
+                "coalesced": self.coalesced}
+
+
+class EventBus:
+    def __init__(self, buffer=64):
+        """:param buffer: حداکثر رویداد در انتظار برای هر کلاینت"""
+        self.buffer = buffer
+        self._lock = Lock()
+        self._subscribers = ()   # tuple؛ publish بدون قفل روی آن پیمایش می‌کند
+        self._seq = itertools.count(1)
+        self.published = {}
+        self.publish_seconds = 0.0
+
+    def subscribe(self, topics=None, buffer=None):
+        """:param topics: فهرست topic ها یا None برای همه"""
+        subscription = Subscription(self, topics, buffer or self.buffer)
+        with self._lock:
+            self._subscribers = self._subscribers + (subscription,)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers = tuple(s for s in self._subscribers if s is not subscription)
+
+    def wants(self, topic):
+        """آیا کسی این topic را می‌خواهد؛ برای نساختن payload های پرتکرار بدون مشترک"""
+        return any(s.wants(topic) for s in self._subscribers)
+
+    def publish(self, topic, data, key=None):
+        """
+        :param key: رویدادهای با topic و key یکسان در صف هر کلاینت جایگزین هم می‌شوند
+        :return: تعداد مشترکانی که رویداد را گرفتند
+        """
+        subscribers = [s for s in self._subscribers if s.wants(topic)]
+        self.published[topic] = self.published.get(topic, 0) + 1
+        if not subscribers:
+            return 0
+        t0 = time.perf_counter()
+        seq = next(self._seq)
+        payload = json.dumps(data, default=_default)
+        event = (seq, topic, data, f"id: {seq}\nevent: {topic}\ndata: {payload}\n\n")
+        slot = (topic, key) if key is not None else seq
+        for subscription in subscribers:
+            subscription._put(slot, event)
+        self.publish_seconds += time.perf_counter() - t0
+        return len(subscribers)
+
+    def summary(self):
+        subscribers = self._subscribers
+        published = sum(self.published.values())
+        return {
+            "subscribers": len(subscribers),
+            "published": dict(self.published),
+            "publish_us": 1e6 * self.publish_seconds / published if published else 0.0,
+            "dropped": sum(s.dropped for s in subscribers),
+            "coalesced": sum(s.coalesced for s in subscribers),
+            "max_pending": max((s.max_pending for s in subscribers), default=0),
+        }
+
+
+def sse(subscription, keepalive=15.0):
+    """generator برای Response(mimetype='text/event-stream')؛ با قطع کلاینت اشتراک بسته می‌شود"""
+    try:
+        yield "retry: 2000\n\n"
+        while not subscription.closed:
+            events = subscription.get(timeout=keepalive)
+            if not events:
+                yield ": keep-alive\n\n"
+                continue
+            yield "".join(event[3] for event in events)
+    finally:
+        subscription.close()
+
+
+if __name__ == "__main__":
+    # آزمون بار: 100 مشترک (چند تا کند)، شمار ذرات 30 بار در ثانیه، پیشرفت انتقال و وضعیت job
+    # با --url همین آزمون روی اتصال‌های واقعی HTTP به /stream یک سرور در حال اجرا
+    import argparse
+    import resource
+    from threading import Thread
+
+    parser = argparse.ArgumentParser(description="Event bus fan-out load test")
+    parser.add_argument("--clients", type=int, default=100)
+    parser.add_argument("--slow", type=int, default=10, help="تعداد کلاینت‌هایی که هر ثانیه یک بار می‌خوانند")
+    parser.add_argument("--seconds", type=float, default=5.0)
+    parser.add_argument("--rate", type=float, default=30.0, help="رویداد particles در ثانیه")
+    parser.add_argument("--buffer", type=int, default=64)
+    parser.add_argument("--url", help="مثلاً http://localhost:5000/stream")
+    args = parser.parse_args()
+
+    if args.url:
+        import urllib.request
+        received = [0] * args.clients
+
+        def http_client(i):
+            try:
+                with urllib.request.urlopen(args.url, timeout=args.seconds + 20) as response:
+                    end = time.monotonic() + args.seconds
+                    while time.monotonic() < end:
+                        line = response.readline()
+                        if not line:
+                            break
+                        if line.startswith(b"data: "):
+                            received[i] += 1
+                        if i < args.slow:
+                            time.sleep(0.05)
+            except OSError as e:
+                print(f"[Client {i} Error]: {e}")
+
+        threads = [Thread(target=http_client, args=(i,), daemon=True) for i in range(args.clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        connected = sum(1 for n in received if n)
+        print(f"{connected}/{args.clients} clients received events; "
+              f"fast mean {sum(received[args.slow:]) / max(1, args.clients - args.slow):.0f}, "
+              f"slow mean {sum(received[:args.slow]) / max(1, args.slow):.0f} events in {args.seconds:.0f}s")
+        raise SystemExit
+
+    bus = EventBus(buffer=args.buffer)
+    rss0 = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    latencies = []
+    running = True
+
+    def client(i):
+        subscription = bus.subscribe()
+        slow = i < args.slow
+        while running:
+            for seq, topic, data, text in subscription.get(timeout=0.5):
+                if not slow and topic == "particles":
+                    latencies.append(time.perf_counter() - data["t"])
+            if slow:
+                time.sleep(1.0)
+        subscription.close()
+
+    threads = [Thread(target=client, args=(i,), daemon=True) for i in range(args.clients)]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.2)
+
+    frame = 0
+    t0 = time.monotonic()
+    while time.monotonic() - t0 < args.seconds:
+        frame += 1
+        tracks = [[n, 10.0 * n, 5.0 * n] for n in range(20)]
+        bus.publish("particles", {"frame": frame, "count": 20, "tracks": tracks, "t": time.perf_counter()},
+                    key="live")
+        if frame % 3 == 0:
+            bus.publish("transfer", {"id": "abc", "done": frame << 20, "size": 1 << 30}, key="abc")
+        if frame % 30 == 0:
+            bus.publish("job", {"id": f"job{frame}", "state": "done"})
+        time.sleep(1.0 / args.rate)
+    stats = bus.summary()
+    running = False
+    for thread in threads:
+        thread.join()
+
+    latencies.sort()
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(f"{args.clients} subscribers ({args.slow} slow), {frame} frames at {args.rate:.0f} Hz for {args.seconds:.0f}s")
+    print(f"publish cost: {stats['publish_us']:.0f} us per event (fan-out to all subscribers)")
+    if latencies:
+        print(f"delivery latency (fast clients): p50 {1000 * latencies[len(latencies) // 2]:.2f} ms, "
+              f"p99 {1000 * latencies[int(len(latencies) * 0.99)]:.2f} ms")
+    print(f"per-client pending peak: {stats['max_pending']} (buffer {args.buffer}); "
+          f"coalesced {stats['coalesced']}, dropped {stats['dropped']}; max RSS +{(rss - rss0) / 1024:.1f} MB")
@@ -0,0 +1,485 @@
+#! /usr/bin/env python3
+"""
+event_recorder.py
+ضبط رویدادمحور با pre-roll: چند ثانیه آخر همیشه به صورت فشرده در حافظه نگه داشته می‌شود و
+وقتی یک trigger (تعداد ذرات، حرکت ناگهانی، تجمع ذرات) فعال شود، pre-roll به همراه post-roll
+روی دیسک نوشته می‌شود؛ به جای ساعت‌ها فایل خالی فقط لحظه‌های مهم ذخیره و منتقل می‌شوند
+
+    EventRecorder       فریم‌های JPEG همان FrameHub پیش‌نمایش در بافر حلقوی محدود به بایت و ثانیه؛
+                        از شروع رویداد در رشته جدا به mp4 نوشته می‌شود (با replay/synthetic قابل تست)
+    H264EventRecorder   روی Pi: encoder سخت‌افزاری با CircularOutput از Picamera2
+"""
+
+import os
+import time
+import cv2
+import numpy as np
+from collections import deque
+from queue import Queue
+from threading import Thread, Lock
+from frame_pacer import FramePacer
+
+
+# -----------------------
+# triggerها: check(frame, detections) -> دلیل (str) یا None
+# -----------------------
+class CountTrigger:
+    """تعداد ذرات در فریم از آستانه بیشتر شود"""
+
+    def __init__(self, threshold):
+        self.threshold = threshold
+
+    def check(self, frame, detections):
+        if detections is not None and len(detections) >= self.threshold:
+            return f"count={len(detections)}"
+        return None
+
+
+class MotionTrigger:
+    """حرکت ناگهانی: میانگین قدر مطلق اختلاف با فریم قبل روی تصویر کوچک شده"""
+
+    def __init__(self, threshold=8.0, scale=0.125):
+        self.threshold = threshold
+        self.scale = scale
+        self._previous = None
+
+    def check(self, frame, detections):
+        if frame is None:
+            return None
+        gray = frame if frame.ndim == 2 else cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY)
+        small = cv2.resize(gray, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+        previous, self._previous = self._previous, small
+        if previous is None or previous.shape != small.shape:
+            return None
+        mad = float(cv2.absdiff(small, previous).mean())
+        return f"motion={mad:.1f}" if mad >= self.threshold else None
+
+
+class AggregationTrigger:
+    """تجمع: چند ذره با مساحت خیلی بیشتر از میانه مساحت‌ها"""
+
+    def __init__(self, factor=4.0, min_count=3):
+        self.factor = factor
+        self.min_count = min_count
+
+    def check(self, frame, detections):
+        if detections is None or len(detections) < self.min_count:
+            return None
+        areas = detections["area"]
+        large = int((areas >= self.factor * np.median(areas)).sum())
+        return f"aggregates={large}" if large >= self.min_count else None
+
+
+def make_triggers(count=None, motion=None, aggregation=None):
+    """ساخت فهرست trigger از پارامترهای ساده (None یعنی غیرفعال)"""
+    triggers = []
+    if count is not None:
+        triggers.append(CountTrigger(count))
+    if motion is not None:
+        triggers.append(MotionTrigger(motion))
+    if aggregation is not None:
+        triggers.append(AggregationTrigger(aggregation))
+    return triggers
+
+
+class _EventMonitor:
+    """
+    پایه مشترک: فریم‌های FrameHub را دنبال می‌کند، triggerها را بررسی و وضعیت رویداد را مدیریت می‌کند
+    زیرکلاس‌ها _buffer_frame، _begin و _finish را پیاده می‌کنند
+    """
+
+    def __init__(self, hub, folder, triggers=(), pre_seconds=10.0, post_seconds=10.0,
+                 max_event_seconds=120.0, on_clip=None):
+        self.hub = hub
+        self.folder = folder
+        self.triggers = list(triggers)
+        self.pre_seconds = pre_seconds
+        self.post_seconds = post_seconds
+        self.max_event_seconds = max_event_seconds
+        self.on_clip = on_clip
+
+        self._lock = Lock()
+        self._thread = None
+        self.armed = False
+        self._manual = None
+        self._detections = None
+        self.active = None       # رویداد در حال ضبط
+        self.events = []         # رویدادهای تمام شده
+        self.frames_seen = 0
+
+    def on_detections(self, detections):
+        """listener برای DetectionWorker"""
+        self._detections = detections
+
+    def trigger(self, reason="manual"):
+        """شروع/تمدید دستی رویداد"""
+        self._manual = reason
+
+    def arm(self, triggers=None):
+        with self._lock:
+            if triggers is not None:
+                self.triggers = list(triggers)
+            if self.armed:
+                return
+            self.armed = True
+            os.makedirs(self.folder, exist_ok=True)
+            self._start()
+            self._thread = Thread(target=self._run, name="event-monitor", daemon=True)
+            self._thread.start()
+
+    def disarm(self):
+        with self._lock:
+            if not self.armed:
+                return
+            self.armed = False
+        if self._thread is not None:
+            self._thread.join(timeout=2)
+            self._thread = None
+        if self.active is not None:
+            self._close_event()
+        self._stop()
+
+    def _run(self):
+        last_version = 0
+        while self.armed:
+            item = self.hub.acquire(last_version)
+            if item is None:
+                continue
+            last_version, frame, jpeg, _, timestamp = item[:5]
+            ts = int(timestamp * 1e9)
+            self.frames_seen += 1
+            try:
+                self._buffer_frame(ts, jpeg)
+                reason = self._check(frame)
+                if reason is not None:
+                    if self.active is None:
+                        self._open_event(ts, reason)
+                    else:
+                        # رویداد ادامه دارد: post-roll تمدید می‌شود (تا سقف max_event_seconds)
+                        self.active["until"] = min(ts + int(self.post_seconds * 1e9),
+                                                   self.active["started"] + int(self.max_event_seconds * 1e9))
+                        self.active["reasons"].add(reason.split("=")[0])
+                if self.active is not None and ts >= self.active["until"]:
+                    self._close_event()
+            except Exception as e:
+                print(f"[Event Recorder Error]: {e}")
+            finally:
+                self.hub.release(frame)
+
+    def _check(self, frame):
+        if self._manual is not None:
+            reason, self._manual = self._manual, None
+            return reason
+        detections = self._detections
+        for trigger in self.triggers:
+            reason = trigger.check(frame, detections)
+            if reason is not None:
+                return reason
+        return None
+
+    def _open_event(self, ts, reason):
+        now = time.time()
+        stamp = time.strftime("%Y%m%d_%H%M%S", time.localtime(now)) + f"_{int(now * 1000) % 1000:03d}"
+        name = f"event_{stamp}_{reason.split('=')[0]}"
+        self.active = {
+            "name": name,
+            "reason": reason,
+            "reasons": {reason.split("=")[0]},
+            "started": ts,
+            "until": ts + int(self.post_seconds * 1e9),
+            "wall_time": stamp,
+        }
+        print(f"[Event] {name}: {reason}")
+        self._begin(self.active)
+
+    def _close_event(self):
+        event, self.active = self.active, None
+        event["reasons"] = sorted(event["reasons"])
+        self._finish(event)
+
+    def summary(self):
+        return {
+            "armed": self.armed,
+            "active": self.active["name"] if self.active else None,
+            "events": [dict(e) for e in self.events[-50:]],
+            "frames_seen": self.frames_seen,
+        }
+
+    # --- زیرکلاس‌ها ---
+    def _start(self):
+        pass
+
+    def _stop(self):
+        pass
+
+    def _buffer_frame(self, ts, jpeg):
+        pass
+
+    def _begin(self, event):
+        raise NotImplementedError
+
+    def _finish(self, event):
+        raise NotImplementedError
+
+
+class EventRecorder(_EventMonitor):
+    """
+    pre-roll نرم‌افزاری روی JPEGهای FrameHub (هیچ encode اضافه‌ای؛ همان JPEG پیش‌نمایش)
+    با شروع رویداد pre-roll به رشته نوشتن داده می‌شود و فریم‌های post-roll همان لحظه پشت سر آن
+    در فایل باز نوشته می‌شوند؛ حافظه در طول رویداد به max_bytes محدود است، نه به طول رویداد
+    """
+
+    def __init__(self, hub, folder, *args, fps=30, max_bytes=64 * 2**20, **kwargs):
+        """
+        :param max_bytes: سقف حافظه بافر pre-roll و، جدا از آن، سقف فریم‌های منتظر رشته نوشتن؛
+                          وقتی نوشتن عقب بیفتد فریم post-roll دور ریخته می‌شود (جایش با فریم قبل پر می‌شود)
+        """
+        super().__init__(hub, folder, *args, **kwargs)
+        self.fps = fps
+        self.max_bytes = max_bytes
+        self._ring = deque()
+        self._ring_bytes = 0
+        self._writes = Queue()
+        self._pending_bytes = 0  # بایت‌های JPEG در صف نوشتن
+        self._pending_lock = Lock()
+        self._writer = None
+        self.evicted_for_memory = 0
+        self.dropped_for_memory = 0
+        self.bytes_written = 0
+        self.bytes_seen = 0
+
+    def _start(self):
+        self.hub.subscribe()
+        if self._writer is None:
+            self._writer = Thread(target=self._write_loop, name="event-writer", daemon=True)
+            self._writer.start()
+
+    def _stop(self):
+        self.hub.unsubscribe()
+        self._ring.clear()
+        self._ring_bytes = 0
+
+    def _buffer_frame(self, ts, jpeg):
+        if jpeg is None:
+            return
+        self.bytes_seen += len(jpeg)
+        if self.active is not None:
+            with self._pending_lock:
+                if self._pending_bytes + len(jpeg) > self.max_bytes:
+                    self.dropped_for_memory += 1
+                    return
+                self._pending_bytes += len(jpeg)
+            self.active["frame_count"] += 1
+            self._writes.put(("frame", self.active, [(ts, jpeg)]))
+            return
+        self._ring.append((ts, jpeg))
+        self._ring_bytes += len(jpeg)
+        horizon = ts - int(self.pre_seconds * 1e9)
+        while self._ring and (self._ring[0][0] < horizon or self._ring_bytes > self.max_bytes):
+            if self._ring[0][0] >= horizon:
+                self.evicted_for_memory += 1
+            self._ring_bytes -= len(self._ring.popleft()[1])
+
+    def _begin(self, event):
+        frames = list(self._ring)
+        with self._pending_lock:
+            self._pending_bytes += self._ring_bytes
+        self._ring.clear()
+        self._ring_bytes = 0
+        event["path"] = os.path.join(self.folder, event["name"] + ".mp4")
+        event["frame_count"] = len(frames)
+        event["first_ts"] = frames[0][0] if frames else event["started"]
+        self._writes.put(("open", event, frames))
+
+    def _finish(self, event):
+        self._writes.put(("close", event, None))
+
+    def _write_loop(self):
+        clips = {}  # name -> _ClipWriter
+        while True:
+            kind, event, frames = self._writes.get()
+            clip = clips.get(event["name"])
+            try:
+                if kind == "open":
+                    clip = clips[event["name"]] = _ClipWriter(event["path"], self.fps)
+                if clip is not None and frames:
+                    for ts, jpeg in frames:
+                        if clip.write(ts, jpeg):
+                            self.bytes_written += len(jpeg)
+                        event["last_ts"] = ts
+                if kind == "close" and clip is not None:
+                    del clips[event["name"]]
+                    clip.close()
+                    event["seconds"] = (event.get("last_ts", event["first_ts"]) - event["first_ts"]) / 1e9
+                    self.events.append(event)
+                    print(f"[Event] saved {event['path']} ({event['frame_count']} frames, {event['seconds']:.1f}s)")
+                    if self.on_clip is not None:
+                        self.on_clip(event["path"], event)
+            except Exception as e:
+                print(f"[Event Write Error]: {e}")
+                # فایل خراب رها می‌شود؛ بقیه فریم‌های همین رویداد نادیده گرفته می‌شوند
+                broken = clips.pop(event["name"], None)
+                if broken is not None:
+                    broken.close()
+            finally:
+                if frames:
+                    with self._pending_lock:
+                        self._pending_bytes -= sum(len(jpeg) for _, jpeg in frames)
+                self._writes.task_done()
+
+    def flush(self, timeout=60):
+        """صبر تا نوشته شدن همه کلیپ‌های رویداد (مثلاً بعد از disarm)"""
+        deadline = time.monotonic() + timeout
+        while self._writes.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.05)
+        return not self._writes.unfinished_tasks
+
+    def summary(self):
+        summary = super().summary()
+        summary.update({
+            "pre_roll_frames": len(self._ring),
+            "pre_roll_bytes": self._ring_bytes,
+            "pending_bytes": self._pending_bytes,
+            "evicted_for_memory": self.evicted_for_memory,
+            "dropped_for_memory": self.dropped_for_memory,
+            "storage_ratio": self.bytes_written / self.bytes_seen if self.bytes_seen else 0.0,
+        })
+        return summary
+
+
+class _ClipWriter:
+    """decode JPEGهای یک رویداد و نوشتن mp4 با جایگاه زمانی واقعی هر فریم"""
+
+    def __init__(self, path, fps):
+        self.path = path
+        self.fps = fps
+        self.pacer = FramePacer(fps)
+        self.writer = None
+        self.previous = None
+
+    def write(self, ts, jpeg):
+        image = cv2.imdecode(np.frombuffer(jpeg, np.uint8), cv2.IMREAD_COLOR)
+        if image is None:
+            return False
+        # فریم‌های hub به ترتیب RGB هستند
+        image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+        if self.writer is None:
+            h, w = image.shape[:2]
+            self.writer = cv2.VideoWriter(self.path, cv2.VideoWriter_fourcc(*'mp4v'), self.fps, (w, h))
+            if not self.writer.isOpened():
+                self.writer = None
+                raise RuntimeError(f"VideoWriter failed for {self.path}")
+        # فاصله‌ها (فریم از دست رفته، رد شده توسط ChangeGate یا دور ریخته به خاطر حافظه) با فریم قبلی پر می‌شوند
+        count = self.pacer.slots_for(ts)
+        if count:
+            for _ in range(count - 1):
+                self.writer.write(self.previous)
+            self.writer.write(image)
+        self.previous = image
+        return True
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.release()
+            self.writer = None
+
+
+class H264EventRecorder(_EventMonitor):
+    """
+    روی Pi: encoder سخت‌افزاری H.264 دائماً در CircularOutput می‌نویسد (pre-roll بر حسب فریم)؛
+    در رویداد همان بافر و ادامه آن در فایل .h264 نوشته می‌شود. triggerها همچنان روی lores اجرا می‌شوند
+    """
+
+    def __init__(self, hub, folder, source, modes=None, *args, fps=30, bitrate=10000000, **kwargs):
+        super().__init__(hub, folder, *args, **kwargs)
+        self.source = source
+        self.modes = modes
+        self.fps = fps
+        self.bitrate = bitrate
+        self._encoder = None
+        self._output = None
+
+    def _start(self):
+        from picamera2.encoders import H264Encoder
+        from picamera2.outputs import CircularOutput
+        stream = self.modes.prepare("record", mode="video") if self.modes is not None else "main"
+        self.source.open()
+        self._encoder = H264Encoder(bitrate=self.bitrate, framerate=self.fps)
+        self._output = CircularOutput(buffersize=int(self.pre_seconds * self.fps))
+        self.source.picam2.start_encoder(self._encoder, self._output, name=stream)
+
+    def _stop(self):
+        if self._encoder is not None:
+            self.source.picam2.stop_encoder(self._encoder)
+            self._encoder = self._output = None
+            if self.modes is not None:
+                self.modes.restore()
+
+    def _begin(self, event):
+        event["path"] = os.path.join(self.folder, event["name"] + ".h264")
+        self._output.fileoutput = event["path"]
+        self._output.start()
+
+    def _finish(self, event):
+        self._output.stop()
+        event["seconds"] = (time.monotonic_ns() - event["started"]) / 1e9 + self.pre_seconds
+        self.events.append(event)
+        print(f"[Event] saved {event['path']}")
+        if self.on_clip is not None:
+            self.on_clip(event["path"], event)
+
+
+def create_event_recorder(hub, folder, source=None, modes=None, prefer="h264", **kwargs):
+    """H.264 سخت‌افزاری اگر موجود است، در غیر این صورت pre-roll نرم‌افزاری روی JPEGهای پیش‌نمایش"""
+    from recorders import hardware_encoder_available
+    if prefer == "h264" and source is not None and hardware_encoder_available(source):
+        return H264EventRecorder(hub, folder, source, modes, **kwargs)
+    return EventRecorder(hub, folder, **kwargs)
+
+
+if __name__ == "__main__":
+    # تست با منبع replay یا synthetic: trigger روی تعداد ذرات/حرکت و مقایسه حجم با ضبط پیوسته
+    import argparse
+    import tempfile
+    from frame_hub import FrameHub
+    from frame_source import create_source
+    from particle_detector import ParticleDetector, DetectionWorker
+
+    parser = argparse.ArgumentParser(description="Event-triggered recording test")
+    parser.add_argument("--source", default="synthetic", help="synthetic یا replay:<path>")
+    parser.add_argument("--seconds", type=float, default=20)
+    parser.add_argument("--count", type=int, default=None, help="trigger تعداد ذرات")
+    parser.add_argument("--motion", type=float, default=None, help="trigger حرکت (MAD)")
+    parser.add_argument("--aggregation", type=float, default=None, help="trigger تجمع (ضریب مساحت)")
+    parser.add_argument("--manual-at", type=float, default=5.0, help="trigger دستی در این ثانیه (بدون trigger دیگر)")
+    parser.add_argument("--pre", type=float, default=3)
+    parser.add_argument("--post", type=float, default=3)
+    parser.add_argument("--folder", default=None)
+    args = parser.parse_args()
+
+    source = create_source(args.source)
+    hub = FrameHub(lambda: cv2.cvtColor(source.capture_array("lores"), cv2.COLOR_YUV420p2RGB))
+    worker = DetectionWorker(hub, ParticleDetector())
+    folder = args.folder or tempfile.mkdtemp()
+    recorder = EventRecorder(hub, folder, make_triggers(args.count, args.motion, args.aggregation),
+                             pre_seconds=args.pre, post_seconds=args.post)
+    worker.add_listener(recorder.on_detections)
+    worker.start()
+    recorder.arm()
+
+    t0 = time.monotonic()
+    manual = not recorder.triggers
+    while time.monotonic() - t0 < args.seconds:
+        if manual and time.monotonic() - t0 >= args.manual_at:
+            recorder.trigger("manual")
+            manual = False
+        time.sleep(0.1)
+    recorder.disarm()
+    worker.stop()
+    recorder.flush()
+
+    s = recorder.summary()
+    print(f"frames seen={s['frames_seen']} events={len(s['events'])} "
+          f"stored {100 * s['storage_ratio']:.1f}% of the continuous stream")
+    for event in s["events"]:
+        print(f"  {event['path']}: {event['reason']} {event['frame_count']} frames {event['seconds']:.1f}s")
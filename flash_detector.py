@@ -1,42 +1,28 @@
 import os
-import subprocess
-from time import sleep
+from storage_presence import StoragePresence
 
 class FlashDetector:
-    def __init__(self):
+    def __init__(self, presence=None):
         self.flash_mounted = False
         self.mount_point = None
         self.media_folder = None
+        # پارتیشن‌های mount شده دستگاه‌های USB (معمولاً /dev/sd*) از mountinfo کش شده،
+        # به جای اجرای lsblk در هر بررسی
+        self.presence = presence or StoragePresence(roots=(), devices=("/dev/sd",))
+        self.presence.start()
 
     def detect_flash(self):
         """بررسی وجود فلش مموری متصل شده"""
         try:
-            # پیدا کردن دستگاه فلش
-            result = subprocess.run(
-                ['lsblk', '-o', 'NAME,MOUNTPOINT,LABEL', '-J'],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True
-            )
-            
-            if result.returncode != 0:
-                print("Error in run command lsblk")
-                return False, "خطا در اجرای دستور lsblk"
-
-            import json
-            devices = json.loads(result.stdout)
-            
-            for device in devices['blockdevices']:
-                # بررسی دستگاه‌های USB (معمولاً با sd شروع می‌شوند)
-                if device['name'].startswith('sd'):
-                    for partition in device.get('children', []):
-                        if partition.get('mountpoint'):
-                            self.mount_point = partition['mountpoint']
-                            self.flash_mounted = True
-                            return True, None
-            print("No external storage found")            
+            mount_point = self.presence.current()
+            if mount_point:
+                self.mount_point = mount_point
+                self.flash_mounted = True
+                return True, None
+            self.flash_mounted = False
+            print("No external storage found")
             return False, "هیچ ذخیره ساز خارجی متصل نشده است"
-            
+
         except Exception as e:
             return False, f"error in found memory: {str(e)}"
 
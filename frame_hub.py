@@ -0,0 +1,238 @@
+#! /usr/bin/env python3
+"""
+frame_hub.py
+یک تولیدکننده برای همه بینندگان: یک رشته فریم را می‌گیرد و JPEG را یک بار می‌سازد،
+همه کلاینت‌های /video_feed آخرین نسخه را از یک اسلات مشترک می‌خوانند
+با ChangeGate فریم‌های بدون تغییر اصلاً منتشر نمی‌شوند: نه JPEG جدید، نه تشخیص جدید؛
+مصرف‌کننده‌ها همان نسخه قبلی را نگه می‌دارند
+"""
+
+import time
+import cv2
+from threading import Condition, Thread
+
+MJPEG_HEADER = b'--frame\r\nContent-Type: image/jpeg\r\n\r\n'
+MJPEG_TRAILER = b'\r\n'
+
+
+class FrameHub:
+    def __init__(self, capture_fn, quality=80, gate=None, reuse=None, buffers=None):
+        """
+        :param capture_fn: تابعی که یک فریم آماده encode برمی‌گرداند (دوربین، فایل یا مصنوعی)
+        :param quality: کیفیت JPEG پیش‌نمایش
+        :param gate: ChangeGate یا None؛ فریم‌های بدون تغییر منتشر نمی‌شوند
+        :param reuse: تابعی که بعد از رد شدن فریم صدا زده می‌شود تا capture بعدی همان بافر را
+                      دوباره پر کند (مثلاً RotatingBuffers.reuse)، وگرنه بافر فریم منتشر شده بازنویسی می‌شود
+        :param buffers: RotatingBuffers که capture_fn از آن می‌نویسد؛ فریم منتشر شده و فریم‌هایی که
+                        مصرف‌کننده‌ها با acquire گرفته‌اند تا release بازنویسی نمی‌شوند
+        """
+        self._capture = capture_fn
+        self.quality = quality
+        self.gate = gate
+        self._reuse = reuse
+        self._buffers = buffers
+
+        # اسلات مشترک نسخه‌دار
+        self._cond = Condition()
+        self.version = 0
+        self.frame = None
+        self.jpeg = None        # memoryview روی بافر خروجی imencode (بدون کپی)
+        self.part = None        # بخش کامل multipart که یک بار برای همه مشترک‌ها ساخته می‌شود
+        self.timestamp = None
+        # شماره capture فریم منتشر شده؛ برخلاف version فریم‌های رد شده با gate را هم می‌شمارد
+        # تا فاصله زمانی بین دو فریم منتشر شده (مثلاً برای ردیابی) درست باشد
+        self.sequence = 0
+
+        self._thread = None
+        self._running = False
+        self.subscribers = 0
+
+        # شمارنده‌ها برای اندازه‌گیری هزینه
+        self.frames_captured = 0
+        self.frames_encoded = 0
+        self.frames_gated = 0
+        self.encode_seconds = 0.0
+
+    def start(self):
+        """راه‌اندازی رشته capture (فقط یک بار)"""
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+            self._thread = Thread(target=self._run, name="frame-hub", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """توقف رشته capture و بیدار کردن همه مشترک‌ها"""
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout=2)
+            self._thread = None
+
+    def _run(self):
+        while self._running:
+            try:
+                frame = self._capture()
+                if frame is None:
+                    time.sleep(0.01)
+                    continue
+                self.frames_captured += 1
+                sequence = self.frames_captured
+                if self.gate is not None and not self.gate.changed(frame):
+                    self.frames_gated += 1
+                    if self._reuse is not None:
+                        self._reuse()
+                    continue
+
+                # فقط وقتی بیننده‌ای هست encode می‌کنیم
+                jpeg = part = None
+                if self.subscribers > 0:
+                    t0 = time.perf_counter()
+                    ret, buffer = cv2.imencode('.jpg', frame, [int(cv2.IMWRITE_JPEG_QUALITY), self.quality])
+                    if ret:
+                        jpeg = memoryview(buffer)
+                        part = b''.join((MJPEG_HEADER, jpeg, MJPEG_TRAILER))
+                        self.frames_encoded += 1
+                        self.encode_seconds += time.perf_counter() - t0
+
+                with self._cond:
+                    # خود hub هم فریم منتشر شده را نگه می‌دارد تا capture بعدی آن را انتخاب نکند
+                    self._hold(frame)
+                    self._release(self.frame)
+                    self.version += 1
+                    self.frame = frame
+                    self.jpeg = jpeg
+                    self.part = part
+                    self.timestamp = time.monotonic()
+                    self.sequence = sequence
+                    self._cond.notify_all()
+            except Exception as e:
+                print(f"Frame capture error: {e}")
+                time.sleep(0.1)
+
+    def wait_for(self, last_version, timeout=1.0):
+        """
+        صبر تا نسخه‌ای جدیدتر از last_version منتشر شود
+        :return: (version, frame, jpeg, part, timestamp, sequence) یا None در صورت timeout/توقف
+        """
+        self.start()
+        with self._cond:
+            if not self._cond.wait_for(lambda: self.version > last_version or not self._running, timeout):
+                return None
+            if not self._running:
+                return None
+            return self.version, self.frame, self.jpeg, self.part, self.timestamp, self.sequence
+
+    def acquire(self, last_version, timeout=1.0):
+        """
+        مثل wait_for ولی فریم تا release(frame) در اختیار مصرف‌کننده می‌ماند؛ برای کسی که فریم خام را
+        می‌خواند (تشخیص، encode سطح‌ها) و ممکن است چند فریم عقب بیفتد
+        """
+        self.start()
+        with self._cond:
+            if not self._cond.wait_for(lambda: self.version > last_version or not self._running, timeout):
+                return None
+            if not self._running:
+                return None
+            self._hold(self.frame)
+            return self.version, self.frame, self.jpeg, self.part, self.timestamp, self.sequence
+
+    def release(self, frame):
+        self._release(frame)
+
+    def _hold(self, frame):
+        if self._buffers is not None and frame is not None:
+            self._buffers.hold(frame)
+
+    def _release(self, frame):
+        if self._buffers is not None and frame is not None:
+            self._buffers.release(frame)
+
+    def latest(self):
+        """آخرین فریم خام منتشر شده بدون انتظار"""
+        with self._cond:
+            return self.version, self.frame, self.timestamp
+
+    @property
+    def encode_ms(self):
+        """میانگین هزینه یک encode (ms)"""
+        return 1000 * self.encode_seconds / self.frames_encoded if self.frames_encoded else 0.0
+
+    def subscribe(self):
+        """درخواست JPEG برای فریم‌های بعدی (هر مصرف‌کننده JPEG یک بار)"""
+        with self._cond:
+            self.subscribers += 1
+
+    def unsubscribe(self):
+        with self._cond:
+            self.subscribers -= 1
+
+    def mjpeg(self, views=False):
+        """
+        تولید بخش‌های multipart برای یک مشترک MJPEG
+        :param views: True برای سرورهایی که buffer protocol می‌پذیرند: header، memoryview بافر
+                      encoder و trailer جدا yield می‌شوند (بدون هیچ کپی)؛ سرور توسعه Werkzeug فقط
+                      bytes می‌پذیرد، پس پیش‌فرض همان part مشترک است که یک بار برای همه ساخته شده
+        """
+        self.subscribe()
+        try:
+            last_version = 0
+            while True:
+                item = self.wait_for(last_version)
+                if item is None:
+                    if not self._running:
+                        return
+                    continue
+                last_version, _, jpeg, part = item[:4]
+                if jpeg is None:
+                    # فریم قبل از اضافه شدن این مشترک گرفته شده بود
+                    continue
+                if views:
+                    yield MJPEG_HEADER
+                    yield jpeg
+                    yield MJPEG_TRAILER
+                else:
+                    yield part
+        finally:
+            self.unsubscribe()
+
+
+if __name__ == "__main__":
+    # تست بار: 50 کلاینت شبیه‌سازی شده روی منبع مصنوعی یا فایل ویدئو
+    import argparse
+    from frame_source import create_source
+
+    parser = argparse.ArgumentParser(description="FrameHub load test")
+    parser.add_argument("--clients", type=int, default=50)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--fps", type=float, default=30)
+    parser.add_argument("--source", default="synthetic", help="synthetic یا replay:<path>")
+    args = parser.parse_args()
+
+    source = create_source(args.source, fps=args.fps)
+
+    def capture():
+        return cv2.cvtColor(source.capture_array("lores"), cv2.COLOR_YUV420p2RGB)
+
+    hub = FrameHub(capture)
+    received = [0] * args.clients
+    deadline = time.monotonic() + args.seconds
+
+    def client(i):
+        for _ in hub.mjpeg():
+            received[i] += 1
+            if time.monotonic() > deadline:
+                break
+
+    threads = [Thread(target=client, args=(i,), daemon=True) for i in range(args.clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    hub.stop()
+
+    print(f"clients={args.clients} captured={hub.frames_captured} encoded={hub.frames_encoded}")
+    print(f"frames per client: min={min(received)} max={max(received)} total={sum(received)}")
+    print(f"encodes per delivered frame: {hub.frames_encoded / max(sum(received), 1):.4f}")
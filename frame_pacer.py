@@ -0,0 +1,119 @@
+#! /usr/bin/env python3
+"""
+frame_pacer.py
+زمان‌بندی فریم بدون drift برای ضبط
+به جای sleep ثابت بعد از هر فریم، موعد هر فریم از روی ساعت monotonic محاسبه می‌شود
+و هر فریم بر اساس timestamp سنسور (یا monotonic) در جایگاه زمانی خودش قرار می‌گیرد؛
+در صورت نیاز فریم تکرار یا حذف می‌شود تا timeline فایل با زمان واقعی یکی باشد
+(برای اندازه‌گیری سرعت ذرات فاصله زمانی بین فریم‌ها باید دقیق باشد)
+"""
+
+import math
+import time
+
+
+class FramePacer:
+    def __init__(self, fps):
+        self.fps = float(fps)
+        self.period = 1.0 / self.fps
+        self.reset()
+
+    def reset(self):
+        self.t0 = None           # زمان شروع (ثانیه، monotonic)
+        self.ts0 = None          # timestamp اولین فریم (نانوثانیه)
+        self._deadline = None
+        self._last_slot = -1
+        self._last_ts = None
+
+        # آمار
+        self.frames_in = 0
+        self.frames_out = 0
+        self.duplicated = 0
+        self.dropped = 0
+        self.late = 0
+        self._intervals_n = 0
+        self._intervals_sum = 0.0
+        self._intervals_sq = 0.0
+
+    def start(self):
+        self.t0 = time.monotonic()
+        self._deadline = self.t0
+
+    # -----------------------
+    # حالت ۱: موعد monotonic برای حلقه‌هایی که خودشان مسدود نمی‌شوند
+    # -----------------------
+    def wait(self):
+        """
+        صبر تا موعد فریم بعدی
+        :return: تعداد موعدهایی که از دست رفته (0 یعنی به موقع)
+        """
+        if self._deadline is None:
+            self.start()
+        self._deadline += self.period
+        now = time.monotonic()
+        delay = self._deadline - now
+        if delay > 0:
+            time.sleep(delay)
+            return 0
+        # دیر رسیدیم: به جای جبران انباشته، موعدهای از دست رفته رد می‌شوند
+        missed = int(-delay / self.period)
+        if missed:
+            self._deadline += missed * self.period
+        self.late += 1
+        return missed
+
+    # -----------------------
+    # حالت ۲: قرار دادن فریم با timestamp در timeline خروجی
+    # -----------------------
+    def slots_for(self, timestamp_ns=None):
+        """
+        تعداد دفعاتی که این فریم باید در خروجی نوشته شود
+        0: حذف (فریم اضافه در همان جایگاه زمانی)، 1: عادی، بیشتر: تکرار برای پر کردن فاصله
+        """
+        if timestamp_ns is None:
+            timestamp_ns = time.monotonic_ns()
+        if self.ts0 is None:
+            self.ts0 = timestamp_ns
+            if self.t0 is None:
+                self.start()
+        self.frames_in += 1
+
+        if self._last_ts is not None:
+            interval = (timestamp_ns - self._last_ts) / 1e9
+            self._intervals_n += 1
+            self._intervals_sum += interval
+            self._intervals_sq += interval * interval
+            if interval > 1.5 * self.period:
+                self.late += 1
+        self._last_ts = timestamp_ns
+
+        slot = int(round((timestamp_ns - self.ts0) / 1e9 * self.fps))
+        count = slot - self._last_slot
+        if count <= 0:
+            self.dropped += 1
+            return 0
+        self._last_slot = slot
+        self.duplicated += count - 1
+        self.frames_out += count
+        return count
+
+    # -----------------------
+    # آمار
+    # -----------------------
+    def summary(self):
+        elapsed = time.monotonic() - self.t0 if self.t0 is not None else 0.0
+        n = self._intervals_n
+        mean = self._intervals_sum / n if n else 0.0
+        jitter = math.sqrt(max(self._intervals_sq / n - mean * mean, 0.0)) if n else 0.0
+        return {
+            "target_fps": self.fps,
+            "achieved_fps": 1.0 / mean if mean else 0.0,
+            "jitter_ms": jitter * 1000,
+            "late_frames": self.late,
+            "frames_in": self.frames_in,
+            "frames_out": self.frames_out,
+            "duplicated": self.duplicated,
+            "dropped": self.dropped,
+            "timeline_s": self.frames_out / self.fps,
+            "wall_s": elapsed,
+        }
@@ -0,0 +1,499 @@
+#! /usr/bin/env python3
+"""
+frame_source.py
+منبع فریم قابل تعویض: Picamera2، پخش دوباره فایل ویدئو/پوشه تصویر، یا ذرات مصنوعی
+منبع فقط در اولین استفاده باز می‌شود (نه هنگام import) تا برنامه بدون Raspberry Pi هم اجرا شود
+
+انتخاب منبع با متغیر محیطی CAMERA_SOURCE:
+    picamera2                  دوربین واقعی (پیش‌فرض)
+    synthetic                  ذرات متحرک مصنوعی
+    replay:<path>              فایل ویدئو، پوشه تصاویر یا الگوی glob
+"""
+
+import os
+import glob
+import time
+import cv2
+import numpy as np
+from contextlib import contextmanager
+from threading import Lock
+
+# -----------------------
+# پیکربندی پیش‌فرض
+# -----------------------
+MAIN_SIZE = (3840, 2160)
+LORES_SIZE = (1024, 768)
+FRAME_RATE = 30.0
+
+# فرمت‌ها مثل Picamera2 در create_video_configuration
+# XBGR8888 -> [R, G, B, 255]   RGB888 -> [B, G, R]   YUV420 -> I420 با ارتفاع 1.5 برابر
+DEFAULT_FORMATS = {"main": "XBGR8888", "lores": "YUV420"}
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff')
+
+
+# کد cvtColor برای تبدیل BGR <-> فرمت هر استریم (None یعنی همان BGR است)
+_FROM_BGR = {
+    "YUV420": cv2.COLOR_BGR2YUV_I420,
+    "XBGR8888": cv2.COLOR_BGR2RGBA,
+    "XRGB8888": cv2.COLOR_BGR2BGRA,
+    "BGR888": cv2.COLOR_BGR2RGB,
+    "RGB888": None,
+}
+_TO_BGR = {
+    "YUV420": cv2.COLOR_YUV2BGR_I420,
+    "XBGR8888": cv2.COLOR_RGBA2BGR,
+    "XRGB8888": cv2.COLOR_BGRA2BGR,
+    "BGR888": cv2.COLOR_RGB2BGR,
+    "RGB888": None,
+}
+
+
+def _convert(frame, code, dst):
+    if code is None:
+        if dst is None:
+            return frame
+        np.copyto(dst, frame)
+        return dst
+    if dst is None:
+        return cv2.cvtColor(frame, code)
+    return cv2.cvtColor(frame, code, dst=dst)
+
+
+def bgr_to_format(frame, fmt, dst=None):
+    """تبدیل فریم BGR به فرمتی که Picamera2 برای آن استریم برمی‌گرداند (dst: بافر از پیش تخصیص داده)"""
+    return _convert(frame, _FROM_BGR[fmt], dst)
+
+
+def format_to_bgr(frame, fmt, dst=None):
+    """عکس bgr_to_format، برای ذخیره فایل یا تحلیل"""
+    return _convert(frame, _TO_BGR[fmt], dst)
+
+
+def bgr_code(fmt):
+    """کد cvtColor فرمت استریم به BGR (برای capture_into)؛ None یعنی فریم همان BGR است"""
+    return _TO_BGR[fmt]
+
+
+class FrameSource:
+    """
+    رابط مشترک همه منابع فریم
+    متدها مثل Picamera2 نام‌گذاری شده‌اند تا کد دوربین بدون تغییر زیاد از آن استفاده کند
+    """
+
+    def __init__(self, main_size=MAIN_SIZE, lores_size=LORES_SIZE, fps=FRAME_RATE, formats=None):
+        self.sizes = {"main": tuple(main_size), "lores": tuple(lores_size)}
+        self.formats = dict(DEFAULT_FORMATS)
+        if formats:
+            self.formats.update(formats)
+        self.fps = fps
+        self.is_open = False
+        self._open_lock = Lock()
+
+    # --- چرخه عمر ---
+    def open(self):
+        with self._open_lock:
+            if not self.is_open:
+                self._open()
+                self.is_open = True
+
+    def close(self):
+        with self._open_lock:
+            if self.is_open:
+                self._close()
+                self.is_open = False
+
+    def configure(self, main_size=None, lores_size=None, formats=None):
+        """تغییر اندازه/فرمت استریم‌ها"""
+        if main_size:
+            self.sizes["main"] = tuple(main_size)
+        if lores_size:
+            self.sizes["lores"] = tuple(lores_size)
+        if formats:
+            self.formats.update(formats)
+        if self.is_open:
+            self._reconfigure()
+
+    # --- خواندن فریم ---
+    def capture_array(self, name="main"):
+        frame, _ = self.capture_with_timestamp(name)
+        return frame
+
+    def capture_with_timestamp(self, name="main"):
+        """
+        :return: (frame, timestamp_ns) که timestamp زمان سنسور یا monotonic است
+        """
+        self.open()
+        return self._capture(name)
+
+    @contextmanager
+    def mapped(self, name="main"):
+        """
+        دسترسی بدون کپی به فریم: (array, timestamp_ns)
+        آرایه فقط داخل بلوک with معتبر است و نباید نگه داشته شود
+        """
+        self.open()
+        yield self._capture_view(name)
+
+    @contextmanager
+    def mapped_with(self, name, other):
+        """
+        مثل mapped و از همان درخواست (همان فریم سنسور) یک کپی از استریم other: (array، timestamp_ns، other_array)
+        برای tap تحلیل در حین ضبط؛ capture جدا برای other منتظر فریم بعدی می‌ماند و نرخ ضبط را نصف می‌کند
+        other_array کپی است و می‌تواند نگه داشته شود
+        """
+        self.open()
+        yield self._capture_views(name, other)
+
+    def capture_into(self, name, out=None, code=None):
+        """
+        نوشتن فریم مستقیماً در بافر از پیش تخصیص داده (با تبدیل رنگ اختیاری cvtColor)
+        :return: (out, timestamp_ns)
+        """
+        with self.mapped(name) as (frame, timestamp):
+            if out is None and code is None:
+                return frame.copy(), timestamp
+            return _convert(frame, code, out), timestamp
+
+    def capture_file(self, path, name="main"):
+        """ذخیره یک فریم کامل در فایل"""
+        frame = self.capture_array(name)
+        if not cv2.imwrite(path, format_to_bgr(frame, self.formats[name])):
+            raise RuntimeError(f"Could not write {path}")
+        return path
+
+    # --- برای پیاده‌سازی در زیرکلاس‌ها ---
+    def _open(self):
+        pass
+
+    def _close(self):
+        pass
+
+    def _reconfigure(self):
+        pass
+
+    def _capture(self, name):
+        raise NotImplementedError
+
+    def _capture_view(self, name):
+        # پیش‌فرض: همان آرایه تازه؛ زیرکلاس‌ها بافر مشترک برمی‌گردانند
+        return self._capture(name)
+
+    def _capture_views(self, name, other):
+        raise NotImplementedError
+
+
+# -----------------------
+# Picamera2
+# -----------------------
+class Picamera2Source(FrameSource):
+    # حداکثر زمان انتظار برای آماده شدن سنسور بعد از start
+    READY_TIMEOUT = 2.0
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.picam2 = None
+        self._configs = {}  # پیکربندی‌های ساخته شده، کلید: اندازه‌ها و فرمت‌ها
+
+    def _build_config(self):
+        key = (self.sizes["main"], self.sizes["lores"], self.formats["main"], self.formats["lores"])
+        if key not in self._configs:
+            self._configs[key] = self.picam2.create_video_configuration(
+                main={"size": self.sizes["main"], "format": self.formats["main"]},
+                lores={"size": self.sizes["lores"], "format": self.formats["lores"]},
+                display="lores",
+                encode="main",
+                controls={"FrameRate": self.fps}
+            )
+        return self._configs[key]
+
+    def _wait_ready(self):
+        """به جای sleep ثابت: صبر تا اولین فریم کامل و قفل شدن AE (حداکثر READY_TIMEOUT)"""
+        deadline = time.monotonic() + self.READY_TIMEOUT
+        while True:
+            metadata = self.picam2.capture_metadata()
+            if metadata.get("AeLocked", True) or time.monotonic() > deadline:
+                return
+
+    def _open(self):
+        # import با تأخیر تا روی سیستم بدون دوربین هم ماژول قابل import باشد
+        from picamera2 import Picamera2
+        self.picam2 = Picamera2()
+        self.picam2.configure(self._build_config())
+        self.picam2.start()
+        self._wait_ready()
+
+    def _close(self):
+        self.picam2.stop()
+        self.picam2.close()
+        self.picam2 = None
+        self._configs = {}
+
+    def _reconfigure(self):
+        self.picam2.stop()
+        self.picam2.configure(self._build_config())
+        self.picam2.start()
+        self._wait_ready()
+
+    def _capture(self, name):
+        request = self.picam2.capture_request()
+        try:
+            frame = request.make_array(name)
+            timestamp = request.get_metadata().get("SensorTimestamp", time.monotonic_ns())
+        finally:
+            request.release()
+        return frame, timestamp
+
+    @contextmanager
+    def mapped(self, name="main"):
+        """نگاشت مستقیم بافر dmabuf درخواست؛ بدون کپی به آرایه numpy جدید"""
+        from picamera2 import MappedArray
+        self.open()
+        request = self.picam2.capture_request()
+        try:
+            timestamp = request.get_metadata().get("SensorTimestamp", time.monotonic_ns())
+            width = self.sizes[name][0]
+            with MappedArray(request, name) as m:
+                array = m.array
+                if self.formats[name] == "YUV420" and array.shape[1] != width:
+                    # stride با عرض فرق دارد؛ صفحه‌های U/V پیوسته نیستند پس کپی لازم است
+                    array = request.make_array(name)
+                yield array, timestamp
+        finally:
+            request.release()
+
+    @contextmanager
+    def mapped_with(self, name, other):
+        """یک capture_request برای هر دو استریم"""
+        from picamera2 import MappedArray
+        self.open()
+        request = self.picam2.capture_request()
+        try:
+            timestamp = request.get_metadata().get("SensorTimestamp", time.monotonic_ns())
+            other_array = request.make_array(other)
+            width = self.sizes[name][0]
+            with MappedArray(request, name) as m:
+                array = m.array
+                if self.formats[name] == "YUV420" and array.shape[1] != width:
+                    array = request.make_array(name)
+                yield array, timestamp, other_array
+        finally:
+            request.release()
+
+    def capture_file(self, path, name="main"):
+        self.open()
+        self.picam2.capture_file(path, name=name)
+        return path
+
+
+# -----------------------
+# منابع نرم‌افزاری (بدون سخت‌افزار)
+# -----------------------
+class _PacedSource(FrameSource):
+    """منبعی که مثل دوربین تا فریم بعدی صبر می‌کند (realtime=False: با حداکثر سرعت)"""
+
+    def __init__(self, *args, realtime=True, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.realtime = realtime
+        self._t0 = None
+        self._last_index = -1
+
+    def _open(self):
+        self._t0 = time.monotonic()
+        self._last_index = -1
+        self._views = {}
+
+    def _next_index(self):
+        if not self.realtime:
+            self._last_index += 1
+            return self._last_index
+        index = int((time.monotonic() - self._t0) * self.fps)
+        if index <= self._last_index:
+            index = self._last_index + 1
+            time.sleep(max(0.0, self._t0 + index / self.fps - time.monotonic()))
+        self._last_index = index
+        return index
+
+    def _capture(self, name):
+        frame, timestamp = self._capture_view(name)
+        return frame.copy(), timestamp
+
+    def _capture_view(self, name):
+        # مثل بافر دوربین: هر استریم یک بافر ثابت دارد که در capture بعدی بازنویسی می‌شود
+        index = self._next_index()
+        return self._view_at(index, name), int((self._t0 + index / self.fps) * 1e9)
+
+    def _capture_views(self, name, other):
+        # هر دو استریم از یک index، مثل دو استریم یک درخواست دوربین
+        index = self._next_index()
+        other_array = self._view_at(index, other).copy()
+        return self._view_at(index, name), int((self._t0 + index / self.fps) * 1e9), other_array
+
+    def _view_at(self, index, name):
+        frame = self._render(index, self.sizes[name])
+        view = self._views.get(name)
+        if self.formats[name] == "RGB888":
+            view = None  # BGR است؛ بافر render همان بافر ثابت است
+        self._views[name] = bgr_to_format(frame, self.formats[name], dst=view)
+        return self._views[name]
+
+    def _render(self, index, size):
+        raise NotImplementedError
+
+
+class SyntheticSource(_PacedSource):
+    """ذرات روشن متحرک روی زمینه تیره با نویز، برای بنچمارک تشخیص و ردیابی"""
+
+    def __init__(self, *args, particles=200, radius=(2, 8), seed=0, **kwargs):
+        super().__init__(*args, **kwargs)
+        rng = np.random.default_rng(seed)
+        # موقعیت و سرعت نرمال شده (کسری از عرض/ارتفاع تصویر)
+        self.positions = rng.random((particles, 2))
+        self.velocities = rng.normal(0, 0.05, (particles, 2))  # در هر ثانیه
+        self.radii = rng.uniform(radius[0], radius[1], particles)
+        self.intensities = rng.integers(150, 256, particles)
+        self._noise = rng.integers(0, 24, (256, 256), dtype=np.uint8)
+        self._backgrounds = {}
+        self._canvas = {}
+
+    def particle_positions(self, index, size):
+        """موقعیت ذرات (پیکسل) در فریم index؛ برخورد با دیواره به صورت بازتاب"""
+        t = index / self.fps
+        p = (self.positions + self.velocities * t) % 2.0
+        p = np.where(p > 1.0, 2.0 - p, p)
+        return p * np.array(size, dtype=np.float64)
+
+    def _background(self, size):
+        if size not in self._backgrounds:
+            w, h = size
+            reps = (h // 256 + 1, w // 256 + 1)
+            noise = np.tile(self._noise, reps)[:h, :w] + 16
+            self._backgrounds[size] = cv2.cvtColor(noise, cv2.COLOR_GRAY2BGR)
+        return self._backgrounds[size]
+
+    def _render(self, index, size):
+        background = self._background(size)
+        frame = self._canvas.get(size)
+        if frame is None:
+            frame = self._canvas[size] = np.empty_like(background)
+        np.copyto(frame, background)
+        scale = size[0] / LORES_SIZE[0]  # شعاع بر حسب پیکسل lores
+        for (x, y), r, v in zip(self.particle_positions(index, size), self.radii, self.intensities):
+            cv2.circle(frame, (int(x), int(y)), max(1, int(r * scale)), (int(v),) * 3, -1)
+        return frame
+
+
+class ReplaySource(_PacedSource):
+    """پخش دوباره فایل ویدئو، پوشه تصاویر یا الگوی glob (در انتها از اول تکرار می‌شود)"""
+
+    def __init__(self, path, *args, loop=True, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.path = path
+        self.loop = loop
+        self._cap = None
+        self._files = None
+        self._frame = None
+        self._frame_for = None
+        self._frame_index = -1
+        self._resized = {}
+
+    def _open(self):
+        super()._open()
+        if os.path.isdir(self.path):
+            self._files = sorted(f for f in glob.glob(os.path.join(self.path, '*'))
+                                 if f.lower().endswith(IMAGE_EXTENSIONS))
+        elif any(c in self.path for c in '*?['):
+            self._files = sorted(glob.glob(self.path))
+        else:
+            self._cap = cv2.VideoCapture(self.path)
+            if not self._cap.isOpened():
+                raise RuntimeError(f"Cannot open replay source {self.path}")
+        if self._files is not None and not self._files:
+            raise RuntimeError(f"No images found in {self.path}")
+
+    def _close(self):
+        if self._cap is not None:
+            self._cap.release()
+            self._cap = None
+
+    def _read_next(self):
+        if self._files is not None:
+            i = self._frame_index + 1
+            if i >= len(self._files):
+                if not self.loop:
+                    raise EOFError(self.path)
+                i = 0
+            self._frame_index = i
+            return cv2.imread(self._files[i])
+        ok, frame = self._cap.read(self._frame)  # بافر فریم قبلی دوباره استفاده می‌شود
+        if not ok:
+            if not self.loop:
+                raise EOFError(self.path)
+            self._cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            ok, frame = self._cap.read()
+            if not ok:
+                raise RuntimeError(f"Cannot read from {self.path}")
+        return frame
+
+    def _render(self, index, size):
+        # همه استریم‌ها در یک index همان فریم منبع را می‌بینند
+        if index != self._frame_for:
+            self._frame = self._read_next()
+            self._frame_for = index
+        frame = self._frame
+        if (frame.shape[1], frame.shape[0]) != size:
+            resized = self._resized.get(size)
+            frame = self._resized[size] = cv2.resize(frame, size, dst=resized, interpolation=cv2.INTER_AREA)
+        return frame
+
+
+# -----------------------
+# انتخاب منبع از روی پیکربندی
+# -----------------------
+def create_source(spec=None, **kwargs):
+    """
+    ساخت منبع از روی رشته پیکربندی (مثل CAMERA_SOURCE)
+    :param spec: 'picamera2' | 'synthetic' | 'replay:<path>'
+    """
+    spec = spec or os.environ.get("CAMERA_SOURCE", "picamera2")
+    if spec == "picamera2":
+        return Picamera2Source(**kwargs)
+    if spec == "synthetic":
+        return SyntheticSource(**kwargs)
+    if spec.startswith("replay:"):
+        return ReplaySource(spec[len("replay:"):], **kwargs)
+    raise ValueError(f"Unknown frame source: {spec}")
+
+
+_source = None
+_source_lock = Lock()
+
+
+def get_source(**kwargs):
+    """منبع مشترک برنامه (ساخته می‌شود ولی تا اولین capture باز نمی‌شود)"""
+    global _source
+    with _source_lock:
+        if _source is None:
+            _source = create_source(**kwargs)
+        return _source
+
+
+if __name__ == "__main__":
+    # بنچمارک سرعت منبع بدون سخت‌افزار
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Frame source benchmark")
+    parser.add_argument("--source", default="synthetic")
+    parser.add_argument("--stream", default="main", choices=["main", "lores"])
+    parser.add_argument("--frames", type=int, default=60)
+    parser.add_argument("--max-speed", action="store_true", help="بدون زمان‌بندی realtime")
+    args = parser.parse_args()
+
+    kwargs = {} if args.source == "picamera2" else {"realtime": not args.max_speed}
+    source = create_source(args.source, **kwargs)
+    t0 = time.monotonic()
+    for _ in range(args.frames):
+        frame = source.capture_array(args.stream)
+    elapsed = time.monotonic() - t0
+    source.close()
+    print(f"{args.source} {args.stream} {frame.shape} {frame.dtype}: {args.frames / elapsed:.1f} fps")
@@ -0,0 +1,323 @@
+#! /usr/bin/env python3
+"""
+job_scheduler.py
+زمان‌بند کارهای دوربین: عکس، ضبط و تحلیل به صورت job با id، وضعیت، پیشرفت، لغو و اولویت
+
+درخواست HTTP فقط job را ثبت می‌کند و فوراً برمی‌گردد؛ هر lane (مثلاً camera و analysis) یک
+رشته دارد که کارهایش را به ترتیب اولویت و یکی‌یکی اجرا می‌کند، پس دو ضبط هرگز همزمان شروع نمی‌شوند
+و متغیرهای سراسری recording بین درخواست‌ها race ندارند
+
+پیش‌دستی: کار preempt (عکس) وقتی کار در حال اجرای lane قابل پیش‌دستی است (ضبط) منتظر نمی‌ماند و
+همان لحظه در رشته جدا اجرا می‌شود؛ پیکربندی دو استریمی دائمی اجازه می‌دهد عکس از main گرفته شود
+بدون این که ضبط متوقف شود
+
+تغییرات با شماره نسخه منتشر می‌شوند (مثل FrameHub): wait_for(version) تا تغییر بعدی می‌خوابد و
+کارهای تغییر کرده را برمی‌گرداند؛ endpoint های SSE روی همین ساخته می‌شوند
+"""
+
+import time
+import heapq
+import itertools
+import uuid
+from threading import Condition, Event, Lock, Thread
+
+PRIORITIES = {"high": 0, "normal": 10, "low": 20}
+FINAL_STATES = ("done", "failed", "cancelled")
+
+
+class Job:
+    def __init__(self, scheduler, kind, fn, args, kwargs, priority, lane, preemptible):
+        self.scheduler = scheduler
+        self.id = uuid.uuid4().hex[:12]
+        self.kind = kind
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.priority = priority
+        self.lane = lane
+        self.preemptible = preemptible
+        self.state = "queued"    # queued، running، done، failed، cancelled
+        self.progress = None     # 0..1 یا None وقتی نامعلوم است (مثلاً ضبط بدون مدت)
+        self.message = ""
+        self.result = None
+        self.error = None
+        self.preempted = False
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.version = 0
+        self.on_cancel = None    # تابعی که کار در حال اجرا را متوقف می‌کند (مثلاً stop_recording)
+        self._cancel = Event()
+
+    @property
+    def cancelled(self):
+        """کار در حال اجرا باید این را بررسی کند و زود برگردد"""
+        return self._cancel.is_set()
+
+    def update(self, progress=None, message=None):
+        """گزارش پیشرفت از داخل کار؛ تغییرهای کمتر از 1% منتشر نمی‌شوند"""
+        changed = message is not None and message != self.message
+        if progress is not None:
+            progress = min(1.0, max(0.0, progress))
+            changed = changed or self.progress is None or abs(progress - self.progress) >= 0.01
+            self.progress = progress
+        if message is not None:
+            self.message = message
+        if changed:
+            self.scheduler._notify(self)
+
+    def summary(self):
+        return {
+            "id": self.id, "kind": self.kind, "state": self.state, "lane": self.lane,
+            "priority": self.priority, "progress": self.progress, "message": self.message,
+            "result": self.result, "error": self.error, "preempted": self.preempted,
+            "created": self.created, "started": self.started, "finished": self.finished,
+            "version": self.version,
+        }
+
+
+class JobScheduler:
+    def __init__(self, lanes=("camera",), keep=200):
+        """
+        :param lanes: نام lane ها؛ هر lane یک رشته و صف اولویت جدا دارد
+        :param keep: حداکثر کارهای تمام شده که برای /jobs نگه داشته می‌شوند
+        """
+        self.lanes = tuple(lanes)
+        self.keep = keep
+        self._lock = Lock()
+        self._changed = Condition(self._lock)
+        self._queues = {lane: [] for lane in self.lanes}
+        self._current = {lane: None for lane in self.lanes}
+        self._seq = itertools.count()
+        self._jobs = {}
+        self._threads = []
+        self._listeners = []
+        self._running = False
+        self.version = 0
+        self.preemptions = 0
+
+    # -----------------------
+    # رشته هر lane
+    # -----------------------
+    def start(self):
+        with self._lock:
+            if self._running:
+                return
+            self._running = True
+            self._threads = [Thread(target=self._loop, args=(lane,), name=f"jobs-{lane}", daemon=True)
+                             for lane in self.lanes]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self, timeout=5.0):
+        with self._lock:
+            self._running = False
+            self._changed.notify_all()
+        for thread in self._threads:
+            thread.join(timeout=timeout)
+        self._threads = []
+
+    def _loop(self, lane):
+        while True:
+            with self._lock:
+                while self._running and not self._queues[lane]:
+                    self._changed.wait()
+                if not self._running:
+                    return
+                job = heapq.heappop(self._queues[lane])[2]
+                if job.state != "queued":
+                    continue  # در صف لغو شده
+                self._current[lane] = job
+            self._run(job)
+            with self._lock:
+                self._current[lane] = None
+
+    def _run(self, job):
+        with self._lock:
+            job.state = "running"
+            job.started = time.time()
+            self._bump(job)
+        try:
+            result = job.fn(job, *job.args, **job.kwargs)
+            state, error = ("cancelled" if job.cancelled else "done"), None
+        except Exception as e:
+            print(f"[Job Error]: {job.kind} {job.id}: {e}")
+            result, state, error = None, "failed", str(e)
+        with self._lock:
+            job.result = result
+            job.state = state
+            job.error = error
+            if state == "done":
+                job.progress = 1.0
+            job.finished = time.time()
+            self._bump(job)
+            self._prune()
+
+    # -----------------------
+    # ثبت و کنترل کارها
+    # -----------------------
+    def submit(self, kind, fn, args=(), kwargs=None, priority="normal", lane=None, preempt=False,
+               preemptible=False):
+        """
+        :param fn: fn(job, *args, **kwargs)؛ مقدار برگشتی در result ذخیره می‌شود (باید JSON پذیر باشد)
+        :param priority: 'high'، 'normal'، 'low' یا عدد (کمتر زودتر)
+        :param preempt: اگر کار در حال اجرای lane قابل پیش‌دستی است، بدون انتظار اجرا شود
+        :param preemptible: کارهای preempt می‌توانند در حین اجرای این کار اجرا شوند
+        :return: وضعیت job
+        """
+        lane = lane or self.lanes[0]
+        if lane not in self._queues:
+            raise ValueError(f"Unknown lane: {lane}")
+        priority = PRIORITIES.get(priority, priority)
+        job = Job(self, kind, fn, args, kwargs or {}, priority, lane, preemptible)
+        with self._lock:
+            self._jobs[job.id] = job
+            current = self._current[lane]
+            run_now = preempt and current is not None and current.preemptible and current.state == "running"
+            if run_now:
+                job.preempted = True
+                self.preemptions += 1
+            else:
+                heapq.heappush(self._queues[lane], (priority, next(self._seq), job))
+            self._bump(job)
+        if run_now:
+            Thread(target=self._run, args=(job,), name=f"jobs-{lane}-preempt", daemon=True).start()
+        return job.summary()
+
+    def cancel(self, job_id):
+        """
+        کار در صف فوراً لغو می‌شود؛ کار در حال اجرا علامت لغو می‌گیرد و on_cancel آن صدا زده می‌شود
+        :return: وضعیت job یا None
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            if job.state in FINAL_STATES:
+                return job.summary()
+            job._cancel.set()
+            if job.state == "queued":
+                job.state = "cancelled"
+                job.finished = time.time()
+            self._bump(job)
+            on_cancel = job.on_cancel if job.state == "running" else None
+        if on_cancel is not None:
+            try:
+                on_cancel()
+            except Exception as e:
+                print(f"[Job Cancel Error]: {e}")
+        return job.summary()
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return job.summary() if job is not None else None
+
+    def jobs(self, kind=None):
+        with self._lock:
+            return [job.summary() for job in self._jobs.values() if kind is None or job.kind == kind]
+
+    def wait(self, job_id, timeout=None):
+        """انتظار تا پایان یک کار؛ :return: وضعیت job"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._lock:
+            while True:
+                job = self._jobs.get(job_id)
+                if job is None or job.state in FINAL_STATES:
+                    return job.summary() if job is not None else None
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return job.summary()
+                self._changed.wait(remaining)
+
+    # -----------------------
+    # انتشار تغییرات
+    # -----------------------
+    def add_listener(self, fn):
+        """fn(job_summary) با هر تغییر؛ با قفل زمان‌بند صدا زده می‌شود پس باید سریع باشد (مثلاً EventBus.publish)"""
+        self._listeners.append(fn)
+
+    def _bump(self, job):
+        """lock باید گرفته شده باشد"""
+        self.version += 1
+        job.version = self.version
+        self._changed.notify_all()
+        for fn in self._listeners:
+            try:
+                fn(job.summary())
+            except Exception as e:
+                print(f"[Job Listener Error]: {e}")
+
+    def _notify(self, job):
+        with self._lock:
+            self._bump(job)
+
+    def wait_for(self, version, timeout=None, job_id=None):
+        """
+        انتظار تا تغییری بعد از version
+        :return: (version جدید، فهرست وضعیت کارهای تغییر کرده)؛ در timeout فهرست خالی
+        """
+        with self._lock:
+            self._changed.wait_for(lambda: self.version > version or not self._running, timeout)
+            changed = [job.summary() for job in self._jobs.values()
+                       if job.version > version and (job_id is None or job.id == job_id)]
+            return self.version, sorted(changed, key=lambda job: job["version"])
+
+    def _prune(self):
+        done = [job for job in self._jobs.values() if job.state in FINAL_STATES]
+        for job in sorted(done, key=lambda job: job.finished)[:max(0, len(done) - self.keep)]:
+            del self._jobs[job.id]
+
+    def summary(self):
+        with self._lock:
+            states = {}
+            for job in self._jobs.values():
+                states[job.state] = states.get(job.state, 0) + 1
+            return {
+                "states": states,
+                "queued": {lane: len(queue) for lane, queue in self._queues.items()},
+                "running": {lane: job.id if job else None for lane, job in self._current.items()},
+                "preemptions": self.preemptions,
+                "version": self.version,
+            }
+
+
+if __name__ == "__main__":
+    # تأخیر عکس وقتی ضبط در حال اجراست: صف ساده (منتظر پایان ضبط) در برابر پیش‌دستی
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Job scheduler: still latency during a running record")
+    parser.add_argument("--record", type=float, default=3.0, help="مدت ضبط شبیه‌سازی شده (ثانیه)")
+    parser.add_argument("--still", type=float, default=0.2, help="زمان گرفتن عکس (ثانیه)")
+    args = parser.parse_args()
+
+    def record(job, duration):
+        t0 = time.monotonic()
+        while not job.cancelled and time.monotonic() - t0 < duration:
+            job.update(progress=(time.monotonic() - t0) / duration, message="recording")
+            time.sleep(0.05)
+        return {"seconds": time.monotonic() - t0}
+
+    def still(job):
+        time.sleep(args.still)
+        return {"taken": time.time()}
+
+    for preempt in (False, True):
+        scheduler = JobScheduler()
+        scheduler.start()
+        t0 = time.monotonic()
+        rec = scheduler.submit("record", record, (args.record,), preemptible=True)
+        submit_ms = 1000 * (time.monotonic() - t0)
+        time.sleep(0.5)
+        t1 = time.monotonic()
+        shot = scheduler.submit("capture", still, priority="high", preempt=preempt)
+        scheduler.wait(shot["id"])
+        latency = time.monotonic() - t1
+        version, changed = scheduler.wait_for(0)
+        print(f"preempt={preempt!s:5s}: submit {submit_ms:.2f} ms, still ready after {latency:.2f} s, "
+              f"{version} status events, record {scheduler.get(rec['id'])['state']}")
+        cancelled = scheduler.cancel(rec["id"])
+        scheduler.wait(rec["id"])
+        print(f"  cancel record -> {scheduler.get(rec['id'])['state']} "
+              f"(progress {100 * (cancelled['progress'] or 0):.0f}%) {scheduler.summary()}")
+        scheduler.stop()
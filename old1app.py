@@ -1,35 +1,24 @@
 #! /usr/bin/env python3
 
 from flask import Flask, render_template, Response, request, jsonify
-from picamera2 import Picamera2
 import time
 import os
-from libcamera import controls
 import cv2
 import numpy as np
 from threading import Lock
 import time
 from old1updater import check_and_update
+from frame_pacer import FramePacer
+from frame_source import get_source, format_to_bgr
 
 app = Flask(__name__)
-picam2 = Picamera2()
 
-# Configure camera
-#config = picam2.create_preview_configuration(main={"size": (1920, 1080)})
-config = picam2.create_video_configuration(
-    main={"size": (3840 , 2160)},  # Reduced resolution for better performance
-    lores={"size": (1024, 768)},    # Lower resolution stream
-    display="lores",               # Display lower resolution
-    encode="main"
+# Configure camera (opened lazily on the first capture, not at import)
+camera_source = get_source(
+    main_size=(3840, 2160),   # Full resolution stream
+    lores_size=(1024, 768),   # Lower resolution stream
+    fps=30.0
 )
-picam2.set_controls({
-    #"AfMode": controls.AfModeEnum.Continuous,
-    "FrameRate": 30.0,
-    #"AwbMode": controls.AwbModeEnum.Auto
-})
-picam2.configure(config)
-picam2.start()
-time.sleep(2)  # Allow camera to stabilize
 
 # Video recording variables
 recording = False
@@ -47,8 +36,8 @@ def gen_frames():
     while True:
         try:
             # Capture frame with error handling
-            frame = picam2.capture_array("main")  # Use lower resolution stream
-            frame = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
+            frame = camera_source.capture_array("main")  # Use lower resolution stream
+            frame = format_to_bgr(frame, camera_source.formats["main"])
             
             # Encode as JPEG with quality adjustment
             ret, buffer = cv2.imencode('.jpg', frame, [int(cv2.IMWRITE_JPEG_QUALITY), 80])
@@ -87,25 +76,23 @@ def start_recording():
         recording = True
     
     print(f"Recording started: {video_path}")
-    start_time = time.time()
-    i=0
+    pacer = FramePacer(fps)
+    pacer.start()
     try:
-        t = time.time()
-        while recording and (t - start_time) < 60:
-            t = time.time()
-            # Capture from main stream
-            frame = picam2.capture_array("main")
-            # Convert color space from RGB to BGR
-            frame = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
+        while recording and time.monotonic() - pacer.t0 < 60:
+            # Capture from main stream (blocks until the next sensor frame)
+            frame, timestamp = camera_source.capture_with_timestamp("main")
+            # Place the frame on the output timeline by its sensor timestamp: duplicate or drop to match real time
+            count = pacer.slots_for(timestamp)
+            if count == 0:
+                continue
+            # Convert the stream format to BGR
+            frame = format_to_bgr(frame, camera_source.formats["main"])
             
             with recording_lock:
                 if video_writer is not None:
-                    video_writer.write(frame)
-            
-            time.sleep(1/120)  # Maintain approx 30fps
-            i+=1
-            
-            print("in", t,"i is:",i," ")
+                    for _ in range(count):
+                        video_writer.write(frame)
             
     finally:
         with recording_lock:
@@ -115,6 +102,7 @@ def start_recording():
                 video_writer = None
     
     print(f"Recording saved: {video_path}")
+    print(f"Pacing: {pacer.summary()}")
     return video_path
 
 @app.route('/start_recording', methods=['POST'])
@@ -140,7 +128,7 @@ def capture():
     timestamp = time.strftime("%Y%m%d-%H%M%S")
     filename = f"image_{timestamp}.jpg"
     filepath = os.path.join(IMAGE_FOLDER, filename)
-    picam2.capture_file(filepath)
+    camera_source.capture_file(filepath)
     return {'status': 'success', 'filename': filename}
 
 def Run():
@@ -0,0 +1,293 @@
+#! /usr/bin/env python3
+"""
+raw_capture.py
+ضبط فریم‌های خام (بدون JPEG یا mp4v) در یک stack از پیش تخصیص داده memory-mapped برای تحلیل علمی
+
+فشرده‌سازی با اتلاف جزئیات شدت نور ذرات کوچک را از بین می‌برد و decode دوباره برای تحلیل CPU هدر می‌دهد؛
+اینجا هر فریم مستقیماً از بافر دوربین (mapped، بدون کپی میانی) در جای خود در فایل .npy کپی می‌شود:
+
+    <name>.npy             آرایه (capacity، h، w) یا (capacity، h، w، 3) با هدر استاندارد numpy
+    <name>.timestamps.npy  زمان سنسور هر فریم (int64، ns)؛ صفر یعنی هنوز نوشته نشده
+    <name>.json            stream، plane، decimation، تعداد فریم و وضعیت
+
+plane ها:
+    y       صفحه Y (روشنایی)؛ برای lores با YUV420 فقط یک کپی حافظه، بدون تبدیل رنگ
+    bgr     تصویر رنگی BGR
+    native  آرایه خود استریم بدون هیچ تبدیلی (مثلاً I420 کامل یا XBGR8888)
+
+فضای فایل در شروع با posix_fallocate رزرو می‌شود: پر شدن دیسک وسط ضبط در memmap به جای خطا SIGBUS
+می‌دهد و کل پردازه را می‌کشد، پس کمبود جا باید پیش از اولین فریم دیده شود
+
+open_stack(path) بدون خواندن داده باز می‌کند (np.load با mmap_mode)؛ یک stack ده گیگابایتی فوراً در دسترس
+است و فقط فریم‌هایی که خوانده می‌شوند از دیسک می‌آیند
+"""
+
+import os
+import json
+import time
+import shutil
+import cv2
+import numpy as np
+from frame_source import bgr_code
+
+PLANES = ("y", "bgr", "native")
+
+# تبدیل مستقیم به خاکستری بدون گذر از BGR (YUV420 جدا: صفحه Y خودش خاکستری است)
+_TO_GRAY = {
+    "XBGR8888": cv2.COLOR_RGBA2GRAY,
+    "XRGB8888": cv2.COLOR_BGRA2GRAY,
+    "BGR888": cv2.COLOR_RGB2GRAY,
+    "RGB888": cv2.COLOR_BGR2GRAY,
+}
+
+
+def frame_shape(size, fmt, plane):
+    """شکل هر فریم stack برای اندازه (w، h) و فرمت استریم"""
+    width, height = size
+    if plane == "y":
+        return (height, width)
+    if plane == "bgr":
+        return (height, width, 3)
+    if fmt == "YUV420":
+        return (height * 3 // 2, width)
+    return (height, width, 3 if fmt in ("BGR888", "RGB888") else 4)
+
+
+def copy_plane(frame, fmt, plane, dst):
+    """نوشتن فریم استریم در dst (یک ردیف stack) بدون آرایه موقت"""
+    if plane == "native":
+        np.copyto(dst, frame)
+    elif plane == "bgr":
+        code = bgr_code(fmt)
+        if code is None:
+            np.copyto(dst, frame)
+        else:
+            cv2.cvtColor(frame, code, dst=dst)
+    elif fmt == "YUV420":
+        np.copyto(dst, frame[:dst.shape[0]])
+    else:
+        cv2.cvtColor(frame, _TO_GRAY[fmt], dst=dst)
+    return dst
+
+
+def stack_paths(path):
+    """(frames، timestamps، json) از مسیر .npy یا نام بدون پسوند"""
+    stem = path[:-4] if path.endswith(".npy") else path
+    return stem + ".npy", stem + ".timestamps.npy", stem + ".json"
+
+
+def open_stack(path):
+    """
+    باز کردن stack بدون خواندن داده (فقط خواندنی)
+    تعداد فریم از timestamps خوانده می‌شود تا stack ضبطی که قطع شده هم تا آخرین فریم نوشته شده باز شود
+    :return: (frames memmap، timestamps_ns، meta)
+    """
+    frames_path, ts_path, meta_path = stack_paths(path)
+    meta = {}
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+    frames = np.load(frames_path, mmap_mode="r")
+    timestamps = np.load(ts_path, mmap_mode="r")
+    count = int(np.count_nonzero(timestamps))
+    return frames[:count], np.asarray(timestamps[:count]), meta
+
+
+class RawStack:
+    def __init__(self, path, shape, capacity, dtype=np.uint8, flush_every=64, **meta):
+        """
+        :param path: مسیر <name>.npy
+        :param shape: شکل هر فریم
+        :param capacity: حداکثر تعداد فریم (کل فایل از اول رزرو می‌شود)
+        :param flush_every: هر چند فریم داده به دیسک flush و json به‌روز شود
+        """
+        self.path, self.ts_path, self.meta_path = stack_paths(path)
+        self.capacity = int(capacity)
+        self.flush_every = max(1, int(flush_every))
+        self.bytes = self.capacity * int(np.prod(shape)) * np.dtype(dtype).itemsize
+        folder = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(folder, exist_ok=True)
+        free = shutil.disk_usage(folder).free
+        if self.bytes + 8 * self.capacity > free:
+            raise RuntimeError(f"Not enough space for raw stack: {self.bytes / 2**30:.2f} GB needed, "
+                               f"{free / 2**30:.2f} GB free")
+        self.frames = np.lib.format.open_memmap(self.path, mode="w+", dtype=dtype,
+                                                shape=(self.capacity,) + tuple(shape))
+        self.timestamps = np.lib.format.open_memmap(self.ts_path, mode="w+", dtype=np.int64,
+                                                    shape=(self.capacity,))
+        for file in (self.path, self.ts_path):
+            self._reserve(file)
+        self.count = 0
+        self.meta = dict(meta, shape=list(shape), dtype=np.dtype(dtype).str, capacity=self.capacity,
+                         count=0, complete=False, created=time.time())
+        self._save_meta()
+
+    @staticmethod
+    def _reserve(path):
+        if not hasattr(os, "posix_fallocate"):
+            return
+        with open(path, "r+b") as f:
+            try:
+                os.posix_fallocate(f.fileno(), 0, os.fstat(f.fileno()).st_size)
+            except OSError as e:
+                raise RuntimeError(f"Could not reserve {path}: {e}")
+
+    @property
+    def full(self):
+        return self.count >= self.capacity
+
+    def slot(self):
+        """ردیف بعدی stack برای نوشتن مستقیم (copy_plane)"""
+        return self.frames[self.count]
+
+    def commit(self, timestamp):
+        """ثبت ردیفی که در slot() نوشته شد"""
+        self.timestamps[self.count] = timestamp
+        self.count += 1
+        if self.count % self.flush_every == 0:
+            self.flush()
+
+    def flush(self):
+        self.frames.flush()
+        self.timestamps.flush()
+        self.meta["count"] = self.count
+        self._save_meta()
+
+    def close(self, **fields):
+        self.meta.update(fields, complete=True, finished=time.time())
+        self.flush()
+        del self.frames, self.timestamps
+
+    def _save_meta(self):
+        tmp = self.meta_path + ".tmp"
+        try:
+            with open(tmp, "w") as f:
+                json.dump(self.meta, f, indent=1)
+            os.replace(tmp, self.meta_path)
+        except OSError as e:
+            print(f"[Raw Stack Error]: {e}")
+
+
+class RawCapture:
+    def __init__(self, source, folder, stream="lores", plane="y", decimation=1, flush_every=64):
+        """
+        :param source: FrameSource
+        :param stream: 'lores' یا 'main'
+        :param plane: 'y'، 'bgr' یا 'native'
+        :param decimation: از هر چند فریم دوربین یکی ذخیره شود
+        """
+        if plane not in PLANES:
+            raise ValueError(f"Unknown raw plane: {plane}")
+        if int(decimation) < 1:
+            raise ValueError("decimation must be at least 1")
+        self.source = source
+        self.folder = folder
+        self.stream = stream
+        self.plane = plane
+        self.decimation = int(decimation)
+        self.flush_every = flush_every
+
+    def run(self, frames, name=None, seconds=None, progress=None, cancelled=None):
+        """
+        :param frames: تعداد فریم ذخیره شده (ظرفیت stack)
+        :param seconds: توقف زودتر بعد از این مدت (stack با فریم‌های نوشته شده معتبر می‌ماند)
+        :param progress: progress(fraction، message)
+        :param cancelled: cancelled() -> True برای توقف
+        :return: خلاصه ضبط
+        """
+        if frames < 1:
+            raise ValueError("Raw capture needs at least one frame")
+        name = name or time.strftime("raw_%Y%m%d_%H%M%S")
+        fmt = self.source.formats[self.stream]
+        size = self.source.sizes[self.stream]
+        shape = frame_shape(size, fmt, self.plane)
+        stack = RawStack(os.path.join(self.folder, f"{name}.npy"), shape, frames, flush_every=self.flush_every,
+                         stream=self.stream, format=fmt, plane=self.plane, size=list(size),
+                         decimation=self.decimation, fps=self.source.fps)
+        seen = 0
+        copy_s = 0.0
+        t0 = time.monotonic()
+        try:
+            while not stack.full:
+                if cancelled is not None and cancelled():
+                    break
+                if seconds is not None and time.monotonic() - t0 >= seconds:
+                    break
+                with self.source.mapped(self.stream) as (frame, timestamp):
+                    seen += 1
+                    if (seen - 1) % self.decimation:
+                        continue
+                    t = time.perf_counter()
+                    copy_plane(frame, fmt, self.plane, stack.slot())
+                    copy_s += time.perf_counter() - t
+                stack.commit(timestamp)
+                if progress is not None:
+                    progress(stack.count / frames, f"{stack.count}/{frames} frames")
+        finally:
+            elapsed = time.monotonic() - t0
+            count = stack.count
+            timestamps = np.array(stack.timestamps[:count])
+            stack.close(count=count, seen=seen, seconds=elapsed)
+
+        # فاصله‌های بیشتر از 1.5 برابر فاصله مورد انتظار یعنی فریم‌هایی که ضبط به آن‌ها نرسید
+        expected = 1e9 * self.decimation / self.source.fps
+        gaps = int(np.count_nonzero(np.diff(timestamps) > 1.5 * expected)) if count > 1 else 0
+        frame_bytes = stack.bytes // stack.capacity
+        return {
+            "name": name, "path": stack.path, "timestamps": stack.ts_path, "meta": stack.meta_path,
+            "stream": self.stream, "plane": self.plane, "shape": list(shape), "decimation": self.decimation,
+            "frames": count, "capacity": frames, "seen": seen, "gaps": gaps, "seconds": elapsed,
+            "fps": count / elapsed if elapsed > 0 else 0.0,
+            "mb_per_s": count * frame_bytes / 2**20 / elapsed if elapsed > 0 else 0.0,
+            "copy_ms": 1000 * copy_s / max(1, count),
+            "bytes": stack.bytes,
+        }
+
+
+if __name__ == "__main__":
+    # هزینه ذخیره و خواندن دوباره: stack خام در برابر JPEG (encode در ضبط، decode در تحلیل) و دقت شدت نور
+    import argparse
+    import tempfile
+    from frame_source import create_source
+
+    parser = argparse.ArgumentParser(description="Raw memory-mapped frame stacks vs JPEG for analysis")
+    parser.add_argument("--frames", type=int, default=120)
+    parser.add_argument("--stream", default="lores", choices=["lores", "main"])
+    parser.add_argument("--plane", default="y", choices=PLANES)
+    parser.add_argument("--decimation", type=int, default=1)
+    parser.add_argument("--realtime", action="store_true", help="منبع با سرعت واقعی دوربین (برای gaps)")
+    args = parser.parse_args()
+
+    source = create_source("synthetic", realtime=args.realtime)
+    work = tempfile.mkdtemp(prefix="raw_")
+    capture = RawCapture(source, work, stream=args.stream, plane=args.plane, decimation=args.decimation)
+    result = capture.run(args.frames, name="bench")
+    print(f"{args.stream} {args.plane} {result['shape']}: {result['frames']} frames at {result['fps']:.1f} fps, "
+          f"{result['mb_per_s']:.0f} MB/s, copy {result['copy_ms']:.2f} ms/frame, "
+          f"{result['bytes'] / 2**20:.0f} MB, gaps {result['gaps']}")
+
+    t0 = time.perf_counter()
+    frames, timestamps, meta = open_stack(result["path"])
+    open_ms = 1000 * (time.perf_counter() - t0)
+    t0 = time.perf_counter()
+    order = np.random.default_rng(0).permutation(len(frames))
+    total = sum(int(frames[i].flat[0]) for i in order)
+    read_ms = 1000 * (time.perf_counter() - t0) / len(frames)
+    print(f"open_stack: {open_ms:.2f} ms for {len(frames)} frames; random frame access {read_ms:.3f} ms/frame")
+
+    sample = np.ascontiguousarray(frames[len(frames) // 2])
+    t0 = time.perf_counter()
+    for _ in range(10):
+        ok, jpeg = cv2.imencode(".jpg", sample, [int(cv2.IMWRITE_JPEG_QUALITY), 90])
+    encode_ms = 100 * (time.perf_counter() - t0)
+    t0 = time.perf_counter()
+    for _ in range(10):
+        decoded = cv2.imdecode(jpeg, cv2.IMREAD_UNCHANGED)
+    decode_ms = 100 * (time.perf_counter() - t0)
+    error = np.abs(decoded.astype(np.int16) - sample.astype(np.int16))
+    print(f"JPEG q90 of the same frame: encode {encode_ms:.2f} ms, decode {decode_ms:.2f} ms; "
+          f"intensity error mean {error.mean():.2f}, max {error.max()} levels "
+          f"({100 * np.count_nonzero(error) / error.size:.0f}% of pixels changed)")
+    del frames
+    source.close()
+    shutil.rmtree(work)
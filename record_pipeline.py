@@ -0,0 +1,469 @@
+#! /usr/bin/env python3
+"""
+record_pipeline.py
+ضبط سه مرحله‌ای: capture -> تبدیل رنگ/اندازه -> encode/نوشتن
+مراحل با بافرهای حلقوی محدود با اسلات‌های از پیش تخصیص داده شده به هم وصل‌اند،
+پس کندی لحظه‌ای کارت SD دیگر مستقیماً capture را متوقف نمی‌کند
+
+سیاست فشار برگشتی (backpressure) وقتی بافر پر است:
+    drop-oldest   قدیمی‌ترین فریم منتظر دور ریخته می‌شود (پیش‌فرض)
+    drop-newest   فریم جدید دور ریخته می‌شود
+    block         تولیدکننده صبر می‌کند
+
+با gate (ChangeGate) فریم بدون تغییر کپی و تبدیل نمی‌شود؛ مرحله نوشتن جای خالی آن را
+با آخرین فریم تبدیل شده پر می‌کند تا timeline فایل دست نخورد
+
+با segment_seconds/segment_bytes ضبط به فایل‌های پشت سر هم <stem>_0001.mp4، ... تقسیم می‌شود
+(هر فایل با یک keyframe شروع می‌شود)؛ هر فایل بسته شده فوراً به on_segment داده می‌شود
+"""
+
+import os
+import time
+import cv2
+import numpy as np
+from collections import deque
+from contextlib import contextmanager
+from threading import Condition, Thread
+from recorders import Recorder, FrameStats
+from frame_source import format_to_bgr
+from frame_pacer import FramePacer
+
+POLICIES = ("drop-oldest", "drop-newest", "block")
+
+
+class FrameRing:
+    """بافر حلقوی محدود با اسلات‌های numpy که دوباره استفاده می‌شوند"""
+
+    def __init__(self, capacity, policy="drop-oldest", name="ring"):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown backpressure policy: {policy}")
+        self.name = name
+        self.capacity = capacity
+        self.policy = policy
+        self.slots = [None] * capacity
+        self.meta = [None] * capacity
+        self._free = deque(range(capacity))
+        self._ready = deque()
+        self._cond = Condition()
+        self.closed = False
+
+        # شمارنده‌ها
+        self.put = 0
+        self.got = 0
+        self.dropped = 0
+        self.max_depth = 0
+
+    def slot(self, index, shape, dtype):
+        """آرایه اسلات؛ فقط وقتی اندازه عوض شود دوباره تخصیص داده می‌شود"""
+        buf = self.slots[index]
+        if buf is None or buf.shape != shape or buf.dtype != dtype:
+            buf = self.slots[index] = np.empty(shape, dtype)
+        return buf
+
+    def acquire(self, timeout=None):
+        """
+        گرفتن یک اسلات خالی برای نوشتن
+        :return: index یا None (فریم طبق سیاست drop-newest دور ریخته شد یا بافر بسته است)
+        """
+        with self._cond:
+            while not self._free:
+                if self.closed:
+                    return None
+                if self.policy == "drop-newest":
+                    self.dropped += 1
+                    return None
+                if self.policy == "drop-oldest" and self._ready:
+                    self.dropped += 1
+                    return self._ready.popleft()
+                if not self._cond.wait(timeout):
+                    return None
+            return self._free.popleft()
+
+    def commit(self, index, meta=None):
+        with self._cond:
+            self.meta[index] = meta
+            self._ready.append(index)
+            self.put += 1
+            self.max_depth = max(self.max_depth, len(self._ready))
+            self._cond.notify_all()
+
+    def get(self, timeout=None):
+        """
+        گرفتن قدیمی‌ترین اسلات آماده
+        :return: index یا None اگر بافر بسته و خالی است (یا timeout)
+        """
+        with self._cond:
+            while not self._ready:
+                if self.closed or not self._cond.wait(timeout):
+                    return None
+            self.got += 1
+            return self._ready.popleft()
+
+    def release(self, index):
+        """برگرداندن اسلات به فهرست خالی‌ها بعد از مصرف"""
+        with self._cond:
+            self._free.append(index)
+            self._cond.notify_all()
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+    @property
+    def depth(self):
+        return len(self._ready)
+
+    def summary(self):
+        return {"put": self.put, "got": self.got, "dropped": self.dropped,
+                "depth": self.depth, "max_depth": self.max_depth, "capacity": self.capacity}
+
+
+class StageStats:
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.busy = 0.0
+        self.started = None
+
+    def add(self, seconds):
+        self.items += 1
+        self.busy += seconds
+
+    def summary(self):
+        elapsed = time.monotonic() - self.started if self.started else 0.0
+        return {
+            "items": self.items,
+            "throughput_fps": self.items / elapsed if elapsed else 0.0,
+            "busy_ms_per_item": 1000 * self.busy / self.items if self.items else 0.0,
+        }
+
+
+class RecordingPipeline(Recorder):
+    def __init__(self, *args, fourcc='mp4v', capacity=8, policy="drop-oldest", roi=None, gate=None,
+                 segment_seconds=None, segment_bytes=None, on_segment=None, **kwargs):
+        """
+        :param roi: (x, y, w, h) پیکسل در استریم ضبط؛ فقط همین ناحیه کپی و ضبط می‌شود
+        :param gate: ChangeGate یا None؛ فریم‌های بدون تغییر از capture به بعد رد می‌شوند
+        :param segment_seconds: طول هر فایل (ثانیه timeline)؛ None یعنی یک فایل
+        :param segment_bytes: حداکثر حجم هر فایل (حدودی، هر ثانیه بررسی می‌شود)
+        :param on_segment: on_segment(dict) بعد از بسته شدن هر فایل (در رشته نوشتن)
+        """
+        super().__init__(*args, **kwargs)
+        self.fourcc = fourcc
+        self.roi = roi
+        self.gate = gate
+        self.segment_seconds = segment_seconds
+        self.segment_bytes = segment_bytes
+        self.on_segment = on_segment
+        self.segments = []
+        self._segment = None
+        self.capacity = capacity
+        self.policy = policy
+        self.video_writer = None
+        self.pacer = FramePacer(self.fps)
+        self._threads = []
+        self._stream = "main"
+        self.error = None
+
+    def start(self, path):
+        self._stream = self.modes.prepare("record") if self.modes is not None else "main"
+        if self.roi is not None and self.source.formats[self._stream] == "YUV420":
+            raise ValueError("ROI recording needs a packed (RGB/XBGR) stream")
+        self.path = path
+        self.segments = []
+        self.error = None
+        self._open_segment()
+
+        self.captured = FrameRing(self.capacity, self.policy, name="captured")
+        self.converted = FrameRing(self.capacity, self.policy, name="converted")
+        self.stages = {name: StageStats(name) for name in ("capture", "convert", "write")}
+        self.stats = FrameStats(self.fps)
+        self.stats.start()
+        self.pacer.reset()
+        if self.gate is not None:
+            self.gate.reset()
+        self.gated = 0
+        self._tail = None       # timestamp آخرین فریم رد شده بعد از آخرین فریم نوشته شده
+        self.recording = True
+
+        self._threads = []
+        for name, target in (("capture", self._capture_loop),
+                             ("convert", self._convert_loop),
+                             ("write", self._write_loop)):
+            self.stages[name].started = time.monotonic()
+            thread = Thread(target=target, name=f"record-{name}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    # -----------------------
+    # فایل‌ها (قطعه‌ها)
+    # -----------------------
+    @property
+    def segmented(self):
+        return bool(self.segment_seconds or self.segment_bytes)
+
+    def _open_segment(self):
+        index = len(self.segments) + 1
+        path = self.path
+        if self.segmented:
+            stem, ext = os.path.splitext(self.path)
+            path = f"{stem}_{index:04d}{ext}"
+        writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*self.fourcc), self.fps, self.frame_size)
+        if not writer.isOpened():
+            raise RuntimeError(f"VideoWriter failed for {path}")
+        self.video_writer = writer
+        self._segment = {"index": index, "name": os.path.basename(path), "path": path,
+                         "start_ns": None, "end_ns": None, "frames": 0, "bytes": 0}
+
+    def _close_segment(self):
+        # بعد از خطای نوشتن ممکن است فایلی باز نباشد (مثلاً باز کردن قطعه بعدی شکست خورده)
+        if self.video_writer is not None:
+            self.video_writer.release()
+            self.video_writer = None
+        segment, self._segment = self._segment, None
+        if segment is None:
+            return
+        try:
+            segment["bytes"] = os.path.getsize(segment["path"])
+        except OSError:
+            pass
+        self.segments.append(segment)
+        if self.on_segment is not None:
+            try:
+                self.on_segment(dict(segment))
+            except Exception as e:
+                print(f"[Segment Callback Error]: {e}")
+
+    def _segment_full(self):
+        frames = self._segment["frames"]
+        if not frames:
+            return False
+        if self.segment_seconds and frames >= self.segment_seconds * self.fps:
+            return True
+        if self.segment_bytes and frames % int(self.fps) == 0:
+            return os.path.getsize(self._segment["path"]) >= self.segment_bytes
+        return False
+
+    def _write(self, frame, timestamp):
+        """نوشتن یک جایگاه timeline؛ اگر فایل فعلی پر است اول فایل بعدی باز می‌شود"""
+        if self.segmented and self._segment_full():
+            self._close_segment()
+            self._open_segment()
+        self.video_writer.write(frame)
+        segment = self._segment
+        if segment["start_ns"] is None:
+            segment["start_ns"] = timestamp
+        segment["end_ns"] = timestamp
+        segment["frames"] += 1
+
+    # -----------------------
+    # مراحل
+    # -----------------------
+    @contextmanager
+    def _mapped(self):
+        """(frame، timestamp، tap_frame)؛ فریم tap از همان درخواست، بدون capture دوم که نرخ ضبط را نصف کند"""
+        if self.tap is None:
+            with self.source.mapped(self._stream) as (frame, timestamp):
+                yield frame, timestamp, None
+        else:
+            with self.source.mapped_with(self._stream, self.tap_stream) as views:
+                yield views
+
+    def _capture_loop(self):
+        try:
+            while self.recording:
+                index = self.captured.acquire()
+                with self._mapped() as (frame, timestamp, tap_frame):
+                    t = time.monotonic()
+                    self.stats.add(timestamp)
+                    if index is None:
+                        continue
+                    if self.roi is not None:
+                        # برش با view؛ فقط پیکسل‌های ناحیه کپی می‌شوند
+                        x, y, w, h = self.roi
+                        frame = frame[y:y + h, x:x + w]
+                    skip = self.gate is not None and not self.gate.changed(frame, self.source.formats[self._stream])
+                    if not skip:
+                        # کپی مستقیم از بافر دوربین به اسلات ثابت بافر حلقوی
+                        np.copyto(self.captured.slot(index, frame.shape, frame.dtype), frame)
+                if skip:
+                    self.captured.release(index)
+                    self.gated += 1
+                    self._tail = timestamp
+                    self.stages["capture"].add(time.monotonic() - t)
+                    continue
+                self._tail = None
+                self.captured.commit(index, timestamp)
+                if tap_frame is not None:
+                    self.tap(tap_frame)
+                self.stages["capture"].add(time.monotonic() - t)
+        except Exception as e:
+            print(f"[Recording Error]: {e}")
+            self.recording = False
+        finally:
+            self.captured.close()
+
+    def _convert_loop(self):
+        fmt = self.source.formats[self._stream]
+        w, h = self.frame_size
+        scratch = None  # بافر ثابت برای تبدیل رنگ قبل از resize
+        try:
+            while True:
+                index = self.captured.get()
+                if index is None:
+                    break
+                t = time.monotonic()
+                timestamp = self.captured.meta[index]
+                src = self.captured.slots[index]
+                out = self.converted.acquire()
+                if out is None:
+                    self.captured.release(index)
+                    continue
+                dst = self.converted.slot(out, (h, w, 3), np.uint8)
+                if src.shape[:2] == (h, w) and fmt != "YUV420":
+                    format_to_bgr(src, fmt, dst=dst)
+                else:
+                    bgr = format_to_bgr(src, fmt, dst=scratch)
+                    if bgr is not src:
+                        scratch = bgr
+                    cv2.resize(bgr, self.frame_size, dst=dst, interpolation=cv2.INTER_AREA)
+                self.captured.release(index)
+                self.converted.commit(out, timestamp)
+                self.stages["convert"].add(time.monotonic() - t)
+        except Exception as e:
+            self._fail(e)
+        finally:
+            self.converted.close()
+
+    def _write_loop(self):
+        held = None  # با gate آخرین فریم نوشته شده برای پر کردن جای فریم‌های رد شده نگه داشته می‌شود
+        try:
+            while True:
+                index = self.converted.get()
+                if index is None:
+                    break
+                t = time.monotonic()
+                timestamp = self.converted.meta[index]
+                count = self.pacer.slots_for(timestamp)
+                if count and held is not None:
+                    for _ in range(count - 1):
+                        self._write(self.converted.slots[held], timestamp)
+                    count = 1
+                try:
+                    for _ in range(count):
+                        self._write(self.converted.slots[index], timestamp)
+                finally:
+                    if self.gate is None:
+                        self.converted.release(index)
+                    else:
+                        if held is not None:
+                            self.converted.release(held)
+                        held = index
+                self.stages["write"].add(time.monotonic() - t)
+            if held is not None and self._tail is not None:
+                # صحنه تا پایان ضبط ثابت ماند؛ فایل تا timestamp آخرین فریم رد شده ادامه پیدا می‌کند
+                for _ in range(self.pacer.slots_for(self._tail)):
+                    self._write(self.converted.slots[held], self._tail)
+        except Exception as e:
+            self._fail(e)
+        finally:
+            if held is not None:
+                self.converted.release(held)
+
+    def _fail(self, error):
+        """
+        خطا در مرحله تبدیل یا نوشتن: ضبط متوقف و هر دو بافر بسته و خالی می‌شوند تا مراحل دیگر
+        (حتی با سیاست block) منتظر اسلات خالی نمانند؛ stop() خطا را در خلاصه گزارش می‌کند
+        """
+        print(f"[Recording Error]: {error}")
+        if self.error is None:
+            self.error = str(error)
+        self.recording = False
+        for ring in (self.captured, self.converted):
+            ring.close()
+            self._drain(ring)
+
+    @staticmethod
+    def _drain(ring):
+        """برگرداندن فریم‌های منتظر یک بافر بسته به فهرست خالی‌ها"""
+        while True:
+            index = ring.get(timeout=0)
+            if index is None:
+                return
+            ring.release(index)
+
+    def stop(self):
+        """توقف capture؛ فریم‌های داخل بافرها هنوز نوشته می‌شوند"""
+        if self._threads:
+            self.recording = False
+            for thread in self._threads:
+                thread.join()
+            self._threads = []
+            self.stats.stop()
+            self._close_segment()
+        return self.summary()
+
+    def summary(self):
+        if not hasattr(self, "stages"):
+            return self.stats.summary()
+        summary = dict(
+            self.stats.summary(),
+            error=self.error,
+            pacing=self.pacer.summary(),
+            stages={name: stage.summary() for name, stage in self.stages.items()},
+            queues={"captured": self.captured.summary(), "converted": self.converted.summary()},
+        )
+        if self.segmented:
+            summary["segments"] = len(self.segments)
+        if self.gate is not None:
+            convert = self.stages["convert"].summary()["busy_ms_per_item"]
+            summary["gate"] = self.gate.summary(saved_ms_per_frame=convert)
+        return summary
+
+
+if __name__ == "__main__":
+    # شبیه‌سازی کندی I/O: هر چند فریم یک بار نوشتن 200ms طول می‌کشد
+    import argparse
+    import tempfile
+    from frame_source import create_source
+    from camera_modes import CameraModeManager
+
+    parser = argparse.ArgumentParser(description="Recording pipeline under I/O hiccups")
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--policy", default="drop-oldest", choices=POLICIES)
+    parser.add_argument("--capacity", type=int, default=8)
+    parser.add_argument("--hiccup-every", type=int, default=60)
+    args = parser.parse_args()
+
+    source = create_source("synthetic", main_size=(1920, 1080))
+    modes = CameraModeManager(source, modes={"dual": {"main_size": (1920, 1080), "lores_size": (1024, 768)}})
+    pipeline = RecordingPipeline(source, modes, capacity=args.capacity, policy=args.policy)
+
+    writes = [0]
+
+    class SlowWriter:
+        def __init__(self, writer):
+            self.writer = writer
+
+        def write(self, frame):
+            writes[0] += 1
+            if writes[0] % args.hiccup_every == 0:
+                time.sleep(0.2)
+            self.writer.write(frame)
+
+        def release(self):
+            self.writer.release()
+
+    path = os.path.join(tempfile.mkdtemp(), "pipeline.mp4")
+    pipeline.start(path)
+    pipeline.video_writer = SlowWriter(pipeline.video_writer)
+    time.sleep(args.seconds)
+    result = pipeline.stop()
+    source.close()
+
+    print(f"capture fps={result['fps']:.1f} dropped(sensor)={result['dropped']}")
+    for name, stage in result["stages"].items():
+        print(f"  {name:8s} {stage['throughput_fps']:6.1f} fps  {stage['busy_ms_per_item']:6.1f} ms/frame")
+    for name, queue in result["queues"].items():
+        print(f"  {name:9s} max_depth={queue['max_depth']} dropped={queue['dropped']}")
@@ -0,0 +1,368 @@
+#! /usr/bin/env python3
+"""
+recorders.py
+مسیرهای ضبط ویدئو:
+    H264Recorder    استریم main مستقیم به encoder سخت‌افزاری Picamera2 داده می‌شود
+                    (فریم‌ها وارد پایتون نمی‌شوند مگر اینکه tap تحلیل درخواست کند)
+    OpenCVRecorder  مسیر قدیمی capture_array + cvtColor + cv2.VideoWriter(mp4v) به عنوان fallback
+"""
+
+import os
+import time
+import cv2
+from threading import Thread, Lock
+from frame_source import Picamera2Source, format_to_bgr
+from frame_pacer import FramePacer
+
+# محدودیت encoder سخت‌افزاری H.264 روی Raspberry Pi
+H264_MAX_SIZE = (1920, 1080)
+
+
+class FrameStats:
+    """شمارش فریم‌ها و فریم‌های از دست رفته از روی فاصله timestampها"""
+
+    def __init__(self, fps):
+        self.fps = fps
+        self.frames = 0
+        self.dropped = 0
+        self.first_ts = None
+        self.last_ts = None
+        self.started = None
+        self.stopped = None
+        self._cpu_start = None
+        self.cpu_seconds = 0.0
+
+    def start(self):
+        self.started = time.monotonic()
+        self._cpu_start = time.process_time()
+
+    def stop(self):
+        self.stopped = time.monotonic()
+        self.cpu_seconds = time.process_time() - self._cpu_start
+
+    def add(self, timestamp_ns):
+        if self.last_ts is not None:
+            gap = (timestamp_ns - self.last_ts) / 1e9 * self.fps
+            if gap > 1.5:
+                self.dropped += int(round(gap)) - 1
+        else:
+            self.first_ts = timestamp_ns
+        self.last_ts = timestamp_ns
+        self.frames += 1
+
+    def summary(self):
+        end = self.stopped or time.monotonic()
+        duration = end - self.started if self.started else 0.0
+        return {
+            "frames": self.frames,
+            "dropped": self.dropped,
+            "duration": duration,
+            "fps": self.frames / duration if duration else 0.0,
+            "cpu_percent": 100.0 * self.cpu_seconds / duration if duration and self.stopped else None,
+        }
+
+
+class Recorder:
+    """رابط مشترک: start(path) و stop() -> خلاصه آمار"""
+
+    def __init__(self, source, modes=None, frame_size=(1920, 1080), fps=30, tap=None, tap_stream="lores"):
+        self.source = source
+        self.modes = modes
+        self.frame_size = tuple(frame_size)
+        self.fps = fps
+        self.tap = tap
+        self.tap_stream = tap_stream
+        self.path = None
+        self.stats = FrameStats(fps)
+        self.recording = False
+
+    def record(self, path, duration):
+        """ضبط مسدودکننده به مدت duration ثانیه"""
+        self.start(path)
+        try:
+            end = time.monotonic() + duration
+            while self.recording and time.monotonic() < end:
+                time.sleep(0.05)
+        finally:
+            stats = self.stop()
+        return stats
+
+    def start(self, path):
+        raise NotImplementedError
+
+    def stop(self):
+        raise NotImplementedError
+
+
+# -----------------------
+# مسیر سخت‌افزاری H.264
+# -----------------------
+class H264Recorder(Recorder):
+    def __init__(self, *args, bitrate=10000000, sink=None, segment_seconds=10.0, segment_bytes=None,
+                 on_segment=None, **kwargs):
+        """
+        :param sink: DirectWriter یا LocalSink یا None؛ با sink خروجی encoder به قطعه‌های .h264
+                     تقسیم و از طریق sink نوشته می‌شود (path فقط نام پایه قطعه‌ها است)
+        :param on_segment: on_segment(dict) بعد از بسته شدن هر قطعه
+        """
+        super().__init__(*args, **kwargs)
+        self.bitrate = bitrate
+        self.sink = sink
+        self.segment_seconds = segment_seconds
+        self.segment_bytes = segment_bytes
+        self.on_segment = on_segment
+        self.segments = None
+        self._encoder = None
+        self._switched = False
+
+    def _on_request(self, request):
+        """post_callback: فقط metadata خوانده می‌شود؛ آرایه فقط برای tap ساخته می‌شود"""
+        self.stats.add(request.get_metadata().get("SensorTimestamp", time.monotonic_ns()))
+        if self.tap is not None:
+            try:
+                self.tap(request.make_array(self.tap_stream))
+            except Exception as e:
+                print(f"[Tap Error]: {e}")
+
+    def start(self, path):
+        from picamera2.encoders import H264Encoder
+        from picamera2.outputs import FileOutput, FfmpegOutput
+
+        # encoder بیشتر از 1080p را نمی‌پذیرد؛ تنها جایی که تغییر حالت واقعاً لازم است
+        stream = "main"
+        if self.modes is not None:
+            main_size = self.modes.stream_size("main")
+            if main_size[0] > H264_MAX_SIZE[0] or main_size[1] > H264_MAX_SIZE[1]:
+                stream = self.modes.prepare("record", mode="video")
+                self._switched = True
+            else:
+                stream = self.modes.prepare("record")
+
+        self.source.open()
+        picam2 = self.source.picam2
+        self.path = path
+        if self.sink is not None:
+            from direct_writer import SegmentWriter, picamera2_output
+            # SPS/PPS روی هر keyframe تکرار می‌شود تا هر قطعه جدا قابل پخش باشد
+            self.segments = SegmentWriter(self.sink, os.path.splitext(os.path.basename(path))[0], ".h264",
+                                          self.segment_seconds, segment_bytes=self.segment_bytes,
+                                          on_segment=self.on_segment)
+            output = picamera2_output(self.segments)
+            self._encoder = H264Encoder(bitrate=self.bitrate, framerate=self.fps, repeat=True,
+                                        iperiod=int(self.fps))
+        else:
+            output = FfmpegOutput(path) if path.endswith('.mp4') else FileOutput(path)
+            self._encoder = H264Encoder(bitrate=self.bitrate, framerate=self.fps)
+
+        self.stats = FrameStats(self.fps)
+        self.stats.start()
+        picam2.post_callback = self._on_request
+        picam2.start_encoder(self._encoder, output, name=stream)
+        self.recording = True
+
+    def stop(self):
+        if self.recording:
+            self.recording = False
+            picam2 = self.source.picam2
+            picam2.stop_encoder(self._encoder)
+            picam2.post_callback = None
+            self._encoder = None
+            self.stats.stop()
+            if self._switched:
+                self.modes.restore()
+                self._switched = False
+        return self.stats.summary()
+
+
+# -----------------------
+# مسیر OpenCV (fallback)
+# -----------------------
+class OpenCVRecorder(Recorder):
+    def __init__(self, *args, fourcc='mp4v', **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fourcc = fourcc
+        self.video_writer = None
+        self._thread = None
+        self._lock = Lock()
+        self.pacer = FramePacer(self.fps)
+
+    def start(self, path):
+        stream = self.modes.prepare("record") if self.modes is not None else "main"
+        self.path = path
+        fourcc = cv2.VideoWriter_fourcc(*self.fourcc)
+        with self._lock:
+            self.video_writer = cv2.VideoWriter(path, fourcc, self.fps, self.frame_size)
+            if not self.video_writer.isOpened():
+                raise RuntimeError(f"VideoWriter failed for {path}")
+            self.recording = True
+        self.stats = FrameStats(self.fps)
+        self.stats.start()
+        self.pacer.reset()
+        self._thread = Thread(target=self._loop, args=(stream,), name="opencv-recorder", daemon=True)
+        self._thread.start()
+
+    def _convert(self, frame, stream):
+        frame = format_to_bgr(frame, self.source.formats[stream])
+        if (frame.shape[1], frame.shape[0]) != self.frame_size:
+            frame = cv2.resize(frame, self.frame_size, interpolation=cv2.INTER_AREA)
+        return frame
+
+    def _loop(self, stream):
+        try:
+            while self.recording:
+                if self.tap is None:
+                    frame, timestamp = self.source.capture_with_timestamp(stream)
+                else:
+                    # فریم tap از همان درخواست؛ capture دوم نرخ ضبط را نصف می‌کرد
+                    with self.source.mapped_with(stream, self.tap_stream) as (frame, timestamp, tap_frame):
+                        frame = frame.copy()
+                    self.tap(tap_frame)
+                if frame is None:
+                    print("Warning: Empty frame captured")
+                    continue
+                self.stats.add(timestamp)
+
+                # capture خودش تا فریم بعدی سنسور صبر می‌کند؛ sleep اضافه نمی‌خواهد
+                # فریم در جایگاه timestamp خودش نوشته می‌شود (تکرار/حذف برای حفظ timeline)
+                count = self.pacer.slots_for(timestamp)
+                if count == 0:
+                    continue
+                frame = self._convert(frame, stream)
+                with self._lock:
+                    if self.video_writer is not None:
+                        for _ in range(count):
+                            self.video_writer.write(frame)
+        except Exception as e:
+            print(f"[Recording Error]: {e}")
+        finally:
+            self.recording = False
+
+    def stop(self):
+        self.recording = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+            self.stats.stop()
+        with self._lock:
+            if self.video_writer is not None:
+                self.video_writer.release()
+                self.video_writer = None
+        return dict(self.stats.summary(), pacing=self.pacer.summary())
+
+
+def hardware_encoder_available(source):
+    """encoder سخت‌افزاری فقط با منبع Picamera2 و وجود picamera2.encoders"""
+    if not isinstance(source, Picamera2Source):
+        return False
+    try:
+        import picamera2.encoders  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def create_recorder(source, modes=None, prefer="h264", **kwargs):
+    """
+    انتخاب مسیر ضبط
+    :param prefer: 'h264'، 'pipeline' یا 'opencv'؛ در نبود سخت‌افزار h264 به pipeline برمی‌گردد
+    """
+    if prefer == "h264" and hardware_encoder_available(source):
+        return H264Recorder(source, modes, **kwargs)
+    if prefer in ("h264", "pipeline"):
+        from record_pipeline import RecordingPipeline
+        return RecordingPipeline(source, modes, **kwargs)
+    return OpenCVRecorder(source, modes, **kwargs)
+
+
+# -----------------------
+# بنچمارک: encoder جایگزین در نبود سخت‌افزار
+# -----------------------
+class StandInEncoderRecorder(Recorder):
+    """
+    شبیه‌ساز مسیر سخت‌افزاری: بافر فریم بدون cvtColor/resize/VideoWriter مستقیماً
+    به خروجی داده می‌شود (مثل dmabuf که به encoder تحویل می‌شود)
+    """
+
+    def __init__(self, *args, sink=None, segment_seconds=10.0, segment_bytes=None, on_segment=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.sink = sink
+        self.segment_seconds = segment_seconds
+        self.segment_bytes = segment_bytes
+        self.on_segment = on_segment
+        self.segments = None
+        self._thread = None
+        self._file = None
+
+    def start(self, path):
+        stream = self.modes.prepare("record") if self.modes is not None else "main"
+        self.path = path
+        if self.sink is not None:
+            from direct_writer import SegmentWriter
+            self.segments = SegmentWriter(self.sink, os.path.splitext(os.path.basename(path))[0], ".h264",
+                                          self.segment_seconds, segment_bytes=self.segment_bytes,
+                                          on_segment=self.on_segment)
+        else:
+            self._file = open(path, 'wb', buffering=0)
+        self.stats = FrameStats(self.fps)
+        self.stats.start()
+        self.recording = True
+        self._thread = Thread(target=self._loop, args=(stream,), daemon=True)
+        self._thread.start()
+
+    def _loop(self, stream):
+        index = 0
+        while self.recording:
+            frame, timestamp = self.source.capture_with_timestamp(stream)
+            self.stats.add(timestamp)
+            # encoder واقعی حدود 1/50 حجم خام را می‌نویسد
+            packet = memoryview(frame).cast('B')[:frame.nbytes // 50]
+            if self.segments is not None:
+                # یک keyframe در هر ثانیه، مثل iperiod=fps
+                self.segments.write(packet, index % int(self.fps) == 0, timestamp / 1e9)
+            else:
+                self._file.write(packet)
+            index += 1
+
+    def stop(self):
+        self.recording = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+            self.stats.stop()
+            if self.segments is not None:
+                self.segments.close()
+            else:
+                self._file.close()
+        return self.stats.summary()
+
+
+if __name__ == "__main__":
+    import argparse
+    import tempfile
+    from frame_source import create_source
+    from camera_modes import CameraModeManager
+
+    parser = argparse.ArgumentParser(description="Compare H.264 and OpenCV recording paths")
+    parser.add_argument("--source", default="synthetic")
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--fps", type=float, default=30)
+    args = parser.parse_args()
+
+    out_dir = tempfile.mkdtemp(prefix="record_bench_")
+    results = {}
+    for name in ("h264", "opencv"):
+        source = create_source(args.source, fps=args.fps)
+        modes = CameraModeManager(source)
+        if name == "h264":
+            recorder = (H264Recorder(source, modes, fps=args.fps) if hardware_encoder_available(source)
+                        else StandInEncoderRecorder(source, modes, fps=args.fps))
+        else:
+            recorder = OpenCVRecorder(source, modes, fps=args.fps)
+        source.open()
+        path = os.path.join(out_dir, f"bench_{name}.mp4")
+        results[type(recorder).__name__] = recorder.record(path, args.seconds)
+        source.close()
+
+    for name, r in results.items():
+        print(f"{name:24s} fps={r['fps']:6.1f} dropped={r['dropped']:5d} "
+              f"frames={r['frames']:5d} cpu={r['cpu_percent']:.0f}%")
@@ -0,0 +1,350 @@
+#! /usr/bin/env python3
+"""
+results_store.py
+ذخیره ستونی و فقط-افزودنی نتایج تشخیص و ردیابی (به جای JSON/CSV)
+
+ساختار روی دیسک (پارتیشن‌بندی به سبک Hive، قابل خواندن با pyarrow.dataset):
+    <root>/<table>/sample=<sampleId>/clip=<clip>/chunk-00001.parquet   (اگر pyarrow نصب است)
+    <root>/<table>/sample=<sampleId>/clip=<clip>/chunk-00001.npy       (بدون pyarrow)
+    <root>/<table>/sample=<sampleId>/clip=<clip>/columns/<name>.npy    (بعد از compact)
+
+append هرگز مسدود نمی‌شود: ردیف‌ها در صف گذاشته می‌شوند و یک رشته نویسنده آن‌ها را دسته‌ای
+(هر batch_rows ردیف یا هر flush_interval ثانیه) می‌نویسد
+خواندن با memory map انجام می‌شود: Parquet با memory_map=True، و در حالت npy هر ستون
+یک فایل جدا است که با np.load(mmap_mode='r') بدون خواندن کل فایل باز می‌شود
+"""
+
+import os
+import re
+import time
+import queue
+import numpy as np
+from threading import Thread, Lock
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+BACKENDS = ("parquet", "npy")
+
+_SAFE = re.compile(r"[^A-Za-z0-9_.-]+")
+
+
+def _safe(name):
+    """نام امن برای مسیر (sampleId از فرم وب می‌آید)"""
+    return _SAFE.sub("_", str(name)).strip("._") or "unknown"
+
+
+class ResultsStore:
+    def __init__(self, root, backend=None, batch_rows=50000, flush_interval=2.0, max_pending=1000):
+        """
+        :param backend: 'parquet' (نیاز به pyarrow) یا 'npy'؛ None یعنی parquet در صورت وجود
+        :param batch_rows: حداقل ردیف برای نوشتن یک chunk
+        :param flush_interval: حداکثر تأخیر نوشتن (ثانیه)
+        :param max_pending: حداکثر دسته منتظر در صف؛ بیشتر از آن دور ریخته و شمرده می‌شود
+        """
+        if backend is None:
+            backend = "parquet" if pq is not None else "npy"
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown backend: {backend}")
+        if backend == "parquet" and pq is None:
+            raise RuntimeError("Parquet backend requires pyarrow")
+        self.root = root
+        self.backend = backend
+        self.batch_rows = batch_rows
+        self.flush_interval = flush_interval
+
+        self._queue = queue.Queue(max_pending)
+        self._buffers = {}      # (table, sample, clip) -> list of arrays
+        self._counts = {}
+        self._chunks = {}
+        self._lock = Lock()
+        self._thread = None
+
+        self.rows_written = 0
+        self.chunks_written = 0
+        self.dropped = 0
+        self.write_seconds = 0.0
+
+    # -----------------------
+    # نوشتن
+    # -----------------------
+    def partition(self, table, sample_id, clip):
+        return os.path.join(self.root, _safe(table), f"sample={_safe(sample_id)}", f"clip={_safe(clip)}")
+
+    def append(self, table, rows, sample_id, clip):
+        """
+        افزودن ردیف‌ها (آرایه ساختاریافته numpy)؛ فوراً برمی‌گردد
+        آرایه باید بعد از این فراخوانی تغییر نکند (خروجی تشخیص/ردیابی هر فریم آرایه تازه است)
+        """
+        if not len(rows):
+            return True
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(((table, sample_id, clip), rows))
+            return True
+        except queue.Full:
+            self.dropped += len(rows)
+            return False
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = Thread(target=self._run, name="results-writer", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        last_flush = time.monotonic()
+        while True:
+            try:
+                item = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                item = None
+            if item is not None:
+                key, rows = item
+                if key is None:
+                    # درخواست flush: rows یک Event است
+                    self._flush_all()
+                    last_flush = time.monotonic()
+                    rows.set()
+                    continue
+                self._buffers.setdefault(key, []).append(rows)
+                self._counts[key] = self._counts.get(key, 0) + len(rows)
+                if self._counts[key] >= self.batch_rows:
+                    self._flush(key)
+            if time.monotonic() - last_flush >= self.flush_interval:
+                self._flush_all()
+                last_flush = time.monotonic()
+
+    def _flush_all(self):
+        for key in list(self._buffers):
+            self._flush(key)
+
+    def _flush(self, key):
+        parts = self._buffers.pop(key, None)
+        self._counts.pop(key, None)
+        if not parts:
+            return
+        t0 = time.perf_counter()
+        try:
+            rows = np.concatenate(parts)
+            folder = self.partition(*key)
+            os.makedirs(folder, exist_ok=True)
+            index = self._next_chunk(key, folder)
+            ext = ".parquet" if self.backend == "parquet" else ".npy"
+            target = os.path.join(folder, f"chunk-{index:05d}{ext}")
+            tmp = target + ".tmp"
+            if self.backend == "parquet":
+                table = pa.table({name: rows[name] for name in rows.dtype.names})
+                pq.write_table(table, tmp, compression="zstd")
+            else:
+                with open(tmp, "wb") as f:
+                    np.save(f, rows)
+            os.replace(tmp, target)
+            self.rows_written += len(rows)
+            self.chunks_written += 1
+        except Exception as e:
+            print(f"[Results Store Error]: {e}")
+        self.write_seconds += time.perf_counter() - t0
+
+    def _next_chunk(self, key, folder):
+        if key not in self._chunks:
+            existing = [int(name[6:11]) for name in os.listdir(folder)
+                        if name.startswith("chunk-") and not name.endswith(".tmp")]
+            self._chunks[key] = max(existing, default=0)
+        self._chunks[key] += 1
+        return self._chunks[key]
+
+    def flush(self, timeout=30):
+        """نوشتن همه ردیف‌های منتظر و صبر تا پایان (برای پایان ضبط یا قبل از خواندن)"""
+        from threading import Event
+        if self._thread is None:
+            return True
+        done = Event()
+        self._queue.put((None, done))
+        return done.wait(timeout)
+
+    def compact(self, table, sample_id, clip):
+        """
+        ادغام chunkهای npy یک پارتیشن در یک فایل برای هر ستون (columns/<name>.npy)
+        تا خواندن یک ستون از کل آزمایش فقط همان ستون را از دیسک بیاورد
+        """
+        if self.backend != "npy":
+            return None
+        self.flush()
+        folder = self.partition(table, sample_id, clip)
+        chunks = _chunk_files(folder, ".npy")
+        if not chunks:
+            return None
+        arrays = [np.load(path, mmap_mode="r") for path in chunks]
+        columns_dir = os.path.join(folder, "columns")
+        existing = _read_npy_columns(columns_dir)
+        os.makedirs(columns_dir, exist_ok=True)
+        for name in arrays[0].dtype.names:
+            pieces = ([existing[name]] if existing is not None else []) + [a[name] for a in arrays]
+            target = os.path.join(columns_dir, f"{name}.npy")
+            tmp = target + ".tmp"
+            with open(tmp, "wb") as f:
+                np.save(f, np.concatenate(pieces))
+            os.replace(tmp, target)
+        del arrays
+        for path in chunks:
+            os.remove(path)
+        return columns_dir
+
+    # -----------------------
+    # خواندن
+    # -----------------------
+    def partitions(self, table=None):
+        """فهرست (table, sample_id, clip) موجود روی دیسک"""
+        found = []
+        tables = [table] if table else sorted(os.listdir(self.root)) if os.path.isdir(self.root) else []
+        for t in tables:
+            base = os.path.join(self.root, _safe(t))
+            if not os.path.isdir(base):
+                continue
+            for sample in sorted(os.listdir(base)):
+                for clip in sorted(os.listdir(os.path.join(base, sample))):
+                    found.append((t, sample.split("=", 1)[1], clip.split("=", 1)[1]))
+        return found
+
+    def read(self, table, sample_id=None, clip=None, columns=None, start_ns=None, end_ns=None):
+        """
+        خواندن ستونی یک جدول
+        :param sample_id, clip: فیلتر پارتیشن (None یعنی همه)
+        :param columns: فهرست ستون‌ها (None یعنی همه)
+        :param start_ns, end_ns: بازه timestamp (ردیف‌های هر clip به ترتیب زمان نوشته شده‌اند)
+        :return: dict نام ستون -> آرایه numpy (در حالت npy و یک پارتیشن: memmap بدون کپی)
+        """
+        results = []
+        for t, sample, c in self.partitions(table):
+            if sample_id is not None and sample != _safe(sample_id):
+                continue
+            if clip is not None and c != _safe(clip):
+                continue
+            data = self._read_partition(self.partition(t, sample, c), columns)
+            if data is None:
+                continue
+            if start_ns is not None or end_ns is not None:
+                ts = data["timestamp"] if "timestamp" in data else \
+                    self._read_partition(self.partition(t, sample, c), ["timestamp"])["timestamp"]
+                lo = np.searchsorted(ts, start_ns) if start_ns is not None else 0
+                hi = np.searchsorted(ts, end_ns, side="right") if end_ns is not None else len(ts)
+                data = {name: col[lo:hi] for name, col in data.items()}
+            results.append((sample, c, data))
+
+        if len(results) == 1:
+            return results[0][2]
+        if not results:
+            return {}
+        merged = {name: np.concatenate([r[2][name] for r in results]) for name in results[0][2]}
+        merged["sample_id"] = np.concatenate([np.full(len(next(iter(r[2].values()))), r[0], dtype=object)
+                                              for r in results])
+        merged["clip"] = np.concatenate([np.full(len(next(iter(r[2].values()))), r[1], dtype=object)
+                                         for r in results])
+        return merged
+
+    def _read_partition(self, folder, columns):
+        if self.backend == "parquet" or _chunk_files(folder, ".parquet"):
+            files = _chunk_files(folder, ".parquet")
+            if not files:
+                return None
+            tables = [pq.read_table(path, columns=columns, memory_map=True) for path in files]
+            table = pa.concat_tables(tables)
+            return {name: table.column(name).to_numpy() for name in table.column_names}
+
+        parts = []
+        compacted = _read_npy_columns(os.path.join(folder, "columns"), columns)
+        if compacted is not None:
+            parts.append(compacted)
+        for path in _chunk_files(folder, ".npy"):
+            rows = np.load(path, mmap_mode="r")
+            parts.append({name: rows[name] for name in (columns or rows.dtype.names)})
+        if not parts:
+            return None
+        if len(parts) == 1:
+            return parts[0]
+        return {name: np.concatenate([p[name] for p in parts]) for name in parts[0]}
+
+    def close(self):
+        self.flush()
+
+    def summary(self):
+        return {
+            "backend": self.backend,
+            "rows_written": self.rows_written,
+            "chunks_written": self.chunks_written,
+            "dropped": self.dropped,
+            "pending": self._queue.qsize(),
+            "write_ms_per_chunk": 1000 * self.write_seconds / self.chunks_written if self.chunks_written else 0.0,
+        }
+
+
+def _chunk_files(folder, ext):
+    if not os.path.isdir(folder):
+        return []
+    return [os.path.join(folder, name) for name in sorted(os.listdir(folder))
+            if name.startswith("chunk-") and name.endswith(ext)]
+
+
+def _read_npy_columns(columns_dir, columns=None):
+    if not os.path.isdir(columns_dir):
+        return None
+    names = columns or [name[:-4] for name in sorted(os.listdir(columns_dir)) if name.endswith(".npy")]
+    if not names:
+        return None
+    return {name: np.load(os.path.join(columns_dir, f"{name}.npy"), mmap_mode="r") for name in names}
+
+
+if __name__ == "__main__":
+    # بنچمارک: یک ساعت تشخیص (30fps، ~200 ذره در فریم) نوشتن و خواندن یک ستون
+    import argparse
+    import shutil
+    import tempfile
+    from particle_tracker import TRACK_DTYPE
+
+    parser = argparse.ArgumentParser(description="Results store write/read benchmark")
+    parser.add_argument("--minutes", type=float, default=60)
+    parser.add_argument("--particles", type=int, default=200)
+    parser.add_argument("--backend", default=None, choices=BACKENDS)
+    parser.add_argument("--root", default=None, help="پیش‌فرض: پوشه موقت که در پایان پاک می‌شود")
+    args = parser.parse_args()
+
+    root = args.root or tempfile.mkdtemp()
+    frames = int(args.minutes * 60 * 30)
+    # تولید سریع‌تر از زمان واقعی است؛ صف به اندازه کل آزمایش تا چیزی دور ریخته نشود
+    store = ResultsStore(root, backend=args.backend, max_pending=frames)
+    rng = np.random.default_rng(0)
+    template = np.zeros(args.particles, dtype=TRACK_DTYPE)
+    template["x"] = rng.uniform(0, 1024, args.particles)
+    template["y"] = rng.uniform(0, 768, args.particles)
+    template["track_id"] = np.arange(args.particles)
+
+    worst = 0.0
+    t0 = time.perf_counter()
+    for f in range(frames):
+        rows = template.copy()
+        rows["frame"] = f
+        rows["timestamp"] = int(f / 30 * 1e9)
+        t = time.perf_counter()
+        store.append("detections", rows, "S001", "video_test")
+        worst = max(worst, time.perf_counter() - t)
+    enqueue = time.perf_counter() - t0
+    store.flush(timeout=600)
+    store.compact("detections", "S001", "video_test")
+    written = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    data = store.read("detections", "S001", "video_test", columns=["x", "y", "timestamp"])
+    mean_x = float(np.mean(data["x"]))
+    read = time.perf_counter() - t0
+
+    size = sum(os.path.getsize(os.path.join(d, f)) for d, _, files in os.walk(root) for f in files)
+    print(f"backend={store.backend} rows={frames * args.particles:,} frames={frames:,}")
+    print(f"append: {1e6 * enqueue / frames:.1f} us/frame avg, worst {1000 * worst:.2f} ms; "
+          f"written+compacted in {written:.1f}s; dropped={store.dropped}")
+    print(f"read 3 columns: {read:.2f}s (mean x={mean_x:.1f}); on disk {size / 2**20:.0f} MB")
+    if args.root is None:
+        shutil.rmtree(root, ignore_errors=True)
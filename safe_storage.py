@@ -1,15 +1,17 @@
 import os
-import shutil
+import time
 import tempfile
-from time import sleep
-from threading import Thread
 from flash_detector import FlashDetector
+from transfer_queue import TransferQueue
 
 class SafeStorage:
     def __init__(self):
         self.flash_detector = FlashDetector()
         self.temp_dir = os.path.join(tempfile.gettempdir(), 'raspberry_camera_temp')
         os.makedirs(self.temp_dir, exist_ok=True)
+        # صف پایدار انتقال؛ بعد از راه‌اندازی مجدد کارهای نیمه‌تمام ادامه پیدا می‌کنند
+        self.transfers = TransferQueue(os.path.join(self.temp_dir, 'transfers.json'), self._flash_root)
+        self.transfers.start()
 
     def _check_flash(self):
         """بررسی وجود و وضعیت فلش"""
@@ -18,29 +20,20 @@ class SafeStorage:
             raise RuntimeError(message)
         return self.flash_detector.get_storage_path()
 
-    def _copy_to_flash(self, src_path, dest_type, callback=None):
-        """کپی ایمن فایل از حافظه موقت به فلش"""
-        flash_path = self._check_flash()
-        filename = os.path.basename(src_path)
-        
-        dest_folder = os.path.join(flash_path, dest_type)  # 'images' یا 'videos'
-        dest_path = os.path.join(dest_folder, filename)
-        
+    def _flash_root(self):
+        """مسیر ذخیره‌سازی فلش برای صف انتقال؛ None اگر فلش آماده نیست"""
         try:
-            # کپی فایل به مقصد نهایی
-            shutil.copy2(src_path, dest_path)
-            
-            # حذف فایل موقت
-            os.remove(src_path)
-            
-            if callback:
-                callback(dest_path)
-            return dest_path
-        except Exception as e:
-            # در صورت خطا فایل موقت باقی می‌ماند
-            if callback:
-                callback(None, str(e))
-            raise RuntimeError(f"خطا در انتقال به فلش: {str(e)}")
+            return self._check_flash()
+        except RuntimeError:
+            return None
+
+    def _copy_to_flash(self, src_path, dest_type, callback=None):
+        """
+        افزودن فایل به صف انتقال به فلش ('images' یا 'videos')
+        در صورت خطا فایل موقت باقی می‌ماند و انتقال بعداً دوباره انجام می‌شود
+        :return: وضعیت کار انتقال
+        """
+        return self.transfers.submit(src_path, dest_type, callback)
 
     def save_file(self, file_type, file_extension, file_data, callback=None):
         """
@@ -61,9 +54,8 @@ class SafeStorage:
             with open(temp_path, 'wb') as f:
                 f.write(file_data)
             
-            # انتقال به فلش در یک رشته جداگانه
-            Thread(target=self._copy_to_flash, 
-                  args=(temp_path, file_type, callback)).start()
+            # انتقال به فلش در صف پس‌زمینه
+            self._copy_to_flash(temp_path, file_type, callback)
             
             return temp_path
         except Exception as e:
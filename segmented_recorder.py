@@ -0,0 +1,289 @@
+#! /usr/bin/env python3
+"""
+segmented_recorder.py
+ضبط قطعه‌قطعه برای آزمایش‌های بدون محدودیت طول
+
+ضبط به جای یک فایل برای کل duration، هر N ثانیه یا M بایت (روی مرز keyframe) فایل جدیدی
+شروع می‌کند (RecordingPipeline با segment_seconds/segment_bytes، یا SegmentWriter برای H.264)؛
+خرابی فقط قطعه در حال نوشتن را از بین می‌برد
+
+    Manifest        فایل JSON کنار قطعه‌ها: نام، زمان شروع/پایان (ns)، تعداد فریم، حجم و وضعیت هر قطعه
+    SegmentHandoff  هر قطعه بسته شده را فوراً به تحلیل (پردازه‌های batch_analysis) و سپس به صف انتقال
+                    می‌دهد، پس ضبط، انتقال و تحلیل همزمان جلو می‌روند نه پشت سر هم
+    LocalSink       sink ساده SegmentWriter برای نوشتن قطعه‌های H.264 روی دیسک محلی
+
+مسیرهای ذرات در هر قطعه جدا شماره‌گذاری می‌شوند (clip هر قطعه نام خود قطعه به همراه hash کوتاه مسیر آن است)
+"""
+
+import os
+import json
+import time
+from threading import Event, Lock
+from batch_analysis import plan_jobs, run_job, merge_clip, process_pool
+
+
+class LocalSink:
+    """sink برای SegmentWriter: هر قطعه یک فایل معمولی در folder/subdir"""
+
+    def __init__(self, folder):
+        self.folder = folder
+
+    def open(self, name, subdir=None):
+        folder = os.path.join(self.folder, subdir) if subdir else self.folder
+        os.makedirs(folder, exist_ok=True)
+        return open(os.path.join(folder, name), "wb")
+
+
+class Manifest:
+    def __init__(self, path, stem, **meta):
+        """
+        :param path: مسیر فایل JSON (معمولاً <stem>.manifest.json کنار قطعه‌ها)
+        :param meta: اطلاعات ثابت ضبط (fps، اندازه، sampleId، ...)
+        """
+        self.path = path
+        self._lock = Lock()
+        self._write_lock = Lock()
+        self.data = dict(meta, stem=stem, created=time.time(), complete=False, segments=[])
+        self.save()
+
+    @staticmethod
+    def load(path):
+        with open(path) as f:
+            return json.load(f)
+
+    def save(self):
+        """
+        نوشتن اتمیک؛ manifest بعد از خرابی هم همیشه یک JSON معتبر است
+        قفل نوشتن از ساختن متن تا replace نگه داشته می‌شود تا دو رشته (ضبط و تحلیل/انتقال)
+        یک فایل .tmp را همزمان ننویسند و نسخه قدیمی‌تر جای نسخه جدیدتر را نگیرد
+        """
+        with self._write_lock:
+            with self._lock:
+                text = json.dumps(self.data, indent=1)
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            tmp = self.path + ".tmp"
+            try:
+                with open(tmp, "w") as f:
+                    f.write(text)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp, self.path)
+            except OSError as e:
+                print(f"[Manifest Error]: {e}")
+
+    def add(self, segment, state="recorded"):
+        entry = {k: segment.get(k) for k in ("index", "name", "start_ns", "end_ns", "frames", "bytes")}
+        with self._lock:
+            segments = self.data["segments"]
+            first = segments[0]["start_ns"] if segments else entry["start_ns"]
+            if entry["start_ns"] is not None and first is not None:
+                entry["offset_s"] = (entry["start_ns"] - first) / 1e9
+            if entry["start_ns"] is not None and entry["end_ns"] is not None:
+                entry["duration_s"] = (entry["end_ns"] - entry["start_ns"]) / 1e9
+            entry["state"] = state
+            segments.append(entry)
+        self.save()
+
+    def update(self, name, **fields):
+        with self._lock:
+            for entry in self.data["segments"]:
+                if entry["name"] == name:
+                    entry.update(fields)
+                    break
+        self.save()
+
+    def finish(self, **fields):
+        with self._lock:
+            self.data.update(fields, complete=True, finished=time.time())
+        self.save()
+
+
+class SegmentHandoff:
+    """
+    callback on_segment: ثبت در manifest، تحلیل در پردازه جدا، سپس انتقال
+    قطعه تا پایان تحلیل روی دیسک محلی می‌ماند و بعد به صف انتقال (که آن را حذف می‌کند) سپرده می‌شود
+    """
+
+    def __init__(self, manifest, transfers=None, subdir="", analysis_dir=None, store=None, sample_id=None,
+                 workers=1, detector_kwargs=None, tracker_kwargs=None, transfer_segments=True):
+        """
+        :param transfers: TransferQueue یا None (قطعه‌ها و manifest همان‌جا می‌مانند)
+        :param transfer_segments: False وقتی قطعه‌ها مستقیم روی USB نوشته شده‌اند (فقط manifest منتقل می‌شود)
+        :param analysis_dir: پوشه خروجی تحلیل (<segment>-<hash>.npz)؛ None یعنی بدون تحلیل
+        :param store: ResultsStore برای افزودن نتایج هر قطعه
+        """
+        self.manifest = manifest
+        self.transfers = transfers
+        self.subdir = subdir
+        self.analysis_dir = analysis_dir
+        self.store = store
+        self.sample_id = sample_id
+        self.detector_kwargs = detector_kwargs
+        self.tracker_kwargs = tracker_kwargs
+        self.transfer_segments = transfer_segments
+        # True وقتی قطعه‌ها با DirectWriter نوشته می‌شوند: manifest تا رسیدن وضعیت نهایی همه قطعه‌ها منتقل نمی‌شود
+        self.expect_stored = False
+        self._pool = process_pool(workers) if analysis_dir else None
+        self._lock = Lock()
+        self._pending = {}       # name -> تعداد job تحلیل مانده
+        self._stored = {}        # name -> وضعیت DirectWriter که پیش از ثبت قطعه رسیده
+        self._awaiting = set()   # قطعه‌های ثبت شده که وضعیت DirectWriter آن‌ها هنوز نرسیده
+        self._finishing = False
+        self._finished = Event()
+        self.handed = 0
+        self.analysed = 0
+        self.transferred = 0
+
+    def __call__(self, segment):
+        self.manifest.add(segment)
+        self.handed += 1
+        with self._lock:
+            stored = self._stored.pop(segment["name"], None)
+            if stored is None and self.expect_stored:
+                self._awaiting.add(segment["name"])
+        if stored is not None:
+            self.manifest.update(segment["name"], **stored)
+        path = segment.get("path")
+        jobs = plan_jobs([path]) if self._pool is not None and path and os.path.exists(path) else []
+        if not jobs:
+            self._transfer(segment)
+            return
+        with self._lock:
+            self._pending[segment["name"]] = len(jobs)
+        self.manifest.update(segment["name"], state="analysing")
+        for job in jobs:
+            future = self._pool.submit(run_job, job, self.analysis_dir, self.detector_kwargs, self.tracker_kwargs)
+            future.add_done_callback(lambda f, segment=segment, clip=job["clip"]: self._job_done(segment, clip, f))
+
+    def _job_done(self, segment, clip, future):
+        try:
+            future.result()
+        except Exception as e:
+            print(f"[Segment Analysis Error]: {segment['name']}: {e}")
+        with self._lock:
+            self._pending[segment["name"]] -= 1
+            if self._pending[segment["name"]]:
+                return
+            del self._pending[segment["name"]]
+        try:
+            target, rows, tracks = merge_clip(self.analysis_dir, clip, self.store, self.sample_id)
+            self.analysed += 1
+            self.manifest.update(segment["name"], analysis=os.path.basename(target), rows=rows, tracks=tracks)
+        except Exception as e:
+            print(f"[Segment Analysis Error]: {segment['name']}: {e}")
+        self._transfer(segment)
+
+    def stored(self, summary):
+        """callback on_segment در DirectWriter: وضعیت نهایی قطعه (done روی USB، spilled روی SD یا failed)"""
+        fields = {"storage": summary["state"]}
+        if summary.get("error"):
+            fields["error"] = summary["error"]
+        with self._lock:
+            known = any(entry["name"] == summary["name"] for entry in self.manifest.data["segments"])
+            if not known:
+                self._stored[summary["name"]] = fields
+        if known:
+            self.manifest.update(summary["name"], **fields)
+            with self._lock:
+                self._awaiting.discard(summary["name"])
+            self._maybe_finish()
+
+    def _transfer(self, segment):
+        fields = {"state": "stored"}
+        if (self.transfer_segments and self.transfers is not None and segment.get("path")
+                and os.path.exists(segment["path"])):
+            job = self.transfers.submit(segment["path"], self.subdir)
+            fields = {"state": "transferring", "transfer": job["id"]}
+            self.transferred += 1
+        self.manifest.update(segment["name"], **fields)
+        self._maybe_finish()
+
+    def finish(self, **fields):
+        """
+        پایان ضبط: manifest کامل علامت می‌خورد و بعد از آخرین قطعه (و با DirectWriter بعد از آخرین
+        وضعیت stored) اگر صف انتقال هست منتقل می‌شود
+        تحلیل‌های مانده در پس‌زمینه ادامه پیدا می‌کنند
+        """
+        self.manifest.finish(**fields)
+        with self._lock:
+            self._finishing = True
+        self._maybe_finish()
+
+    def _maybe_finish(self):
+        with self._lock:
+            if not self._finishing or self._pending or self._awaiting:
+                return
+            self._finishing = False
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+        if self.transfers is not None and os.path.exists(self.manifest.path):
+            self.transfers.submit(self.manifest.path, self.subdir)
+        self._finished.set()
+
+    def wait(self, timeout=None):
+        """انتظار تا همه قطعه‌ها تحلیل و به صف انتقال سپرده شوند (بعد از finish)"""
+        return self._finished.wait(timeout)
+
+    def summary(self):
+        with self._lock:
+            pending = len(self._pending)
+        return {"segments": self.handed, "analysing": pending, "analysed": self.analysed,
+                "transferred": self.transferred, "manifest": self.manifest.path}
+
+
+if __name__ == "__main__":
+    # ضبط قطعه‌قطعه روی منبع مصنوعی: زمان رسیدن هر قطعه به «USB» و تحلیل، در برابر پایان ضبط
+    import argparse
+    import shutil
+    import tempfile
+    from frame_source import create_source
+    from camera_modes import CameraModeManager
+    from record_pipeline import RecordingPipeline
+    from transfer_queue import TransferQueue
+
+    parser = argparse.ArgumentParser(description="Segmented recording with overlapped transfer and analysis")
+    parser.add_argument("--seconds", type=float, default=12)
+    parser.add_argument("--segment", type=float, default=4)
+    parser.add_argument("--analyse", action="store_true", help="تحلیل هر قطعه در پردازه جدا")
+    args = parser.parse_args()
+
+    work = tempfile.mkdtemp(prefix="segments_")
+    local, usb, results = (os.path.join(work, name) for name in ("local", "usb", "results"))
+    os.makedirs(local)
+    source = create_source("synthetic", main_size=(1280, 720))
+    modes = CameraModeManager(source, modes={"dual": {"main_size": (1280, 720), "lores_size": (640, 480)}})
+    transfers = TransferQueue(os.path.join(work, "transfers.json"), lambda: usb)
+
+    stem = os.path.join(local, "sample_20260101_000000.mp4")
+    manifest = Manifest(os.path.join(local, "sample_20260101_000000.manifest.json"), "sample_20260101_000000",
+                        fps=30, frame_size=[640, 360])
+    handoff = SegmentHandoff(manifest, transfers, analysis_dir=results if args.analyse else None,
+                             sample_id="sample")
+    arrivals = []
+
+    def on_segment(segment):
+        arrivals.append((time.monotonic(), segment["name"]))
+        handoff(segment)
+
+    pipeline = RecordingPipeline(source, modes, frame_size=(640, 360), fps=30,
+                                 segment_seconds=args.segment, on_segment=on_segment)
+    t0 = time.monotonic()
+    pipeline.start(stem)
+    time.sleep(args.seconds)
+    pipeline.stop()
+    ended = time.monotonic()
+    handoff.finish()
+    handoff.wait()
+    transfers.wait()
+    transfers.stop()
+    source.close()
+
+    for t, name in arrivals:
+        print(f"{name}: closed at {t - t0:5.1f}s ({ended - t:+5.1f}s before recording ended)")
+    data = Manifest.load(os.path.join(usb, "sample_20260101_000000.manifest.json"))
+    print(f"manifest on USB: {len(data['segments'])} segments, complete={data['complete']}")
+    for entry in data["segments"]:
+        print(f"  {entry['name']} offset={entry.get('offset_s', 0):5.2f}s duration={entry.get('duration_s', 0):5.2f}s "
+              f"frames={entry['frames']} state={entry['state']} rows={entry.get('rows')}")
+    print(f"on USB: {sorted(os.listdir(usb))}")
+    shutil.rmtree(work)
@@ -1,9 +1,65 @@
+// دنبال کردن یک job با SSE تا وضعیت نهایی (done، failed، cancelled)
+function followJob(jobId, onUpdate) {
+    const source = new EventSource(`/jobs/${encodeURIComponent(jobId)}/stream`);
+    return new Promise((resolve, reject) => {
+        source.addEventListener("job", event => {
+            const job = JSON.parse(event.data);
+            onUpdate(job);
+            if (job.state === "done") {
+                source.close();
+                resolve(job);
+            } else if (job.state === "failed" || job.state === "cancelled") {
+                source.close();
+                reject(new Error(job.error || job.state));
+            }
+        });
+        source.onerror = () => {
+            source.close();
+            reject(new Error("Lost connection to job stream"));
+        };
+    });
+}
+
+// دنبال کردن انتقال یک فایل با رویدادهای transfer از /stream به جای poll کردن /check_transfer
+function followTransfer(transferId, onUpdate) {
+    const source = new EventSource("/stream?topics=transfer");
+    return new Promise((resolve, reject) => {
+        const handle = status => {
+            if (status.id !== transferId) {
+                return;
+            }
+            onUpdate(status);
+            if (status.state === "done") {
+                source.close();
+                resolve(status);
+            } else if (status.state === "failed") {
+                source.close();
+                reject(new Error(status.error));
+            }
+        };
+        source.addEventListener("transfer", event => handle(JSON.parse(event.data)));
+        // انتقالی که پیش از باز شدن stream تمام شده فقط با یک درخواست دیده می‌شود
+        source.onopen = () => fetch(`/check_transfer/${encodeURIComponent(transferId)}`)
+            .then(res => res.json())
+            .then(data => data.transfer && handle(data.transfer));
+        source.onerror = () => {
+            if (source.readyState === EventSource.CLOSED) {
+                reject(new Error("Lost connection to event stream"));
+            }
+        };
+    });
+}
+
 document.getElementById("capture-btn").addEventListener("click", () => {
     fetch("/capture", { method: "POST" })
         .then(res => res.json())
-        .then(data => {
+        .then(data => followJob(data.job_id, () => {}))
+        .then(job => {
             document.getElementById("message").innerHTML =
-                 `<span class="text-success">Picture Saved ✅ عکس ذخیره شد \n Locate in: ${data.path} : محل ذخیره</span>`;
+                 `<span class="text-success">Picture Saved ✅ عکس ذخیره شد \n Locate in: ${job.result.name} : محل ذخیره</span>`;
+        })
+        .catch(error => {
+            document.getElementById("message").innerHTML = `<span class="text-danger">${error.message}</span>`;
         });
 });
 
@@ -20,22 +76,21 @@ document.getElementById("record-btn").addEventListener("click", () => {
         let progressBar = document.getElementById("record-progress");
         let message = document.getElementById("message");
 
-        message.innerHTML = `<span class="text-warning">⏺ Video is recording for 30 secound duration ...   در حال ضبط ویدئو برای مدت 30 ثانیه</span>`;
+        message.innerHTML = `<span class="text-warning">⏺ Video is recording for ${duration} secound duration ...   در حال ضبط ویدئو برای مدت ${duration} ثانیه</span>`;
         progressBar.style.width = "0%";
         progressBar.innerText = "0%";
 
-        let elapsed = 0;
-        let interval = setInterval(() => {
-            elapsed++;
-            let percent = Math.min((elapsed / duration) * 100, 100);
+        // پیشرفت واقعی ضبط از سرور، نه شمارنده سمت مرورگر
+        return followJob(data.job_id, job => {
+            let percent = Math.floor((job.progress || 0) * 100);
             progressBar.style.width = percent + "%";
-            progressBar.innerText = Math.floor(percent) + "%";
-
-            if (elapsed >= duration) {
-                clearInterval(interval);
-                message.innerHTML = `<span class="text-success"> Vide recording is finished ✅ ضبط به پایان رسید</span>`;
-            }
-        }, 1000);
+            progressBar.innerText = percent + "%";
+        }).then(() => {
+            message.innerHTML = `<span class="text-success"> Vide recording is finished ✅ ضبط به پایان رسید</span>`;
+        });
+    })
+    .catch(error => {
+        document.getElementById("message").innerHTML = `<span class="text-danger">${error.message}</span>`;
     });
 });
 
@@ -51,21 +106,17 @@ async function takePicture() {
         if (result.error) {
             throw new Error(result.error);
         }
-        
-        // بررسی وضعیت انتقال هر 2 ثانیه
-        const checkInterval = setInterval(async () => {
-            const statusResponse = await fetch(`/check_transfer/${encodeURIComponent(result.temp_path)}`);
-            const status = await statusResponse.json();
-            
-            if (status.status === 'completed') {
-                clearInterval(checkInterval);
-                processingModal.hide();
-                alert('تصویر با موفقیت ذخیره شد!');
-            } else {
-                processingModal.updateMessage(status.message);
-            }
-        }, 2000);
-        
+
+        // عکس به صورت job گرفته می‌شود؛ نتیجه آن کار انتقال به فلش است
+        const job = await followJob(result.job_id, job => processingModal.updateMessage(job.message));
+
+        // پیشرفت انتقال (بایت‌های کپی شده) از سرور push می‌شود
+        await followTransfer(job.result.id, status => {
+            processingModal.updateMessage(`${status.state}: ${Math.floor(status.percent)}%`);
+        });
+        processingModal.hide();
+        alert('تصویر با موفقیت ذخیره شد!');
+
     } catch (error) {
         processingModal.hide();
         alert(`خطا: ${error.message}`);
@@ -0,0 +1,245 @@
+#! /usr/bin/env python3
+"""
+storage_presence.py
+تشخیص حافظه USB با کش و رویداد، به جای os.walk("/media") یا اجرای lsblk در هر درخواست
+
+/proc/self/mountinfo یک بار خوانده و نتیجه کش می‌شود؛ یک رشته پس‌زمینه تغییرات را دنبال می‌کند:
+    poll   کرنل با POLLPRI/POLLERR روی mountinfo خبر می‌دهد که mount/umount شده (بدون هزینه در حالت بیکار)
+    ttl    برای فایل معمولی (مثلاً mountinfo ساختگی در تست) یا سیستم بدون poll: بررسی mtime هر ttl ثانیه
+در هر دو حالت خواندن وضعیت فقط خواندن یک متغیر است و هیچ I/O در مسیر عکس/ضبط انجام نمی‌شود
+"""
+
+import os
+import re
+import time
+import select
+from threading import Lock, Thread
+
+MOUNTINFO = "/proc/self/mountinfo"
+
+# mountهای سیستمی که حتی روی /dev/sd* (بوت از USB) حافظه خارجی حساب نمی‌شوند
+SYSTEM_MOUNTS = ("/", "/boot", "/boot/firmware")
+
+_ESCAPE = re.compile(r"\\([0-7]{3})")
+
+
+def _unescape(field):
+    """mountinfo فاصله و کاراکترهای خاص را به صورت \\040 می‌نویسد"""
+    return _ESCAPE.sub(lambda m: chr(int(m.group(1), 8)), field)
+
+
+def parse_mountinfo(text):
+    """
+    :return: فهرست dict با mount_point، root، fstype، source، options و device (major:minor)
+    """
+    mounts = []
+    for line in text.splitlines():
+        fields = line.split()
+        try:
+            sep = fields.index("-", 6)
+            mounts.append({
+                "device": fields[2],
+                "root": _unescape(fields[3]),
+                "mount_point": _unescape(fields[4]),
+                "options": fields[5],
+                "fstype": fields[sep + 1],
+                "source": _unescape(fields[sep + 2]),
+            })
+        except (ValueError, IndexError):
+            continue
+    return mounts
+
+
+class StoragePresence:
+    def __init__(self, roots=("/media",), devices=(), path=MOUNTINFO, ttl=2.0, mode=None):
+        """
+        :param roots: mount هایی که زیر این مسیرها هستند (یا خود این مسیرها) حافظه خارجی حساب می‌شوند
+        :param devices: پیشوند دستگاه (مثلاً '/dev/sd') برای mountهای خارج از roots
+        :param path: فایل mountinfo (برای تست می‌تواند فایل ساختگی باشد)
+        :param ttl: فاصله بررسی در حالت ttl، و سقف انتظار poll در حالت poll (ثانیه)
+        :param mode: 'poll'، 'ttl' یا None (poll برای /proc اگر در دسترس باشد)
+        """
+        self.roots = tuple(r.rstrip("/") or "/" for r in roots)
+        self.devices = tuple(devices)
+        self.path = path
+        self.ttl = ttl
+        if mode is None:
+            mode = "poll" if path.startswith("/proc/") and hasattr(select, "poll") else "ttl"
+        self.mode = mode
+
+        self._lock = Lock()
+        self._listeners = []
+        self._stamp = None
+        self._thread = None
+        self._running = False
+        self.mounts = []
+        self.external = []
+        self.refreshes = 0
+        self.changes = 0
+        self.refresh()
+
+    def _is_external(self, mount):
+        point = mount["mount_point"]
+        if point in SYSTEM_MOUNTS:
+            return False
+        for root in self.roots:
+            if point == root or point.startswith(root + "/"):
+                return True
+        return bool(self.devices) and mount["source"].startswith(self.devices)
+
+    def refresh(self):
+        """خواندن دوباره mountinfo؛ اگر حافظه خارجی عوض شده باشد listenerها خبر می‌شوند"""
+        try:
+            with open(self.path) as f:
+                text = f.read()
+        except OSError as e:
+            print(f"[Storage Presence Error]: {e}")
+            return self.current()
+        mounts = parse_mountinfo(text)
+        external = [m["mount_point"] for m in mounts if self._is_external(m)]
+        with self._lock:
+            previous = self.current()
+            self.mounts = mounts
+            self.external = external
+            self.refreshes += 1
+            changed = self.current() != previous
+            if changed:
+                self.changes += 1
+            listeners = list(self._listeners)
+        if changed:
+            for fn in listeners:
+                try:
+                    fn(self.current())
+                except Exception as e:
+                    print(f"[Storage Listener Error]: {e}")
+        return self.current()
+
+    def current(self):
+        """اولین حافظه خارجی mount شده یا None (بدون I/O)"""
+        external = self.external
+        return external[0] if external else None
+
+    @property
+    def connected(self):
+        return bool(self.external)
+
+    def add_listener(self, fn):
+        """fn(mount_point یا None) وقتی حافظه خارجی وصل، جدا یا عوض شود"""
+        with self._lock:
+            self._listeners.append(fn)
+        self.start()
+
+    # -----------------------
+    # رشته پیگیری تغییرات
+    # -----------------------
+    def start(self):
+        with self._lock:
+            if self._running:
+                return
+            self._running = True
+            self._thread = Thread(target=self._watch, name="storage-presence", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join(timeout=self.ttl + 1)
+            self._thread = None
+
+    def _watch(self):
+        if self.mode == "poll":
+            try:
+                self._watch_poll()
+                return
+            except OSError as e:
+                print(f"[Storage Presence Error]: {e}, falling back to ttl")
+                self.mode = "ttl"
+        self._watch_ttl()
+
+    def _watch_poll(self):
+        with open(self.path) as f:
+            poller = select.poll()
+            poller.register(f, select.POLLPRI | select.POLLERR)
+            f.read()
+            while self._running:
+                # بدون رویداد هم هر ttl ثانیه یک بار بیدار می‌شود تا stop دیده شود
+                if poller.poll(self.ttl * 1000):
+                    f.seek(0)
+                    f.read()  # تا رویداد بعدی دوباره علامت نخورد
+                    self.refresh()
+
+    def _watch_ttl(self):
+        while self._running:
+            time.sleep(self.ttl)
+            try:
+                st = os.stat(self.path)
+            except OSError:
+                continue
+            stamp = (st.st_mtime_ns, st.st_size, st.st_ino)
+            if stamp != self._stamp:
+                self._stamp = stamp
+                self.refresh()
+
+    def summary(self):
+        return {
+            "mode": self.mode,
+            "mount": self.current(),
+            "external": list(self.external),
+            "refreshes": self.refreshes,
+            "changes": self.changes,
+        }
+
+
+if __name__ == "__main__":
+    # mountinfo ساختگی: وصل و جدا کردن فلش و مقایسه هزینه هر پرس‌وجو با os.walk روی /media
+    import argparse
+    import tempfile
+
+    parser = argparse.ArgumentParser(description="Storage presence with a fake mountinfo")
+    parser.add_argument("--ttl", type=float, default=0.2)
+    parser.add_argument("--queries", type=int, default=10000)
+    args = parser.parse_args()
+
+    base = ("22 1 179:2 / / rw,noatime shared:1 - ext4 /dev/mmcblk0p2 rw\n"
+            "23 22 179:1 / /boot/firmware rw,relatime shared:2 - vfat /dev/mmcblk0p1 rw\n"
+            "24 22 0:21 / /proc rw,nosuid shared:3 - proc proc rw\n")
+    usb = "98 22 8:1 / /media/pi/MY\\040USB rw,nosuid,nodev,relatime shared:40 - exfat /dev/sda1 rw\n"
+
+    path = os.path.join(tempfile.mkdtemp(), "mountinfo")
+    with open(path, "w") as f:
+        f.write(base)
+    events = []
+    presence = StoragePresence(path=path, ttl=args.ttl)
+    presence.add_listener(lambda mount: events.append((time.monotonic(), mount)))
+    print(f"mode={presence.mode} mount={presence.current()}")
+
+    for content, label in ((base + usb, "plug"), (base, "unplug")):
+        t0 = time.monotonic()
+        with open(path, "w") as f:
+            f.write(content)
+        while len(events) < (1 if label == "plug" else 2):
+            time.sleep(0.01)
+        print(f"{label:7s} seen after {1000 * (events[-1][0] - t0):6.1f} ms -> {events[-1][1]!r}")
+    presence.stop()
+
+    t0 = time.perf_counter()
+    for _ in range(args.queries):
+        presence.current()
+    cached = (time.perf_counter() - t0) / args.queries
+
+    def walk_media():
+        for root, dirs, files in os.walk("/media"):
+            for name in dirs:
+                if os.path.ismount(os.path.join(root, name)):
+                    return os.path.join(root, name)
+        return None
+
+    queries = max(1, args.queries // 100)
+    t0 = time.perf_counter()
+    for _ in range(queries):
+        walk_media()
+    walked = (time.perf_counter() - t0) / queries
+    print(f"per query: cached {1e6 * cached:.2f} us, os.walk('/media') {1e6 * walked:.1f} us")
+
+    live = StoragePresence(roots=("/media", "/mnt"), devices=("/dev/sd",))
+    print(f"this system: {live.summary()}")
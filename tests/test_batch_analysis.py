@@ -0,0 +1,92 @@
+import os
+
+import cv2
+import numpy as np
+
+import batch_analysis
+from batch_analysis import _ID_SPAN, analyse, process_pool, stitch_tracks
+from particle_tracker import ParticleTracker
+from test_particle_tracker import detections, moving
+
+
+def _chunk(start, stop, chunk, points=moving):
+    """مثل run_job: ردیابی مستقل یک بازه با فریم مرزی مشترک و فاصله شناسه بین بازه‌ها"""
+    tracker = ParticleTracker(gate=10.0)
+    for f in range(start, stop + 1):
+        tracker.update(detections(f, points(f)), f)
+    rows = tracker.trajectories()
+    rows["track_id"] += chunk * _ID_SPAN
+    return start, stop, rows
+
+
+def _paths(rows):
+    """مسیرها به صورت مجموعه‌ای از نقاط، مستقل از مقدار شناسه"""
+    return sorted(tuple((int(r["frame"]), float(r["x"]), float(r["y"])) for r in rows[rows["track_id"] == t])
+                  for t in np.unique(rows["track_id"]))
+
+
+def test_stitched_chunks_match_single_pass():
+    single = _chunk(0, 59, 0)[2]
+    parts = [_chunk(0, 20, 0), _chunk(20, 40, 1), _chunk(40, 59, 2)]
+    stitched = stitch_tracks(parts)
+
+    assert len(stitched) == len(single) == 3 * 60
+    assert _paths(stitched) == _paths(single)
+    # شناسه‌های بازه اول حفظ می‌شوند و هر فریم مرزی فقط یک بار می‌آید
+    assert sorted(np.unique(stitched["track_id"])) == [1, 2, 3]
+    assert np.array_equal(np.bincount(stitched["frame"]), np.full(60, 3))
+    assert np.all(np.diff(stitched["frame"][stitched["track_id"] == 1]) == 1)
+
+
+def test_stitch_with_different_boundary_detections_keeps_ids_apart(capsys):
+    def fewer(frame):
+        return moving(frame)[:2] if frame >= 20 else moving(frame)
+
+    parts = [_chunk(0, 20, 0), _chunk(20, 40, 1, points=fewer)]
+    stitched = stitch_tracks(parts)
+    assert "tracks not stitched" in capsys.readouterr().out
+    assert len(stitched[stitched["frame"] == 20]) == 3
+    assert set(np.unique(stitched["track_id"])) == {1, 2, 3, _ID_SPAN + 1, _ID_SPAN + 2}
+
+
+def test_stitch_empty():
+    assert len(stitch_tracks([])) == 0
+
+
+def test_process_pool_does_not_fork():
+    with process_pool(1) as pool:
+        method = pool._mp_context.get_start_method()
+        assert pool.submit(batch_analysis.sample_from_clip, "S12_20240101_120000-0123abcd").result() == "S12"
+    assert method in ("forkserver", "spawn")
+
+
+def _write_clip(path, frames=45, size=(320, 240)):
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"MJPG"), 30, size)
+    assert writer.isOpened()
+    for f in range(frames):
+        frame = np.zeros((size[1], size[0], 3), np.uint8)
+        for x, y in ((20 + 4 * f, 60), (300 - 3 * f, 120), (160, 30 + 2 * f)):
+            cv2.circle(frame, (x, y), 4, (255, 255, 255), -1)
+        writer.write(frame)
+    writer.release()
+
+
+def test_analyse_chunks_in_worker_pool_match_single_chunk(tmp_path):
+    clip = str(tmp_path / "S1_20240101_120000.avi")
+    _write_clip(clip)
+    kwargs = dict(detector_kwargs={"threshold": 128, "min_area": 5}, tracker_kwargs={"gate": 12.0})
+
+    whole = analyse([clip], str(tmp_path / "whole"), workers=1, chunk_frames=1000, **kwargs)
+    chunked = analyse([clip], str(tmp_path / "chunked"), workers=2, chunk_frames=15, **kwargs)
+    assert whole["jobs"] == 1
+    assert chunked["jobs"] == 3
+
+    def load(folder):
+        name, = [n for n in os.listdir(folder) if n.endswith(".npz")]
+        with np.load(os.path.join(folder, name)) as data:
+            return data["rows"], data["tracks"]
+
+    rows_whole, tracks_whole = load(str(tmp_path / "whole"))
+    rows_chunked, tracks_chunked = load(str(tmp_path / "chunked"))
+    assert len(tracks_whole) == len(tracks_chunked) == 3
+    assert _paths(rows_chunked) == _paths(rows_whole)
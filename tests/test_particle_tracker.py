@@ -0,0 +1,137 @@
+import threading
+
+import numpy as np
+import pytest
+
+from particle_detector import DETECTION_DTYPE
+from particle_tracker import ParticleTracker, summarize_tracks
+
+
+def detections(frame, points, fps=30.0):
+    rows = np.zeros(len(points), dtype=DETECTION_DTYPE)
+    rows["frame"] = frame
+    rows["timestamp"] = int(frame / fps * 1e9)
+    if len(points):
+        rows["x"] = [p[0] for p in points]
+        rows["y"] = [p[1] for p in points]
+    rows["area"] = 12
+    return rows
+
+
+def moving(frame):
+    # سه ذره با سرعت‌های متفاوت، دورتر از gate از هم
+    return [(10 + 3 * frame, 50), (200 - 2 * frame, 150), (100, 250 + 4 * frame)]
+
+
+@pytest.mark.parametrize("assignment", ["greedy", "hungarian"])
+def test_identity_is_kept_along_straight_paths(assignment):
+    if assignment == "hungarian":
+        pytest.importorskip("scipy")
+    tracker = ParticleTracker(gate=10.0, assignment=assignment)
+    ids = [tracker.update(detections(f, moving(f)))["track_id"] for f in range(30)]
+    assert all(list(frame_ids) == [1, 2, 3] for frame_ids in ids)
+    assert tracker.active == 3
+
+    summary = tracker.track_summary()
+    assert list(summary["length"]) == [30, 30, 30]
+    assert summary["dx"][0] == pytest.approx(87.0)
+    assert summary["speed_px_s"][0] == pytest.approx(90.0, rel=1e-3)
+
+
+def test_identity_survives_detection_order_shuffle():
+    tracker = ParticleTracker(gate=10.0)
+    rng = np.random.default_rng(0)
+    first = None
+    for f in range(20):
+        points = moving(f)
+        order = rng.permutation(len(points))
+        rows = tracker.update(detections(f, [points[i] for i in order]))
+        # شناسه هر ذره (به ترتیب moving) در همه فریم‌ها همان شناسه فریم اول است
+        ids = list(rows["track_id"][np.argsort(order)])
+        first = first or ids
+        assert ids == first
+    assert sorted(first) == [1, 2, 3]
+
+
+def test_crossing_particles_are_not_swapped():
+    # دو ذره روی هم عبور می‌کنند؛ پیش‌بینی با سرعت آن‌ها را جدا نگه می‌دارد
+    tracker = ParticleTracker(gate=6.0)
+    for f in range(21):
+        rows = tracker.update(detections(f, [(5 * f, 100), (100 - 5 * f, 100.5)]))
+    assert list(rows["track_id"]) == [1, 2]
+    assert rows["x"][0] > rows["x"][1]
+
+
+def test_gap_in_frame_index_uses_predicted_position():
+    # فریم‌های رد شده با gate: ذره در فاصله 5 فریم 25 پیکسل جلو رفته که بیشتر از gate است
+    tracker = ParticleTracker(gate=8.0)
+    for f in range(5):
+        tracker.update(detections(f, [(5 * f, 0)]), f)
+    rows = tracker.update(detections(9, [(45, 0)]), 9)
+    assert list(rows["track_id"]) == [1]
+
+
+def test_gap_without_frame_index_breaks_track():
+    # اگر فاصله فریم‌ها گم شود (همان مشکل version در hub) ذره track جدید می‌گیرد
+    tracker = ParticleTracker(gate=8.0)
+    for f in range(5):
+        tracker.update(detections(f, [(5 * f, 0)]), f)
+    rows = tracker.update(detections(9, [(45, 0)]), 5)
+    assert list(rows["track_id"]) == [2]
+
+
+def test_track_ends_after_max_missed():
+    tracker = ParticleTracker(gate=10.0, max_missed=2)
+    tracker.update(detections(0, [(0, 0)]))
+    for f in range(1, 4):
+        tracker.update(detections(f, []), f)
+    assert tracker.active == 0
+    assert tracker.ended == 1
+    rows = tracker.update(detections(4, [(0, 0)]))
+    assert list(rows["track_id"]) == [2]
+
+
+def test_reset_clears_tracks_and_ids():
+    tracker = ParticleTracker(gate=10.0)
+    for f in range(5):
+        tracker.update(detections(f, moving(f)))
+    tracker.reset()
+    assert tracker.active == 0
+    assert len(tracker.trajectories()) == 0
+    assert list(tracker.update(detections(0, moving(0)))["track_id"]) == [1, 2, 3]
+
+
+def test_reset_during_updates_keeps_arrays_consistent():
+    tracker = ParticleTracker(gate=10.0, history=100)
+    errors = []
+    stop = threading.Event()
+
+    def feed():
+        f = 0
+        try:
+            while not stop.is_set():
+                rows = tracker.update(detections(f, moving(f % 40)), f)
+                assert len(rows) == 3
+                f += 1
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=feed)
+    thread.start()
+    for _ in range(200):
+        tracker.reset()
+        tracker.trajectories()
+    stop.set()
+    thread.join()
+    assert errors == []
+    assert len(tracker._ids) == len(tracker._pos) == len(tracker._last_frame)
+
+
+def test_summarize_tracks_drops_short_tracks():
+    tracker = ParticleTracker(gate=10.0)
+    tracker.update(detections(0, [(0, 0), (500, 500)]))
+    tracker.update(detections(1, [(1, 0)]))
+    tracker.update(detections(2, [(2, 0)]))
+    summary = summarize_tracks(tracker.trajectories(), min_length=3)
+    assert list(summary["track_id"]) == [1]
+    assert summary["path_px"][0] == pytest.approx(2.0)
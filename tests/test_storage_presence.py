@@ -0,0 +1,125 @@
+import time
+
+from storage_presence import StoragePresence, parse_mountinfo
+
+BASE = ("22 1 179:2 / / rw,noatime shared:1 - ext4 /dev/mmcblk0p2 rw\n"
+        "23 22 179:1 / /boot/firmware rw,relatime shared:2 - vfat /dev/mmcblk0p1 rw\n"
+        "24 22 0:21 / /proc rw,nosuid shared:3 - proc proc rw\n")
+USB = "98 22 8:1 / /media/pi/MY\\040USB rw,nosuid,nodev,relatime shared:40 - exfat /dev/sda1 rw\n"
+SECOND_USB = "99 22 8:17 / /media/pi/DATA rw,relatime shared:41 - vfat /dev/sdb1 rw\n"
+
+
+def _write(path, text):
+    with open(path, "w") as f:
+        f.write(text)
+
+
+def _wait_for(predicate, timeout=3.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def test_parse_mountinfo_fields():
+    mounts = parse_mountinfo(BASE + USB)
+    assert [m["mount_point"] for m in mounts] == ["/", "/boot/firmware", "/proc", "/media/pi/MY USB"]
+    usb = mounts[-1]
+    assert usb["device"] == "8:1"
+    assert usb["root"] == "/"
+    assert usb["fstype"] == "exfat"
+    assert usb["source"] == "/dev/sda1"
+    assert usb["options"] == "rw,nosuid,nodev,relatime"
+
+
+def test_parse_mountinfo_unescapes_and_optional_fields():
+    # بدون فیلد اختیاری (shared:N) و با tab، newline و backslash کدگذاری شده
+    line = "40 22 8:2 /sub\\134dir /media/pi/a\\011b\\012c rw - ext4 /dev/sda2 rw\n"
+    mount, = parse_mountinfo(line)
+    assert mount["root"] == "/sub\\dir"
+    assert mount["mount_point"] == "/media/pi/a\tb\nc"
+    assert mount["fstype"] == "ext4"
+
+
+def test_parse_mountinfo_skips_malformed_lines():
+    mounts = parse_mountinfo("garbage\n\n1 2 3\n" + USB)
+    assert [m["mount_point"] for m in mounts] == ["/media/pi/MY USB"]
+
+
+def test_initial_state_from_file(tmp_path):
+    path = str(tmp_path / "mountinfo")
+    _write(path, BASE + USB)
+    presence = StoragePresence(path=path, ttl=0.05)
+    assert presence.mode == "ttl"
+    assert presence.connected
+    assert presence.current() == "/media/pi/MY USB"
+
+
+def test_system_mounts_are_not_external(tmp_path):
+    path = str(tmp_path / "mountinfo")
+    _write(path, BASE)
+    # حتی با پیشوند دستگاه، / و /boot/firmware حافظه خارجی نیستند
+    presence = StoragePresence(roots=("/media",), devices=("/dev/mmcblk0",), path=path, ttl=0.05)
+    assert presence.current() is None
+    assert not presence.connected
+
+
+def test_device_prefix_outside_roots(tmp_path):
+    path = str(tmp_path / "mountinfo")
+    _write(path, BASE + "50 22 8:1 / /mnt/usb rw - vfat /dev/sda1 rw\n")
+    assert StoragePresence(roots=("/media",), path=path).current() is None
+    assert StoragePresence(roots=("/media",), devices=("/dev/sd",), path=path).current() == "/mnt/usb"
+
+
+def test_plug_and_unplug_events(tmp_path):
+    path = str(tmp_path / "mountinfo")
+    _write(path, BASE)
+    events = []
+    presence = StoragePresence(path=path, ttl=0.05)
+    presence.add_listener(events.append)
+    try:
+        assert presence.current() is None
+
+        _write(path, BASE + USB)
+        assert _wait_for(lambda: len(events) == 1)
+        assert events[-1] == "/media/pi/MY USB"
+        assert presence.connected
+
+        _write(path, BASE)
+        assert _wait_for(lambda: len(events) == 2)
+        assert events[-1] is None
+        assert not presence.connected
+        assert presence.changes == 2
+    finally:
+        presence.stop()
+
+
+def test_refresh_without_change_does_not_notify(tmp_path):
+    path = str(tmp_path / "mountinfo")
+    _write(path, BASE + USB)
+    events = []
+    presence = StoragePresence(path=path, ttl=0.05)
+    presence.add_listener(events.append)
+    try:
+        # یک mount دیگر بعد از فلش اول: current عوض نمی‌شود پس رویدادی هم نیست
+        _write(path, BASE + USB + SECOND_USB)
+        presence.refresh()
+        assert presence.external == ["/media/pi/MY USB", "/media/pi/DATA"]
+        assert events == []
+
+        # جدا شدن فلش اول: دومی جای آن را می‌گیرد
+        _write(path, BASE + SECOND_USB)
+        presence.refresh()
+        assert events == ["/media/pi/DATA"]
+    finally:
+        presence.stop()
+
+
+def test_missing_file_keeps_last_state(tmp_path):
+    path = tmp_path / "mountinfo"
+    _write(str(path), BASE + USB)
+    presence = StoragePresence(path=str(path), ttl=0.05)
+    path.unlink()
+    assert presence.refresh() == "/media/pi/MY USB"
@@ -0,0 +1,220 @@
+import os
+import json
+import hashlib
+import threading
+
+from transfer_queue import TransferQueue
+
+CHUNK = 64 << 10
+
+
+def _make_source(folder, name="clip.mp4", size=1 << 20):
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, name)
+    data = os.urandom(size)
+    with open(path, "wb") as f:
+        f.write(data)
+    return path, data
+
+
+def _queue(tmp_path, usb, **kwargs):
+    kwargs.setdefault("chunk_size", CHUNK)
+    kwargs.setdefault("checkpoint_bytes", 4 * CHUNK)
+    kwargs.setdefault("retry_interval", 0.05)
+    return TransferQueue(str(tmp_path / "logs" / "transfers.json"), lambda: str(usb), **kwargs)
+
+
+def _journal_records(tmp_path):
+    with open(tmp_path / "logs" / "transfers.json") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def test_copy_verifies_and_removes_source(tmp_path):
+    usb = tmp_path / "usb"
+    usb.mkdir()
+    src, data = _make_source(str(tmp_path / "sd"))
+    queue = _queue(tmp_path, usb)
+    job = queue.submit(src, "videos")
+    try:
+        assert queue.wait(timeout=10)
+    finally:
+        queue.stop()
+
+    status = queue.status(job["id"])
+    assert status["state"] == "done"
+    assert status["percent"] == 100.0
+    assert status["sha256"] == hashlib.sha256(data).hexdigest()
+    assert (usb / "videos" / "clip.mp4").read_bytes() == data
+    assert not os.path.exists(src)
+    assert not (usb / "videos" / "clip.mp4.part").exists()
+
+
+def test_resume_from_checkpoint_after_crash(tmp_path):
+    usb = tmp_path / "usb"
+    (usb / "videos").mkdir(parents=True)
+    src, data = _make_source(str(tmp_path / "sd"))
+    dest = str(usb / "videos" / "clip.mp4")
+    synced = 4 * CHUNK
+
+    # وضعیت بعد از قطع برق: checkpoint در synced، بعد از آن داده fsync نشده در .part و یک خط نیمه‌نوشته
+    with open(dest + ".part", "wb") as f:
+        f.write(data[:synced])
+        f.write(os.urandom(2 * CHUNK))
+    job = {"id": "abc123", "src": src, "name": "clip.mp4", "subdir": "videos", "size": len(data),
+           "synced": synced, "state": "copying", "dest": dest, "sha256": None, "error": None,
+           "attempts": 1, "created": 0.0, "finished": None}
+    os.makedirs(tmp_path / "logs")
+    with open(tmp_path / "logs" / "transfers.json", "w") as f:
+        f.write(json.dumps(job) + "\n")
+        f.write('{"id": "abc123", "state": "do')
+
+    queue = _queue(tmp_path, usb)
+    status = queue.status("abc123")
+    assert status["state"] == "queued"
+    assert status["done"] == synced
+    queue.start()
+    try:
+        assert queue.wait(timeout=10)
+    finally:
+        queue.stop()
+
+    status = queue.status("abc123")
+    assert status["state"] == "done"
+    # فقط بعد از checkpoint دوباره کپی شده و داده fsync نشده دور ریخته شده
+    assert queue.bytes_copied == len(data) - synced
+    assert status["sha256"] == hashlib.sha256(data).hexdigest()
+    with open(dest, "rb") as f:
+        assert f.read() == data
+
+
+def test_resume_restarts_when_part_is_shorter_than_checkpoint(tmp_path):
+    usb = tmp_path / "usb"
+    (usb / "videos").mkdir(parents=True)
+    src, data = _make_source(str(tmp_path / "sd"))
+    dest = str(usb / "videos" / "clip.mp4")
+    with open(dest + ".part", "wb") as f:
+        f.write(data[:CHUNK])
+    job = {"id": "abc123", "src": src, "name": "clip.mp4", "subdir": "videos", "size": len(data),
+           "synced": 4 * CHUNK, "state": "copying", "dest": dest, "attempts": 1}
+    os.makedirs(tmp_path / "logs")
+    with open(tmp_path / "logs" / "transfers.json", "w") as f:
+        f.write(json.dumps(job) + "\n")
+
+    queue = _queue(tmp_path, usb)
+    queue.start()
+    try:
+        assert queue.wait(timeout=10)
+    finally:
+        queue.stop()
+    assert queue.status("abc123")["state"] == "done"
+    assert queue.bytes_copied == len(data)
+    with open(dest, "rb") as f:
+        assert f.read() == data
+
+
+def test_stop_and_resume_with_new_queue(tmp_path):
+    usb = tmp_path / "usb"
+    usb.mkdir()
+    src, data = _make_source(str(tmp_path / "sd"), size=8 << 20)
+    checkpoint = threading.Event()
+
+    def slow(status):
+        if status["synced"] >= 8 * CHUNK:
+            checkpoint.set()
+        threading.Event().wait(0.002)
+
+    first = _queue(tmp_path, usb)
+    first.add_listener(slow)
+    job = first.submit(src, "videos")
+    assert checkpoint.wait(10)
+    first.stop()
+    stopped = first.status(job["id"])
+    assert stopped["state"] == "queued"
+    assert 0 < stopped["synced"] < len(data)
+    # آخرین وضعیت در journal همان offset fsync شده است
+    assert _journal_records(tmp_path)[-1]["synced"] == stopped["synced"]
+
+    second = _queue(tmp_path, usb)
+    assert second.status(job["id"])["done"] == stopped["synced"]
+    second.start()
+    try:
+        assert second.wait(timeout=20)
+    finally:
+        second.stop()
+    assert second.status(job["id"])["state"] == "done"
+    assert second.bytes_copied == len(data) - stopped["synced"]
+    assert (usb / "videos" / "clip.mp4").read_bytes() == data
+
+
+def test_checksum_mismatch_is_retried_from_scratch(tmp_path, monkeypatch):
+    usb = tmp_path / "usb"
+    usb.mkdir()
+    src, data = _make_source(str(tmp_path / "sd"))
+    real = TransferQueue._hash_file
+    calls = []
+
+    def corrupt_once(path, view):
+        calls.append(path)
+        return "0" * 64 if len(calls) == 1 else real(path, view)
+
+    monkeypatch.setattr(TransferQueue, "_hash_file", staticmethod(corrupt_once))
+    queue = _queue(tmp_path, usb)
+    job = queue.submit(src, "videos")
+    try:
+        assert queue.wait(timeout=10)
+    finally:
+        queue.stop()
+
+    status = queue.status(job["id"])
+    assert status["state"] == "done"
+    assert status["attempts"] == 2
+    assert status["error"] is None
+    # بعد از ناهمخوانی .part حذف و کل فایل دوباره کپی شده
+    assert queue.bytes_copied == 2 * len(data)
+    assert (usb / "videos" / "clip.mp4").read_bytes() == data
+    records = [r for r in _journal_records(tmp_path) if r["id"] == job["id"]]
+    assert any(r["state"] == "queued" and r["synced"] == 0 and "checksum mismatch" in (r["error"] or "")
+               for r in records)
+
+
+def test_persistent_checksum_mismatch_fails_and_keeps_source(tmp_path, monkeypatch):
+    usb = tmp_path / "usb"
+    usb.mkdir()
+    src, data = _make_source(str(tmp_path / "sd"))
+    monkeypatch.setattr(TransferQueue, "_hash_file", staticmethod(lambda path, view: "0" * 64))
+    results = []
+    queue = _queue(tmp_path, usb)
+    job = queue.submit(src, "videos", callback=lambda dest, error=None: results.append((dest, error)))
+    try:
+        assert queue.wait(timeout=10)
+    finally:
+        queue.stop()
+
+    status = queue.status(job["id"])
+    assert status["state"] == "failed"
+    assert status["attempts"] == 3
+    assert "checksum mismatch" in status["error"]
+    assert results and results[0][1] == status["error"]
+    with open(src, "rb") as f:
+        assert f.read() == data
+    assert os.listdir(usb / "videos") == []
+
+    # وضعیت نهایی بعد از راه‌اندازی مجدد هم failed می‌ماند
+    reloaded = _queue(tmp_path, usb)
+    assert reloaded.status(job["id"])["state"] == "failed"
+
+
+def test_submit_many_uses_one_journal_write(tmp_path):
+    usb = tmp_path / "usb"
+    usb.mkdir()
+    paths = [_make_source(str(tmp_path / "sd"), f"img_{i}.jpg", size=1024)[0] for i in range(20)]
+    queue = _queue(tmp_path, usb)
+    writes = queue.journal_writes
+    jobs = queue.submit_many(paths, "images")
+    try:
+        assert queue.journal_writes == writes + 1
+        assert len(jobs) == 20
+        assert queue.wait(timeout=10)
+    finally:
+        queue.stop()
+    assert sorted(os.listdir(usb / "images")) == sorted(os.path.basename(p) for p in paths)
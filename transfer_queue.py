@@ -0,0 +1,572 @@
+#! /usr/bin/env python3
+"""
+transfer_queue.py
+صف پایدار انتقال فایل به حافظه USB با بررسی صحت و ادامه بعد از قطع
+
+به جای یک Thread جدا برای هر فایل (shutil.copy2 سپس os.remove):
+    - یک رشته I/O (یا چند رشته قابل تنظیم) فایل‌ها را به ترتیب ورود منتقل می‌کند
+    - کپی با قطعه‌های بزرگ (پیش‌فرض 4MB) در یک بافر ثابت، و fsync قبل از اعلام پایان
+    - sha256 منبع حین کپی محاسبه و بعد از fsync با خواندن دوباره مقصد مقایسه می‌شود
+      (کش صفحه مقصد قبل از خواندن دور ریخته می‌شود تا خود حافظه USB خوانده شود)
+    - فایل منبع فقط بعد از تأیید حذف می‌شود
+    - وضعیت کارها در یک journal فقط-افزودنی (هر خط JSON آخرین وضعیت یک کار) ذخیره می‌شود؛ بعد از
+      راه‌اندازی مجدد یا جدا و وصل شدن دوباره فلش، کپی از آخرین نقطه fsync شده در فایل .part ادامه پیدا می‌کند
+      (done پیشرفت زنده است و فقط در حافظه می‌ماند؛ در journal فقط synced، یعنی بایت‌های
+      fsync شده، ثبت می‌شود)
+    - فقط ورود به صف، checkpointها و وضعیت نهایی در journal نوشته می‌شوند (copying، verifying و waiting
+      بعد از راه‌اندازی مجدد به هر حال queued می‌شوند)؛ هر بار یک خط و یک fsync، نه بازنویسی کل فایل.
+      هر compact_every خط، journal از نو و فشرده نوشته می‌شود
+
+وضعیت‌ها: queued، copying، verifying، waiting (مقصد در دسترس نیست)، done، failed
+"""
+
+import os
+import json
+import time
+import uuid
+import hashlib
+from threading import Condition, Thread
+
+STATES = ("queued", "copying", "verifying", "waiting", "done", "failed")
+
+
+class TransferQueue:
+    def __init__(self, journal, resolve_dest, workers=1, chunk_size=4 << 20, checkpoint_bytes=64 << 20,
+                 retry_interval=5.0, verify=True, delete_source=True, keep_done=200, compact_every=1000):
+        """
+        :param journal: مسیر فایل JSON وضعیت کارها
+        :param resolve_dest: تابع resolve_dest() -> پوشه ریشه مقصد یا None اگر فلش وصل نیست
+        :param workers: تعداد رشته‌های I/O (برای یک فلش USB همان 1 بهترین است)
+        :param checkpoint_bytes: هر چند بایت مقصد fsync و پیشرفت در journal ثبت شود
+        :param retry_interval: فاصله تلاش دوباره وقتی مقصد در دسترس نیست (ثانیه)
+        :param keep_done: تعداد کارهای تمام شده که در journal برای گزارش نگه داشته می‌شوند
+        :param compact_every: بعد از این تعداد خط افزوده، journal فشرده بازنویسی می‌شود
+        """
+        self.journal = journal
+        self.resolve_dest = resolve_dest
+        self.workers = max(1, int(workers))
+        self.chunk_size = chunk_size
+        self.checkpoint_bytes = checkpoint_bytes
+        self.retry_interval = retry_interval
+        self.verify = verify
+        self.delete_source = delete_source
+        self.keep_done = keep_done
+        self.compact_every = compact_every
+
+        self._cond = Condition()
+        self._jobs = {}          # id -> dict (به ترتیب ورود)
+        self._callbacks = {}     # id -> callback(dest, error=None)؛ پایدار نیست
+        self._listeners = []
+        self._threads = []
+        self._running = False
+        self._journal_file = None
+        self._appended = 0
+
+        self.journal_writes = 0  # تعداد fsync های journal
+        self.journal_bytes = 0
+        self.bytes_copied = 0
+        self.busy = 0.0
+        self._load()
+
+    # -----------------------
+    # journal
+    # -----------------------
+    def _load(self):
+        if not os.path.exists(self.journal):
+            return
+        jobs = {}
+        try:
+            with open(self.journal) as f:
+                text = f.read()
+            if text.lstrip().startswith("["):
+                # قالب قدیمی: یک آرایه JSON از همه کارها
+                jobs = {job["id"]: job for job in json.loads(text)}
+            else:
+                for line in text.splitlines():
+                    if not line.strip():
+                        continue
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # خط نیمه‌نوشته آخر بعد از قطع برق
+                        print("[Transfer Journal Error]: torn record ignored")
+                        break
+                    jobs[record["id"]] = record
+        except (OSError, ValueError) as e:
+            print(f"[Transfer Journal Error]: {e}")
+        for job in jobs.values():
+            if job["state"] in ("copying", "verifying", "waiting"):
+                # کار نیمه‌تمام از اجرای قبلی؛ از آخرین checkpoint ادامه پیدا می‌کند
+                job["state"] = "queued"
+            job.setdefault("synced", job.get("done", 0) if job["state"] == "done" else 0)
+            job["done"] = job["synced"]
+            self._jobs[job["id"]] = job
+        if jobs:
+            self._compact()
+
+    @staticmethod
+    def _record(job):
+        # done ممکن است از داده‌ای جلوتر باشد که هنوز fsync نشده؛ فقط synced ثبت می‌شود
+        return json.dumps({k: v for k, v in job.items() if k != "done"}) + "\n"
+
+    def _append(self, jobs):
+        """افزودن آخرین وضعیت کارها به journal با یک fsync (صدا زده شده با قفل)"""
+        text = "".join(self._record(job) for job in jobs)
+        try:
+            if self._journal_file is None:
+                os.makedirs(os.path.dirname(os.path.abspath(self.journal)), exist_ok=True)
+                self._journal_file = open(self.journal, "a")
+            self._journal_file.write(text)
+            self._journal_file.flush()
+            os.fsync(self._journal_file.fileno())
+            self.journal_writes += 1
+            self.journal_bytes += len(text)
+        except OSError as e:
+            print(f"[Transfer Journal Error]: {e}")
+            return
+        self._appended += len(jobs)
+        if self._appended >= self.compact_every:
+            self._compact()
+
+    def _compact(self):
+        """بازنویسی اتمیک journal با یک خط برای هر کار (صدا زده شده با قفل)"""
+        done = [j for j in self._jobs.values() if j["state"] == "done"]
+        for job in done[:max(0, len(done) - self.keep_done)]:
+            del self._jobs[job["id"]]
+        os.makedirs(os.path.dirname(os.path.abspath(self.journal)), exist_ok=True)
+        tmp = self.journal + ".tmp"
+        try:
+            text = "".join(self._record(job) for job in self._jobs.values())
+            with open(tmp, "w") as f:
+                f.write(text)
+                f.flush()
+                os.fsync(f.fileno())
+            if self._journal_file is not None:
+                self._journal_file.close()
+                self._journal_file = None
+            os.replace(tmp, self.journal)
+            _fsync_dir(os.path.dirname(os.path.abspath(self.journal)))
+            self.journal_writes += 1
+            self.journal_bytes += len(text)
+            self._appended = 0
+        except OSError as e:
+            print(f"[Transfer Journal Error]: {e}")
+
+    # -----------------------
+    # رابط
+    # -----------------------
+    def start(self):
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+            self._threads = [Thread(target=self._run, name=f"transfer-{i}", daemon=True)
+                             for i in range(self.workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self, timeout=5.0):
+        """توقف رشته‌ها؛ کار در حال کپی در اجرای بعدی از checkpoint ادامه پیدا می‌کند"""
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+        with self._cond:
+            if self._journal_file is not None:
+                self._journal_file.close()
+                self._journal_file = None
+
+    def submit(self, src, subdir="", callback=None):
+        """
+        افزودن فایل به صف
+        :param subdir: زیرپوشه مقصد (مثلاً 'videos')
+        :param callback: callback(dest_path, error=None) بعد از پایان یا شکست
+        :return: وضعیت کار (dict)
+        """
+        return self.submit_many([src], subdir, callback)[0]
+
+    def submit_many(self, paths, subdir="", callback=None):
+        """
+        افزودن چند فایل با یک نوشتن و یک fsync در journal (مثلاً عکس‌های یک burst)
+        :param callback: callback(dest_path, error=None) برای هر فایل
+        :return: فهرست وضعیت کارها
+        """
+        jobs = []
+        for src in paths:
+            src = os.path.abspath(src)
+            jobs.append({
+                "id": uuid.uuid4().hex[:12],
+                "src": src,
+                "name": os.path.basename(src),
+                "subdir": subdir,
+                "size": os.path.getsize(src),
+                "done": 0,
+                "synced": 0,
+                "state": "queued",
+                "dest": None,
+                "sha256": None,
+                "error": None,
+                "attempts": 0,
+                "created": time.time(),
+                "finished": None,
+            })
+        if not jobs:
+            return []
+        with self._cond:
+            for job in jobs:
+                self._jobs[job["id"]] = job
+                if callback is not None:
+                    self._callbacks[job["id"]] = callback
+            self._append(jobs)
+            self._cond.notify_all()
+        for job in jobs:
+            self._emit(job)
+        self.start()
+        return [dict(job) for job in jobs]
+
+    def status(self, key):
+        """وضعیت یک کار با id یا مسیر فایل منبع؛ None اگر پیدا نشود"""
+        with self._cond:
+            job = self._jobs.get(key)
+            if job is None:
+                path = os.path.abspath(key)
+                matches = [j for j in self._jobs.values() if j["src"] == path]
+                job = matches[-1] if matches else None
+            if job is None:
+                return None
+            status = dict(job)
+        return _with_percent(status)
+
+    def jobs(self, states=None):
+        with self._cond:
+            return [dict(j) for j in self._jobs.values() if states is None or j["state"] in states]
+
+    def add_listener(self, fn):
+        """fn(status) با هر تغییر وضعیت و بعد از هر chunk کپی شده (در رشته I/O؛ باید سریع باشد)"""
+        self._listeners.append(fn)
+
+    def _emit(self, job):
+        for fn in self._listeners:
+            try:
+                fn(_with_percent(dict(job)))
+            except Exception as e:
+                print(f"[Transfer Listener Error]: {e}")
+
+    def wake(self):
+        """بیدار کردن رشته‌های منتظر مقصد (مثلاً وقتی فلش دوباره وصل شد)"""
+        with self._cond:
+            self._cond.notify_all()
+
+    def retry(self, job_id):
+        """برگرداندن کار شکست خورده به صف"""
+        with self._cond:
+            job = self._jobs.get(job_id)
+            if job is None or job["state"] != "failed":
+                return False
+            job.update(state="queued", error=None, attempts=0)
+            self._append([job])
+            self._cond.notify_all()
+        return True
+
+    def wait(self, timeout=None):
+        """صبر تا خالی شدن صف (همه کارها done یا failed)"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while any(j["state"] not in ("done", "failed") for j in self._jobs.values()):
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    # -----------------------
+    # رشته I/O
+    # -----------------------
+    def _next_job(self):
+        """قدیمی‌ترین کار در صف (صدا زده شده با قفل)"""
+        for job in self._jobs.values():
+            if job["state"] in ("queued", "waiting"):
+                return job
+        return None
+
+    def _run(self):
+        buffer = bytearray(self.chunk_size)
+        while True:
+            with self._cond:
+                job = None
+                while self._running:
+                    job = self._next_job()
+                    if job is not None:
+                        break
+                    self._cond.wait()
+                if not self._running:
+                    return
+                job["state"] = "copying"
+
+            root = self.resolve_dest()
+            if not root:
+                self._set(job, state="waiting", error="destination not available")
+                self._pause()
+                continue
+            # فقط تلاش‌های واقعی کپی/بررسی شمرده می‌شوند، نه انتظار برای وصل شدن فلش
+            with self._cond:
+                job["attempts"] += 1
+            try:
+                t0 = time.monotonic()
+                self._transfer(job, root, buffer)
+                self.busy += time.monotonic() - t0
+            except FileNotFoundError as e:
+                if not os.path.exists(job["src"]):
+                    self._finish(job, error=f"source missing: {e}")
+                else:
+                    self._set(job, state="waiting", error=str(e))
+                    self._pause()
+            except ValueError as e:
+                # ناهمخوانی hash؛ فایل .part حذف شده و کار از ابتدا دوباره انجام می‌شود
+                print(f"[Transfer Error]: {e}")
+                if job["attempts"] >= 3:
+                    self._finish(job, error=str(e))
+                else:
+                    self._set(job, persist=True, state="queued", error=str(e))
+            except OSError as e:
+                # فلش جدا شد یا خطای I/O؛ بعد از وصل شدن دوباره از checkpoint ادامه می‌یابد
+                print(f"[Transfer Error]: {e}")
+                self._set(job, state="waiting", error=str(e))
+                self._pause()
+
+    def _pause(self):
+        with self._cond:
+            if self._running:
+                self._cond.wait(self.retry_interval)
+
+    def _set(self, job, persist=False, **changes):
+        """:param persist: ثبت در journal (فقط checkpoint، ورود دوباره به صف و وضعیت نهایی)"""
+        with self._cond:
+            job.update(changes)
+            if persist:
+                self._append([job])
+            self._cond.notify_all()
+        self._emit(job)
+
+    def _finish(self, job, dest=None, error=None):
+        self._set(job, persist=True, state="failed" if error else "done", dest=dest or job["dest"], error=error,
+                  finished=time.time())
+        callback = self._callbacks.pop(job["id"], None)
+        if callback is not None:
+            try:
+                callback(dest, error) if error else callback(dest)
+            except Exception as e:
+                print(f"[Transfer Callback Error]: {e}")
+
+    def _destination(self, job, root):
+        folder = os.path.join(root, job["subdir"]) if job["subdir"] else root
+        os.makedirs(folder, exist_ok=True)
+        dest = job["dest"]
+        if dest and os.path.dirname(dest) == folder:
+            return dest
+        # نام تکراری روی فلش بازنویسی نمی‌شود
+        base, ext = os.path.splitext(job["name"])
+        dest = os.path.join(folder, job["name"])
+        n = 1
+        while os.path.exists(dest):
+            dest = os.path.join(folder, f"{base}_{n}{ext}")
+            n += 1
+        return dest
+
+    def _transfer(self, job, root, buffer):
+        dest = self._destination(job, root)
+        part = dest + ".part"
+        view = memoryview(buffer)
+        digest = hashlib.sha256()
+
+        # ادامه از آخرین checkpoint: فقط بایت‌هایی که fsync و در journal ثبت شده‌اند معتبرند
+        offset = job["synced"] if job["dest"] == dest and os.path.exists(part) else 0
+        if offset and os.path.getsize(part) < offset:
+            offset = 0
+        # فقط اگر checkpoint ثبت شده قبلی دیگر معتبر نیست در journal نوشته می‌شود
+        self._set(job, persist=offset != job["synced"], dest=dest, done=offset, synced=offset, error=None)
+
+        with open(job["src"], "rb") as src, open(part, "r+b" if offset else "wb") as out:
+            # hash منبع تا نقطه ادامه دوباره ساخته می‌شود (فقط خواندن از کارت SD)
+            remaining = offset
+            while remaining:
+                n = src.readinto(view[:min(len(view), remaining)])
+                if not n:
+                    raise ValueError(f"{job['src']} is shorter than the resumed copy")
+                digest.update(view[:n])
+                remaining -= n
+            out.truncate(offset)
+            out.seek(offset)
+
+            since_checkpoint = 0
+            while self._running:
+                n = src.readinto(view)
+                if not n:
+                    break
+                digest.update(view[:n])
+                out.write(view[:n])
+                offset += n
+                since_checkpoint += n
+                self.bytes_copied += n
+                if since_checkpoint >= self.checkpoint_bytes:
+                    out.flush()
+                    os.fsync(out.fileno())
+                    since_checkpoint = 0
+                    self._set(job, persist=True, done=offset, synced=offset)
+                else:
+                    job["done"] = offset
+                    self._emit(job)
+            out.flush()
+            os.fsync(out.fileno())
+        if not self._running:
+            self._set(job, persist=True, state="queued", done=offset, synced=offset)
+            return
+
+        checksum = digest.hexdigest()
+        self._set(job, state="verifying", done=offset, synced=offset, size=offset, sha256=checksum)
+        if self.verify:
+            copied = self._hash_file(part, view)
+            if copied != checksum:
+                os.remove(part)
+                self._set(job, persist=True, done=0, synced=0)
+                raise ValueError(f"checksum mismatch for {job['name']}: {copied} != {checksum}")
+        os.replace(part, dest)
+        _fsync_dir(os.path.dirname(dest))
+
+        if self.delete_source:
+            try:
+                os.remove(job["src"])
+            except OSError as e:
+                print(f"[Transfer Cleanup Error]: {e}")
+        self._finish(job, dest=dest)
+
+    @staticmethod
+    def _hash_file(path, view):
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            if hasattr(os, "posix_fadvise"):
+                # خواندن از خود حافظه USB، نه از کش صفحه‌ای که همین الان نوشته شد
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+            while True:
+                n = f.readinto(view)
+                if not n:
+                    break
+                digest.update(view[:n])
+        return digest.hexdigest()
+
+    def summary(self):
+        with self._cond:
+            counts = {state: 0 for state in STATES}
+            pending = 0
+            for job in self._jobs.values():
+                counts[job["state"]] += 1
+                if job["state"] not in ("done", "failed"):
+                    pending += job["size"] - job["done"]
+        return {
+            "workers": self.workers,
+            "jobs": counts,
+            "pending_bytes": pending,
+            "bytes_copied": self.bytes_copied,
+            "journal_writes": self.journal_writes,
+            "journal_bytes": self.journal_bytes,
+            "mb_per_s": self.bytes_copied / self.busy / 2**20 if self.busy else 0.0,
+        }
+
+
+def _with_percent(status):
+    status["percent"] = 100.0 * status["done"] / status["size"] if status["size"] else 100.0
+    return status
+
+
+def _fsync_dir(path):
+    """ثبت rename روی دیسک (روی FAT/exFAT ممکن است پشتیبانی نشود)"""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+if __name__ == "__main__":
+    # بنچمارک: چند کلیپ همزمان، یک رشته در برابر یک Thread برای هر فایل (shutil.copy2)،
+    # و قطع مقصد وسط کپی و ادامه از checkpoint
+    import argparse
+    import shutil
+    import tempfile
+
+    parser = argparse.ArgumentParser(description="Transfer queue benchmark")
+    parser.add_argument("--files", type=int, default=8)
+    parser.add_argument("--mb", type=int, default=64, help="اندازه هر فایل")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--dest", default=None, help="پوشه روی فلش USB (پیش‌فرض پوشه موقت)")
+    args = parser.parse_args()
+
+    work = tempfile.mkdtemp()
+    dest_root = args.dest or tempfile.mkdtemp()
+    block = os.urandom(1 << 20)
+
+    def make_files(tag):
+        paths = []
+        for i in range(args.files):
+            path = os.path.join(work, f"{tag}_{i}.mp4")
+            with open(path, "wb") as f:
+                for _ in range(args.mb):
+                    f.write(block)
+            paths.append(path)
+        return paths
+
+    total = args.files * args.mb
+    paths = make_files("threads")
+    t0 = time.monotonic()
+    threads = [Thread(target=lambda p: (shutil.copy2(p, os.path.join(dest_root, os.path.basename(p))),
+                                        os.remove(p)), args=(p,)) for p in paths]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    os.sync()
+    elapsed = time.monotonic() - t0
+    print(f"thread per file (no fsync/verify): {total / elapsed:7.1f} MB/s")
+
+    paths = make_files("queue")
+    journal = os.path.join(work, "transfers.json")
+    transfers = TransferQueue(journal, lambda: dest_root, workers=args.workers)
+    t0 = time.monotonic()
+    for p in paths:
+        transfers.submit(p, "videos")
+    transfers.wait()
+    elapsed = time.monotonic() - t0
+    summary = transfers.summary()
+    print(f"queue ({args.workers} worker, fsync+verify): {total / elapsed:7.1f} MB/s  {summary['jobs']}  "
+          f"journal: {summary['journal_writes']} fsyncs, {summary['journal_bytes'] / 1024:.0f} KB")
+    transfers.stop()
+
+    # قطع مقصد: بعد از اولین checkpoint «فلش جدا می‌شود» و صف متوقف می‌شود، سپس از نو ساخته می‌شود
+    path = make_files("resume")[0]
+    available = [True]
+    transfers = TransferQueue(journal, lambda: dest_root if available[0] else None,
+                              checkpoint_bytes=8 << 20, retry_interval=0.2)
+    job = transfers.submit(path, "videos")
+    while (transfers.status(job["id"]) or {}).get("done", 0) < (16 << 20):
+        time.sleep(0.01)
+    available[0] = False
+    transfers.stop()
+    status = transfers.status(job["id"])
+    print(f"interrupted at {status['done'] >> 20} MB (synced {status['synced'] >> 20} MB)")
+    transfers = TransferQueue(journal, lambda: dest_root, retry_interval=0.2)
+    resumed_from = transfers.status(job["id"])["done"]
+    transfers.start()
+    transfers.wait()
+    status = transfers.status(job["id"])
+    print(f"resumed from {resumed_from >> 20} MB -> {status['state']} sha256={status['sha256'][:16]}...")
+    transfers.stop()
+    shutil.rmtree(work)
+    if args.dest is None:
+        shutil.rmtree(dest_root)